@@ -0,0 +1,388 @@
+"""Process many workspace recordings with one global worker budget.
+
+The stages of all selected recordings are scheduled across a fixed number of
+stage runners sharing one pool of worker processes, instead of every stage
+starting a pool of all cores. A stage only starts while the estimated memory
+of the running stages stays within the memory budget, and recordings are
+taken in priority order (smallest, largest, newest or oldest first).
+
+    python batch_process.py --workspace downloads --order smallest --workers 16
+"""
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+from depth_decimation import add_decimation_arguments, decimation_from_arguments
+from frame_selection import add_selection_arguments, selection_from_arguments
+from keyframes import add_keyframe_arguments, keyframes_from_arguments
+from process_all import build_stages, is_eye_only, process_eye_only
+from stage_metrics import RecordingMetrics
+from stream_health import check_stream_health
+from workspace_summary import WorkspaceSummaries, matches
+from worker_pool import set_thread_policy, shared_pool
+
+ORDERS = ["smallest", "largest", "newest", "oldest"]
+MB = 1024 * 1024
+# resident memory of a stage besides its inputs, the pool is accounted apart
+STAGE_BASE_MEMORY = 64 * MB
+
+
+def memory_budget():
+    """Three quarters of the physical memory, None where it is unknown."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 3 // 4
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def file_size(recording_path, pattern):
+    return sum(path.stat().st_size for path in recording_path.glob(pattern))
+
+
+def stage_memory(recording_path, stage_name, workers):
+    """Rough resident memory of a stage in the main process and the pool."""
+    if stage_name in ("project hand/eye", "eye"):
+        # np.loadtxt of the 861 column csv holds a few copies of the rows
+        return STAGE_BASE_MEMORY + 4 * file_size(recording_path, "*_eye.csv")
+    if stage_name.startswith("point clouds "):
+        sensor_name = stage_name[len("point clouds ") :]
+        # every worker gets its own copy of the lookup table
+        lut_size = file_size(recording_path, f"{sensor_name}_lut.bin")
+        return STAGE_BASE_MEMORY + (workers + 2) * 2 * lut_size
+    return STAGE_BASE_MEMORY
+
+
+def recording_size(recording_path):
+    return sum(
+        path.stat().st_size for path in recording_path.iterdir() if path.is_file()
+    )
+
+
+def order_recordings(recording_paths, order):
+    # recording names are their start time, YYYY-MM-DD-HHMMSS
+    if order == "smallest":
+        return sorted(recording_paths, key=recording_size)
+    if order == "largest":
+        return sorted(recording_paths, key=recording_size, reverse=True)
+    if order == "newest":
+        return sorted(recording_paths, key=lambda path: path.name, reverse=True)
+    return sorted(recording_paths, key=lambda path: path.name)
+
+
+def select_recordings(w_path, names=None):
+    """The named workspace recordings, or all the unprocessed ones."""
+    recording_paths = sorted(
+        path
+        for path in w_path.glob("*")
+        if path.is_dir() and not path.name.startswith(".")
+    )
+    if names:
+        return [path for path in recording_paths if path.name in names]
+    summaries = WorkspaceSummaries(w_path).summaries(recording_paths)
+    return [
+        path
+        for path, summary in zip(recording_paths, summaries)
+        if summary is not None and matches(summary, ["unprocessed"])
+    ]
+
+
+class BatchRecording:
+    def __init__(
+        self,
+        recording_path,
+        project_hand_eye,
+        overlay_output,
+        overlay_scale,
+        selection=None,
+        keyframes=None,
+        decimation=None,
+    ):
+        self.path = recording_path
+        self.selection = selection
+        self.metrics = RecordingMetrics(recording_path)
+        if is_eye_only(recording_path):
+            eye_stage = partial(process_eye_only, selection=selection)
+            self.stages = [("eye", [], [], eye_stage)]
+        else:
+            filenames = [p.name for p in recording_path.iterdir() if p.is_file()]
+            self.stages = build_stages(
+                filenames,
+                project_hand_eye,
+                overlay_output,
+                overlay_scale,
+                selection,
+                keyframes,
+                decimation,
+            )
+        self.pending = list(self.stages)
+        self.done_stages = set()
+        self.failed_stages = set()
+        self.running = 0
+        self.start = None
+
+    def finished(self):
+        return not self.pending and not self.running
+
+
+class BatchScheduler:
+    """Runs the stages of several recordings on max_stages stage runners.
+
+    Recordings are served in the order given, a stage of a later recording
+    only starts when no earlier one has a stage that is ready and fits the
+    memory budget. The first ready stage always starts when nothing runs, even
+    if its estimate is above the budget. Stages depending on a failed stage
+    are skipped.
+    """
+
+    def __init__(self, recordings, workers, max_stages=2, max_memory=None):
+        self.recordings = recordings
+        self.workers = workers
+        self.max_memory = max_memory
+        self.max_stages = max_stages
+        self.running = 0
+        self.memory = 0
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_stages)
+        self.results = {}
+
+    def _next_stage(self):
+        # called with the condition held
+        for recording in self.recordings:
+            for stage in recording.pending:
+                name, _, required_stages, _ = stage
+                if not all(r in recording.done_stages for r in required_stages):
+                    continue
+                memory = stage_memory(recording.path, name, self.workers)
+                fits = self.max_memory is None or (
+                    self.memory + memory <= self.max_memory
+                )
+                if fits or self.running == 0:
+                    return recording, stage, memory
+        return None
+
+    def _skip_dependents(self, recording):
+        # called with the condition held
+        skipped = True
+        while skipped:
+            skipped = False
+            for stage in list(recording.pending):
+                name, _, required_stages, _ = stage
+                if any(r in recording.failed_stages for r in required_stages):
+                    print(f"[!] {recording.path.name}: skipping {name}")
+                    recording.pending.remove(stage)
+                    recording.failed_stages.add(name)
+                    skipped = True
+
+    def _submit_ready(self):
+        # called with the condition held
+        while self.running < self.max_stages:
+            ready = self._next_stage()
+            if ready is None:
+                break
+            recording, stage, memory = ready
+            recording.pending.remove(stage)
+            recording.running += 1
+            if recording.start is None:
+                recording.start = time.perf_counter()
+            self.running += 1
+            self.memory += memory
+            self.executor.submit(self._run, recording, stage, memory)
+        self.condition.notify_all()
+
+    def _run(self, recording, stage, memory):
+        name, _, _, function = stage
+        print(f"[!] {recording.path.name}: starting {name}")
+        try:
+            with recording.metrics.stage(name):
+                function(recording.path)
+        except Exception:
+            traceback.print_exc()
+            print(f"[!] {recording.path.name}: {name} failed")
+            failed = True
+        else:
+            failed = False
+
+        with self.condition:
+            recording.running -= 1
+            if failed:
+                recording.failed_stages.add(name)
+                self._skip_dependents(recording)
+            else:
+                recording.done_stages.add(name)
+            finished = recording.finished()
+        # the runner is released after the report, run() waits for it
+        if finished:
+            self._finish(recording)
+        with self.condition:
+            self.running -= 1
+            self.memory -= memory
+            self._submit_ready()
+
+    def _finish(self, recording):
+        elapsed = time.perf_counter() - recording.start
+        if recording.stages and recording.stages[0][0] != "eye":
+            try:
+                with recording.metrics.stage("stream health"):
+                    check_stream_health(recording.path, recording.selection)
+            except Exception:
+                traceback.print_exc()
+        failed = sorted(recording.failed_stages)
+        self.results[recording.path.name] = {
+            "seconds": elapsed,
+            "stages": len(recording.stages),
+            "failed": failed,
+        }
+        state = "failed: " + ", ".join(failed) if failed else "done"
+        print(f"\n[!] {recording.path.name} {state} in {elapsed:.1f}s")
+
+    def run(self):
+        """Run all stages, returns {name: result} of the recordings."""
+        with self.condition:
+            for recording in self.recordings:
+                if not recording.stages:
+                    print(f"[!] {recording.path.name}: nothing to process")
+                    recording.start = time.perf_counter()
+                    self.results[recording.path.name] = {
+                        "seconds": 0.0,
+                        "stages": 0,
+                        "failed": [],
+                    }
+            self._submit_ready()
+            while self.running:
+                self.condition.wait()
+        self.executor.shutdown()
+        return self.results
+
+
+def batch_process(
+    w_path,
+    names=None,
+    order="smallest",
+    workers=None,
+    max_stages=2,
+    max_memory=None,
+    project_hand_eye=False,
+    overlay_output="video",
+    overlay_scale=1.0,
+    selection=None,
+    keyframes=None,
+    decimation=None,
+):
+    """Process the named recordings of the workspace, or all unprocessed ones,
+    on one pool of workers processes (all cores by default) with at most
+    max_stages stages and max_memory bytes of estimated stage memory at a
+    time. With a frame_selection.FrameSelection only the selected frames of
+    every recording are processed, with a keyframes.KeyframeSelector only the
+    keyframes of the depth streams are turned into point clouds, from depth
+    images reduced by the depth_decimation.DepthDecimation if given."""
+    recording_paths = order_recordings(select_recordings(w_path, names), order)
+    if not recording_paths:
+        print("[!] No recordings to process")
+        return {}
+    workers = workers or multiprocessing.cpu_count()
+    print(
+        "[!] Processing {} recordings, {} first, {} workers, {} stages".format(
+            len(recording_paths), order, workers, max_stages
+        )
+    )
+    recordings = [
+        BatchRecording(
+            path,
+            project_hand_eye,
+            overlay_output,
+            overlay_scale,
+            selection,
+            keyframes,
+            decimation,
+        )
+        for path in recording_paths
+    ]
+
+    start = time.perf_counter()
+    with shared_pool(workers):
+        results = BatchScheduler(recordings, workers, max_stages, max_memory).run()
+    elapsed = time.perf_counter() - start
+
+    n_failed = sum(1 for result in results.values() if result["failed"])
+    print(
+        "[!] Batch done: {} recordings in {:.1f}s ({:.1f} per hour), {} failed".format(
+            len(results),
+            elapsed,
+            3600 * len(results) / elapsed if elapsed > 0 else 0.0,
+            n_failed,
+        )
+    )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process workspace recordings.")
+    parser.add_argument("--workspace", default="downloads", help="Workspace folder")
+    parser.add_argument(
+        "--recordings",
+        nargs="*",
+        default=None,
+        help="Names of the recordings to process, all unprocessed ones by default",
+    )
+    parser.add_argument(
+        "--order", default="smallest", choices=ORDERS, help="Which recordings first"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes shared by all stages, all cores by default",
+    )
+    parser.add_argument(
+        "--max_stages", type=int, default=2, help="Stages run at the same time"
+    )
+    parser.add_argument(
+        "--max_memory",
+        type=float,
+        default=None,
+        help="Memory budget of the running stages in GB, 3/4 of the RAM by default",
+    )
+    parser.add_argument(
+        "--project_hand_eye",
+        action="store_true",
+        help="Project hand joints (and eye gaze, if recorded) to rgb images",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="OpenCV/OpenMP/BLAS threads per worker, cores / workers by default, "
+        "0 for the library defaults",
+    )
+    parser.add_argument(
+        "--affinity",
+        action="store_true",
+        help="Pin every worker to its own cores (Linux only)",
+    )
+    add_selection_arguments(parser)
+    add_keyframe_arguments(parser)
+    add_decimation_arguments(parser)
+
+    args = parser.parse_args()
+    set_thread_policy(args.workers, args.threads_per_worker, args.affinity)
+    max_memory = memory_budget()
+    if args.max_memory is not None:
+        max_memory = int(args.max_memory * 1024 * MB)
+    batch_process(
+        Path(args.workspace),
+        args.recordings,
+        args.order,
+        args.workers,
+        args.max_stages,
+        max_memory,
+        args.project_hand_eye,
+        selection=selection_from_arguments(args),
+        keyframes=keyframes_from_arguments(args),
+        decimation=decimation_from_arguments(args),
+    )
@@ -0,0 +1,426 @@
+"""Time the converters on a recording, by default a synthetic one.
+
+Every stage runs in a fresh process, so its peak RSS is its own. It is
+reported for the stage process and for the largest of the workers it started,
+a pool of n workers takes about n times the latter. Stages run in pipeline
+order on the same recording since they consume each other's outputs, stages
+whose libraries are missing (e.g. open3d for the point clouds and the TSDF)
+are reported as skipped.
+
+With --thread_sweep the stages run on a fresh copy of the recording for every
+combination of full and half width pools with the library default threads
+and with the threads per worker of worker_pool.set_thread_policy(), to show
+the cost of nested parallelism on the machine. The combinations are repeated
+--sweep_repeats times in a rotated order and the median time of every stage
+is reported with its spread.
+
+    python benchmark.py --duration 10
+    python benchmark.py --recording_path path/to/recording --output bench.json
+    python benchmark.py --duration 10 --thread_sweep
+"""
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import statistics
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+from stage_metrics import peak_rss
+from synthetic_recording import SENSORS, write_recording
+from worker_pool import set_thread_policy
+
+BENCHMARK_FILENAME = "benchmark.json"
+DEFAULT_SENSORS = ["PV", "Depth AHaT", "Depth Long Throw"]
+
+
+def extract_bench(recording_path):
+    from utils import extract_tar_file
+
+    n_frames = 0
+    for tar_path in sorted(recording_path.glob("*.tar")):
+        output_path = recording_path / tar_path.stem
+        output_path.mkdir(exist_ok=True)
+        extract_tar_file(str(tar_path), str(output_path))
+        n_frames += sum(1 for _ in output_path.iterdir())
+    return n_frames
+
+
+def convert_images_bench(recording_path):
+    from convert_images import convert_images
+
+    n_frames = len(list((recording_path / "PV").glob("*.bytes")))
+    convert_images(recording_path)
+    return n_frames
+
+
+def load_head_hand_eye_bench(recording_path):
+    from utils import load_head_hand_eye_data
+
+    csv_path = next(recording_path.glob("*_eye.csv"))
+    return len(load_head_hand_eye_data(csv_path)[0])
+
+
+def project_hand_eye_bench(recording_path):
+    from project_hand_eye_to_pv import project_hand_eye_to_pv
+
+    project_hand_eye_to_pv(recording_path)
+    return len(list((recording_path / "PV").glob("*.png")))
+
+
+def stream_health_bench(recording_path):
+    # check_framerates forwards to the stream health report
+    from utils import check_framerates
+    from stream_health import recording_streams
+
+    check_framerates(recording_path)
+    streams, _ = recording_streams(recording_path)
+    return sum(len(timestamps) for timestamps in streams.values())
+
+
+def save_pclouds_bench(recording_path, sensor_name):
+    from save_pclouds import save_pclouds
+
+    save_pclouds(recording_path, sensor_name)
+    return len(list((recording_path / sensor_name).glob("*[0-9].pgm")))
+
+
+def tsdf_bench(recording_path):
+    # the script name is not a valid module name
+    spec = importlib.util.spec_from_file_location(
+        "tsdf_integration", Path(__file__).parent / "tsdf-integration.py"
+    )
+    tsdf_integration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tsdf_integration)
+
+    pinhole_path = recording_path / "pinhole_projection"
+    if not (pinhole_path / "depth.txt").exists():
+        raise FileNotFoundError("No pinhole projection, the point clouds failed")
+    tsdf_integration.integrate_tsdf(pinhole_path)
+    with open(pinhole_path / "depth.txt") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def build_benchmark_stages(recording_path):
+    """(name, function, args) of the stages that apply to the recording."""
+    filenames = {path.name for path in recording_path.iterdir()}
+    has_pv = "PV.tar" in filenames
+    has_csv = any(name.endswith("_eye.csv") for name in filenames)
+
+    stages = [("extract tars", extract_bench, ())]
+    if has_pv:
+        stages.append(("convert_images", convert_images_bench, ()))
+    if has_csv:
+        stages.append(("load_head_hand_eye_data", load_head_hand_eye_bench, ()))
+    if has_pv and has_csv:
+        stages.append(("project_hand_eye_to_pv", project_hand_eye_bench, ()))
+    stages.append(("check_framerates", stream_health_bench, ()))
+    depth_sensors = [
+        name
+        for name in ["Depth Long Throw", "Depth AHaT"]
+        if f"{name}.tar" in filenames
+    ]
+    for sensor_name in depth_sensors:
+        stages.append(
+            (f"save_pclouds {sensor_name}", save_pclouds_bench, (sensor_name,))
+        )
+    if has_pv and depth_sensors:
+        stages.append(("tsdf integration", tsdf_bench, ()))
+    return stages
+
+
+def run_stage(function, args, recording_path, results, policy):
+    # runs in the stage process, output of the converters is not timed apart
+    set_thread_policy(*policy)
+    start = time.perf_counter()
+    try:
+        n_frames = function(recording_path, *args)
+    except ImportError as e:
+        results.put({"status": "skipped", "error": str(e)})
+        return
+    except Exception as e:
+        traceback.print_exc()
+        results.put({"status": "failed", "error": str(e)})
+        return
+    elapsed = time.perf_counter() - start
+    rss_self, rss_children = peak_rss()
+    results.put(
+        {
+            "status": "ok",
+            "seconds": elapsed,
+            "frames": n_frames,
+            "fps": n_frames / elapsed if elapsed > 0 else 0.0,
+            # the largest single worker, pools use about workers times that
+            "peak_rss_self": rss_self,
+            "peak_rss_children": rss_children,
+        }
+    )
+
+
+def run_benchmark(recording_path, policy=(None, None, False)):
+    """Run the stages with the thread policy (workers, threads per worker,
+    affinity) of worker_pool.set_thread_policy()."""
+    # spawn so a stage does not start with the memory of the parent
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name, function, args in build_benchmark_stages(recording_path):
+        print(f"[!] Running {name}...")
+        results_queue = context.Queue()
+        process = context.Process(
+            target=run_stage,
+            args=(function, args, recording_path, results_queue, policy),
+        )
+        process.start()
+        process.join()
+        try:
+            result = results_queue.get(timeout=5)
+        except queue.Empty:
+            result = {"status": "failed", "error": f"exit code {process.exitcode}"}
+        result["stage"] = name
+        results.append(result)
+    return results
+
+
+def thread_configs(affinity=False):
+    cpus = multiprocessing.cpu_count()
+    configs = []
+    for workers in sorted({cpus, max(cpus // 2, 1)}, reverse=True):
+        # 0 leaves OpenCV, OpenMP and BLAS at their defaults
+        configs.append((workers, 0, False))
+        configs.append((workers, None, affinity))
+    return configs
+
+
+def describe_config(config):
+    workers, threads, affinity = config
+    if threads == 0:
+        text = "library threads"
+    else:
+        text = "{} threads".format(threads or max(os.cpu_count() // workers, 1))
+    return "{} workers, {}{}".format(workers, text, ", pinned" if affinity else "")
+
+
+def thread_sweep(recording_path, work_path, affinity=False, repeats=3):
+    """Run the benchmark for every thread_configs(), repeats times, each run on
+    a fresh copy of the recording. The order of the configurations is rotated
+    from round to round, so that none of them always runs first or right
+    after the same other one. Returns [(config, [results of every round])]."""
+    configs = thread_configs(affinity)
+    rounds = {config: [] for config in configs}
+    for round_id in range(repeats):
+        shift = round_id % len(configs)
+        for config in configs[shift:] + configs[:shift]:
+            print(f"[!] Round {round_id + 1}/{repeats}: {describe_config(config)}")
+            copy_path = work_path / "sweep"
+            copy_path.mkdir(parents=True)
+            for path in recording_path.iterdir():
+                if path.is_file() and path.name != BENCHMARK_FILENAME:
+                    shutil.copy(path, copy_path / path.name)
+            rounds[config].append(run_benchmark(copy_path, config))
+            shutil.rmtree(copy_path)
+    return [(config, rounds[config]) for config in configs]
+
+
+def sweep_seconds(config_rounds, i):
+    """Median and spread (max - min) of the seconds of stage i over the
+    rounds, None when it did not succeed in all of them."""
+    results = [results[i] for results in config_rounds]
+    if any(result["status"] != "ok" for result in results):
+        return None
+    seconds = [result["seconds"] for result in results]
+    return statistics.median(seconds), max(seconds) - min(seconds)
+
+
+def short_config(config):
+    workers, threads, affinity = config
+    if threads == 0:
+        text = "lib"
+    else:
+        text = "{}t".format(threads or max(os.cpu_count() // workers, 1))
+    return "{}w/{}{}".format(workers, text, "/pin" if affinity else "")
+
+
+def print_sweep(sweep):
+    print("")
+    for config, _ in sweep:
+        print("    {}: {}".format(short_config(config), describe_config(config)))
+    print(
+        "{:<32}".format("median seconds (spread)")
+        + "".join("{:>16}".format(short_config(config)) for config, _ in sweep)
+    )
+    for i, result in enumerate(sweep[0][1][0]):
+        row = "{:<32}".format(result["stage"])
+        for _, config_rounds in sweep:
+            seconds = sweep_seconds(config_rounds, i)
+            if seconds is not None:
+                row += "{:>16}".format("{:.2f} ({:.2f})".format(*seconds))
+            else:
+                statuses = [results[i]["status"] for results in config_rounds]
+                row += "{:>16}".format(next(s for s in statuses if s != "ok"))
+        print(row)
+
+
+def format_megabytes(n_bytes):
+    return "{:.1f}MB".format(n_bytes / (1024 * 1024))
+
+
+def print_results(results):
+    print("")
+    print(
+        "{:<32} {:>8} {:>9} {:>10} {:>10} {:>10}".format(
+            "stage", "frames", "seconds", "frames/s", "RSS self", "RSS worker"
+        )
+    )
+    for result in results:
+        if result["status"] == "ok":
+            print(
+                "{:<32} {:>8} {:>9.2f} {:>10.1f} {:>10} {:>10}".format(
+                    result["stage"],
+                    result["frames"],
+                    result["seconds"],
+                    result["fps"],
+                    format_megabytes(result["peak_rss_self"]),
+                    format_megabytes(result["peak_rss_children"]),
+                )
+            )
+        else:
+            print(
+                "{:<32} {}: {}".format(
+                    result["stage"], result["status"], result["error"]
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the converters.")
+    parser.add_argument(
+        "--recording_path",
+        default=None,
+        help="Recording to benchmark, its tars are extracted in place. A "
+        "synthetic recording is written to a temporary folder when not given",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=5.0,
+        help="Length in s of the synthetic recording",
+    )
+    parser.add_argument(
+        "--sensors",
+        nargs="*",
+        default=DEFAULT_SENSORS,
+        choices=list(SENSORS),
+        help="Camera streams of the synthetic recording",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Where to write the results, benchmark.json in the recording "
+        "folder by default",
+    )
+    parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the synthetic recording and its outputs",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes of every stage, all cores by default",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="OpenCV/OpenMP/BLAS threads per worker, cores / workers by default, "
+        "0 for the library defaults",
+    )
+    parser.add_argument(
+        "--affinity",
+        action="store_true",
+        help="Pin every worker to its own cores (Linux only)",
+    )
+    parser.add_argument(
+        "--thread_sweep",
+        action="store_true",
+        help="Compare full and half width pools with and without the thread policy",
+    )
+    parser.add_argument(
+        "--sweep_repeats",
+        type=int,
+        default=3,
+        help="Rounds of the --thread_sweep, in a rotated order of the "
+        "configurations, the median of every stage is reported",
+    )
+
+    args = parser.parse_args()
+    temporary_path = None
+    if args.recording_path:
+        recording_path = Path(args.recording_path)
+        recording = {"path": str(recording_path)}
+    else:
+        temporary_path = Path(tempfile.mkdtemp(prefix="streamrecorder-bench-"))
+        recording_path = temporary_path / "recording"
+        print(f"[!] Writing a {args.duration}s synthetic recording...")
+        frames = write_recording(recording_path, args.duration, args.sensors)
+        recording = {
+            "path": str(recording_path),
+            "synthetic": True,
+            "duration_s": args.duration,
+            "frames": frames,
+        }
+
+    policy = (args.workers, args.threads_per_worker, args.affinity)
+    sweep = None
+    if args.thread_sweep:
+        work_path = Path(tempfile.mkdtemp(prefix="streamrecorder-sweep-"))
+        try:
+            sweep = thread_sweep(
+                recording_path, work_path, args.affinity, args.sweep_repeats
+            )
+        finally:
+            shutil.rmtree(work_path)
+        results = sweep[0][1][0]
+        print_sweep(sweep)
+    else:
+        results = run_benchmark(recording_path, policy)
+        print_results(results)
+
+    output_path = Path(args.output) if args.output else None
+    if output_path is None and (temporary_path is None or args.keep):
+        output_path = recording_path / BENCHMARK_FILENAME
+    if output_path is not None:
+        with open(output_path, "w") as f:
+            json.dump(
+                {
+                    "recording": recording,
+                    "cpu_count": os.cpu_count(),
+                    "policy": policy,
+                    "stages": results,
+                    "thread_sweep": [
+                        {
+                            "workers": config[0],
+                            "threads_per_worker": config[1],
+                            "affinity": config[2],
+                            "seconds": [
+                                sweep_seconds(config_rounds, i)
+                                for i in range(len(config_rounds[0]))
+                            ],
+                            "rounds": config_rounds,
+                        }
+                        for config, config_rounds in sweep or []
+                    ],
+                },
+                f,
+                indent=2,
+            )
+        print(f"[!] Results saved to {output_path}")
+
+    if temporary_path is not None and not args.keep:
+        shutil.rmtree(temporary_path)
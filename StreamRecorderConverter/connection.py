@@ -1,19 +1,41 @@
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from urllib3.exceptions import InsecureRequestWarning
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import partial
 import base64
+import json
+import threading
 import warnings
+import tempfile
+import time
 import os
-import io
 import zipfile
 
 warnings.simplefilter("ignore", InsecureRequestWarning)
 
+# a chunk cut short by a dropped connection is lost, so a resumed transfer
+# repeats up to this many bytes
+CHUNK_SIZE = 64 * 1024
+
 
 def hex64(text: str):
     return base64.b64encode(text.encode("ascii")).decode("ascii")
 
 
+def format_size(n_bytes: float):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n_bytes) < 1024 or unit == "GB":
+            return "{:.1f}{}".format(n_bytes, unit)
+        n_bytes /= 1024
+
+
+def format_rate(n_bytes: float, seconds: float):
+    return "{}/s".format(format_size(n_bytes / seconds if seconds > 0 else 0))
+
+
 class Auth:
     def __init__(self, username, password):
         self.username = username
@@ -21,40 +43,284 @@ class Auth:
         self.authentication = HTTPBasicAuth(username, password)
 
 
-class WriteBytesFile:
-    def __init__(self, content):
-        self.content = content
+class TokenBucket:
+    """Byte rate limiter shared by the threads that take from it."""
 
-    def save(self, filename):
-        with open(filename, "wb") as f:
-            f.write(self.content)
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.available = 0.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
 
+    def take(self, n_bytes: int):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(
+                self.available + (now - self.last) * self.rate, self.rate
+            )
+            self.last = now
+            self.available -= n_bytes
+            wait = -self.available / self.rate if self.available < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TransferLimiter:
+    """Caps the transfers of every browser sharing it.
+
+    At most max_transfers files are downloaded at the same time and their
+    combined rate is kept under bandwidth bytes per second (no cap when 0).
+    """
+
+    def __init__(self, max_transfers: int = 0, bandwidth: float = 0.0):
+        self.semaphore = threading.Semaphore(max_transfers) if max_transfers else None
+        self.bandwidth = bandwidth
+        self.bucket = TokenBucket(bandwidth)
+
+    def slot(self):
+        return self.semaphore if self.semaphore else nullcontext()
+
+    def take(self, n_bytes: int):
+        self.bucket.take(n_bytes)
+
+
+class TransferProgress:
+    """Prints the progress and rate of a transfer, at most every interval seconds."""
+
+    def __init__(self, label: str, interval: float = 0.5):
+        self.label = label
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last = 0.0
+
+    def __call__(self, done: int, total: int = None, final: bool = False):
+        now = time.perf_counter()
+        if not final and now - self.last < self.interval:
+            return
+        self.last = now
+        size = format_size(done)
+        if total:
+            size += " / {} ({:.0f}%)".format(format_size(total), 100 * done / total)
+        print(
+            "\r    => {}: {} ({})".format(
+                self.label, size, format_rate(done, now - self.start)
+            ),
+            end="\n" if final else "",
+            flush=True,
+        )
 
-class WriteBytesFolder:
-    def __init__(self, content):
-        self.content = content
 
-    def save(self, path=None, unzip=True):
+class WriteStreamFile:
+    """Streams a device portal file to disk when saved.
+
+    The content goes to '<filename>.part' first and is renamed once complete.
+    An interrupted transfer resumes from the size of the partial file with an
+    HTTP Range request, and restarts from scratch when the server ignores it.
+    """
+
+    def __init__(self, browser, uri, params, chunk_size=CHUNK_SIZE, retries=3):
+        self.browser = browser
+        self.uri = uri
+        self.params = params
+        self.chunk_size = chunk_size
+        self.retries = retries
+
+    def save(self, filename, progress=None):
+        filename = str(filename)
+        part_filename = filename + ".part"
+
+        # give up after self.retries interruptions in a row without progress
+        attempt = 0
+        while True:
+            before = self._part_size(part_filename)
+            try:
+                if self._download(part_filename, progress):
+                    break
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout,
+            ) as e:
+                attempt = 1 if self._part_size(part_filename) > before else attempt + 1
+                if attempt > self.retries:
+                    raise
+                print(f"[!] => Transfer interrupted ({e}), resuming")
+
+        os.replace(part_filename, filename)
+
+    @staticmethod
+    def _part_size(part_filename):
+        return os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+
+    def _download(self, part_filename, progress):
+        offset = self._part_size(part_filename)
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        with self.browser.get(
+            self.uri, params=self.params, headers=headers, stream=True
+        ) as resp:
+            if resp.status_code == 416:
+                # nothing left to send when the partial file is already complete
+                content_range = resp.headers.get("Content-Range", "")
+                if content_range == f"bytes */{offset}":
+                    return True
+                os.remove(part_filename)
+                return False
+            if not resp:
+                raise ValueError("Could not download file")
+
+            if resp.status_code != 206:
+                if offset:
+                    print("[!] => Server does not support resuming, restarting")
+                offset = 0
+            expected = resp.headers.get("Content-Length")
+            total = offset + int(expected) if expected is not None else None
+
+            done = offset
+            with open(part_filename, "ab" if offset else "wb") as f:
+                for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                    if self.browser.limiter:
+                        self.browser.limiter.take(len(chunk))
+                    f.write(chunk)
+                    done += len(chunk)
+                    if progress:
+                        progress(done, total)
+                f.flush()
+                os.fsync(f.fileno())
+
+        if total is not None and done < total:
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Received {done} of {total} bytes"
+            )
+        return True
+
+
+class WriteStreamFolder:
+    """Streams a zipped device portal folder to disk when saved.
+
+    The archive is spooled to a temporary file (in memory only up to
+    spool_size bytes) and its members are then extracted one at a time, so
+    memory use does not depend on the size of the folder.
+    """
+
+    def __init__(
+        self,
+        browser,
+        uri,
+        params,
+        chunk_size=1024 * 1024,
+        spool_size=16 * 1024 * 1024,
+    ):
+        self.browser = browser
+        self.uri = uri
+        self.params = params
+        self.chunk_size = chunk_size
+        self.spool_size = spool_size
+
+    def _receive(self, f, progress):
+        with self.browser.get(self.uri, params=self.params, stream=True) as resp:
+            if not resp:
+                raise ValueError("Could not download folder")
+            expected = resp.headers.get("Content-Length")
+            total = int(expected) if expected is not None else None
+
+            done = 0
+            for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                if self.browser.limiter:
+                    self.browser.limiter.take(len(chunk))
+                f.write(chunk)
+                done += len(chunk)
+                progress(done, total)
+            progress(done, total, final=True)
+
+    def save(self, path=None, unzip=True, progress=None):
 
         if not unzip and not path:
             raise ValueError("Must provide a path name for the zipped file being saved")
 
-        if unzip:
-            z = zipfile.ZipFile(io.BytesIO(self.content))
-            z.extractall(path)
-        else:
-            with open(path, "wb") as f:
-                f.write(self.content)
+        progress = progress or TransferProgress("Downloading folder")
+        if not unzip:
+            part_path = str(path) + ".part"
+            with open(part_path, "wb") as f:
+                self._receive(f, progress)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(part_path, path)
+            return
+
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_size) as spool:
+            self._receive(spool, progress)
+            spool.seek(0)
+
+            with zipfile.ZipFile(spool) as z:
+                members = z.infolist()
+                total = sum(member.file_size for member in members)
+                extract_progress = TransferProgress("Extracting")
+                done = 0
+                for member in members:
+                    z.extract(member, path)
+                    done += member.file_size
+                    extract_progress(done, total)
+                extract_progress(done, total, final=True)
+
+
+class RequestLog:
+    """Request metrics hook appending every record as a JSON line to path."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, record: dict):
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
 
 
 class DevicePortalBrowser:
-    def __init__(self, ip: str, auth: Auth = None, verbose: bool = False):
+    """Session with the device portal.
+
+    Idempotent requests (GET, PUT, DELETE) are retried with exponential
+    backoff on connection errors, timeouts and 502/503/504 responses. When the
+    portal answers 401/403 the session logs in again, refreshing the CSRF
+    token, and the request is repeated once. Every request is reported to
+    on_request as a dict with method, uri, status, latency_s, bytes and
+    retries, e.g. to a RequestLog.
+    """
+
+    IDEMPOTENT_METHODS = ("GET", "PUT", "DELETE")
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(
+        self,
+        ip: str,
+        auth: Auth = None,
+        verbose: bool = False,
+        https: bool = True,
+        pool_size: int = 8,
+        limiter: TransferLimiter = None,
+        timeout=(5.0, 30.0),
+        retries: int = 3,
+        backoff: float = 0.5,
+        on_request=None,
+    ):
         self.ip = ip
         self.auth = auth
         self.session = None
-        self.base_url = f"https://{ip}"
+        self.base_url = "{}://{}".format("https" if https else "http", ip)
         self.login_status = False
         self.verbose = verbose
+        self.pool_size = pool_size
+        self.limiter = limiter
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.on_request = on_request
+        # bumped by every login, so concurrent 401s log in only once
+        self.generation = 0
+        self.login_lock = threading.Lock()
 
         if self.verbose:
             print(" + Created a device portal interface")
@@ -72,22 +338,29 @@ class DevicePortalBrowser:
             print(" + Connecting to interface")
             print("    - Creating a session...")
 
-        self.session = requests.Session()
+        session = requests.Session()
+
+        # one pooled keep-alive connection per concurrent transfer
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size, pool_maxsize=self.pool_size
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
 
         if self.verbose:
             print("    - Setting up auth and disabling verify")
 
         if self.auth:
-            self.session.auth = self.auth.authentication
+            session.auth = self.auth.authentication
 
-        self.session.verify = False
+        session.verify = False
 
         if self.verbose:
             print("    - Connecting to url: {}".format(self.base_url))
 
-        r = self.session.get(self.base_url)
+        r, _ = self._send(session, "GET", self.base_url, timeout=self.timeout)
 
-        self.csrf_tok = self.session.cookies.get("CSRF-Token")
+        self.csrf_tok = session.cookies.get("CSRF-Token")
 
         if self.verbose:
             print(
@@ -96,8 +369,10 @@ class DevicePortalBrowser:
                 )
             )
 
-        self.session.headers.update({"X-CSRF-Token": self.csrf_tok})
+        session.headers.update({"X-CSRF-Token": self.csrf_tok})
+        self.session = session
         self.login_status = r.status_code == 200
+        self.generation += 1
 
         if self.verbose:
             print(
@@ -111,57 +386,100 @@ class DevicePortalBrowser:
     def is_connected(self):
         return self.login_status
 
-    def get(self, uri: str, *args, **kwargs):
-
-        if not self.login_status:
-            raise ValueError("DevicePortalBrowser not connected")
-
-        r = self.session.get(self.base_url + uri, *args, **kwargs)
-
-        if self.verbose:
-            print(" -> GET", r.url.replace(self.base_url, ""))
-            print("    - Code: {}".format(r.status_code))
-
-        return r
+    def _relogin(self, generation):
+        with self.login_lock:
+            if generation == self.generation:
+                if self.verbose:
+                    print(" + Session expired, logging in again")
+                self.connect()
+
+    def _report(self, method, uri, status, n_bytes, start, retries):
+        if self.on_request:
+            self.on_request(
+                {
+                    "time": time.time(),
+                    "host": self.ip,
+                    "method": method,
+                    "uri": uri,
+                    "status": status,
+                    "latency_s": time.perf_counter() - start,
+                    "bytes": n_bytes,
+                    "retries": retries,
+                }
+            )
 
-    def post(self, uri: str, *args, **kwargs):
+    def _send(self, session, method, url, *args, **kwargs):
+        """Issue one request, retrying idempotent ones with exponential backoff.
+        Returns the response and the number of retries it took."""
+        idempotent = method in self.IDEMPOTENT_METHODS
+        retries = 0
+        while True:
+            try:
+                r = session.request(method, url, *args, **kwargs)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                if not idempotent or retries >= self.retries:
+                    e.retries = retries
+                    raise
+            else:
+                if (
+                    r.status_code not in self.RETRY_STATUS
+                    or not idempotent
+                    or retries >= self.retries
+                ):
+                    return r, retries
+                r.close()
+
+            time.sleep(self.backoff * 2**retries)
+            retries += 1
+
+    def request(self, method: str, uri: str, *args, **kwargs):
 
         if not self.login_status:
             raise ValueError("DevicePortalBrowser not connected")
 
-        r = self.session.post(self.base_url + uri, *args, **kwargs)
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.base_url + uri
+        start = time.perf_counter()
+        generation = self.generation
+        try:
+            r, retries = self._send(self.session, method, url, *args, **kwargs)
+            if r.status_code in (401, 403):
+                # the session or its CSRF token expired, log in and try once more
+                r.close()
+                self._relogin(generation)
+                r, more = self._send(self.session, method, url, *args, **kwargs)
+                retries += more + 1
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            self._report(method, uri, None, 0, start, getattr(e, "retries", 0))
+            raise
 
         if self.verbose:
-            print(" -> POST", r.url.replace(self.base_url, ""))
+            print(" -> {}".format(method), r.url.replace(self.base_url, ""))
             print("    - Code: {}".format(r.status_code))
 
+        if self.on_request:
+            # streamed bodies are not read yet, count what the portal announced
+            if kwargs.get("stream"):
+                n_bytes = int(r.headers.get("Content-Length", 0))
+            else:
+                n_bytes = len(r.content)
+            self._report(method, uri, r.status_code, n_bytes, start, retries)
         return r
 
-    def put(self, uri: str, *args, **kwargs):
-
-        if not self.login_status:
-            raise ValueError("DevicePortalBrowser not connected")
-
-        r = self.session.put(self.base_url + uri, *args, **kwargs)
+    def get(self, uri: str, *args, **kwargs):
+        return self.request("GET", uri, *args, **kwargs)
 
-        if self.verbose:
-            print(" -> PUT", r.url.replace(self.base_url, ""))
-            print("    - Code: {}".format(r.status_code))
+    def post(self, uri: str, *args, **kwargs):
+        return self.request("POST", uri, *args, **kwargs)
 
-        return r
+    def put(self, uri: str, *args, **kwargs):
+        return self.request("PUT", uri, *args, **kwargs)
 
     def delete(self, uri: str, *args, **kwargs):
-
-        if not self.login_status:
-            raise ValueError("DevicePortalBrowser not connected")
-
-        r = self.session.delete(self.base_url + uri, *args, **kwargs)
-
-        if self.verbose:
-            print(" -> DELETE", r.url.replace(self.base_url, ""))
-            print("    - Code: {}".format(r.status_code))
-
-        return r
+        return self.request("DELETE", uri, *args, **kwargs)
 
 
 class HololensInterface(DevicePortalBrowser):
@@ -237,11 +555,76 @@ class HololensInterface(DevicePortalBrowser):
             p = p if p.startswith("\\") else "\\" + p
             params["path"] = p
 
-        resp = self.get("/api/filesystem/apps/file", params=params)
-        if resp:
-            return WriteBytesFile(resp.content)
-        else:
-            raise ValueError("Could not download file")
+        return WriteStreamFile(self, "/api/filesystem/apps/file", params)
+
+    def download_files(
+        self,
+        known_folder: str,
+        filenames: list,
+        destination_folder,
+        package_full_name: str = None,
+        path: str = None,
+        max_workers: int = 4,
+        on_complete=None,
+        progress=None,
+    ):
+        """Download several files concurrently into destination_folder.
+
+        Files are started in the given order and on_complete(filename) is called
+        from the transfer thread as soon as each of them is saved. progress is
+        called as progress(filename, done, total) for every received chunk, an
+        exception raised from it aborts the downloads (partial files are kept
+        for resuming).
+        Returns a list of (filename, bytes, seconds) for the downloaded files.
+        """
+
+        def download(filename):
+            destination_path = os.path.join(destination_folder, filename)
+            file_progress = partial(progress, filename) if progress else None
+            with self.limiter.slot() if self.limiter else nullcontext():
+                start = time.perf_counter()
+                self.download_file(
+                    known_folder, filename, package_full_name, path
+                ).save(destination_path, file_progress)
+            n_bytes = os.path.getsize(destination_path)
+            seconds = time.perf_counter() - start
+            if on_complete:
+                on_complete(filename)
+            return filename, n_bytes, seconds
+
+        stats = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(download, filename) for filename in filenames]
+            try:
+                for future in as_completed(futures):
+                    filename, n_bytes, seconds = future.result()
+                    stats.append((filename, n_bytes, seconds))
+                    print(
+                        "    => Downloaded: {} ({} in {:.1f}s, {})".format(
+                            filename,
+                            format_size(n_bytes),
+                            seconds,
+                            format_rate(n_bytes, seconds),
+                        )
+                    )
+            except BaseException:
+                # do not start the files still waiting for a worker
+                executor.shutdown(cancel_futures=True)
+                raise
+        elapsed = time.perf_counter() - start
+
+        if len(stats):
+            total_bytes = sum(n_bytes for _, n_bytes, _ in stats)
+            print(
+                "[!] Downloaded {} files, {} in {:.1f}s ({})".format(
+                    len(stats),
+                    format_size(total_bytes),
+                    elapsed,
+                    format_rate(total_bytes, elapsed),
+                )
+            )
+        return stats
 
     def download_folder(
         self,
@@ -258,11 +641,7 @@ class HololensInterface(DevicePortalBrowser):
             p = p if p.startswith("\\") else "\\" + p
             params["path"] = p
 
-        resp = self.get("/api/filesystem/apps/folder", params=params)
-        if resp:
-            return WriteBytesFolder(resp.content)
-        else:
-            raise ValueError("Could not download folder")
+        return WriteStreamFolder(self, "/api/filesystem/apps/folder", params)
 
     def delete_file(
         self,
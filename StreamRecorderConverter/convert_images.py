@@ -10,10 +10,12 @@ import os
 import cv2
 import argparse
 import numpy as np
-import multiprocessing
 from pathlib import Path
 
+from frame_selection import add_selection_arguments, selection_from_arguments
+from stage_metrics import TimedTask, count
 from utils import folders_extensions
+from worker_pool import stage_pool
 
 
 def write_bytes_to_png(bytes_path, width, height):
@@ -33,7 +35,7 @@ def write_bytes_to_png(bytes_path, width, height):
     cv2.imwrite(output_path, new_image)
 
     # Delete '*.bytes' files
-    bytes_path.unlink()
+    os.remove(bytes_path)
 
 
 def get_width_and_height(path):
@@ -44,20 +46,32 @@ def get_width_and_height(path):
     return (int(width), int(height))
 
 
-def convert_images(folder):
-    p = multiprocessing.Pool(multiprocessing.cpu_count())
-    for (img_folder, extension) in folders_extensions:
-        if img_folder == "PV":
-            pv_path = list(folder.glob("*pv.txt"))
-            assert len(list(pv_path)) == 1
-            (width, height) = get_width_and_height(pv_path[0])
-
-            paths = (folder / img_folder).glob("*bytes")
-            print("Processing images")
-            for path in paths:
-                p.apply_async(write_bytes_to_png, (str(path), width, height))
-    p.close()
-    p.join()
+def convert_images(folder, selection=None):
+    write_task = TimedTask(write_bytes_to_png)
+    results = []
+    with stage_pool() as (p, _):
+        for (img_folder, extension) in folders_extensions:
+            if img_folder == "PV":
+                pv_path = list(folder.glob("*pv.txt"))
+                assert len(list(pv_path)) == 1
+                (width, height) = get_width_and_height(pv_path[0])
+
+                paths = list((folder / img_folder).glob("*bytes"))
+                if selection:
+                    selected = set(selection.select_stream(folder, "PV").tolist())
+                    paths = [path for path in paths if int(path.stem) in selected]
+                count(len(paths), sum(path.stat().st_size for path in paths))
+                print("Processing images")
+                for path in paths:
+                    results.append(
+                        p.apply_async(
+                            write_task,
+                            (str(path), width, height),
+                            callback=write_task.done,
+                        )
+                    )
+        for result in results:
+            result.wait()
 
 
 if __name__ == "__main__":
@@ -65,5 +79,6 @@ if __name__ == "__main__":
     parser.add_argument(
         "--recording_path", required=True, help="Path to recording folder"
     )
+    add_selection_arguments(parser)
     args = parser.parse_args()
-    convert_images(Path(args.recording_path))
+    convert_images(Path(args.recording_path), selection_from_arguments(args))
@@ -0,0 +1,93 @@
+"""Spatial decimation of the depth images before they are unprojected.
+
+With a factor of n every depth frame is reduced to 1/n^2 of its pixels,
+either by keeping every n-th pixel of every n-th row ("stride") or by the
+median of the valid depths of every n x n block ("median", less noisy and
+without holes where single pixels are invalid). The lookup table of the
+sensor is reduced the same way once, and the virtual pinhole camera of the
+projection, and with it the TSDF integration, shrinks by the same factor.
+"""
+import warnings
+
+import numpy as np
+
+DECIMATION_MODES = ["stride", "median"]
+
+
+class DepthDecimation:
+    def __init__(self, factor, mode="stride"):
+        if factor < 1:
+            raise ValueError("The decimation factor has to be at least 1")
+        if mode not in DECIMATION_MODES:
+            raise ValueError(f"Unknown decimation mode {mode}")
+        self.factor = factor
+        self.mode = mode
+
+    def __repr__(self):
+        return f"DepthDecimation({self.factor}, {self.mode!r})"
+
+    def to_dict(self):
+        return {"factor": self.factor, "mode": self.mode}
+
+    def _blocks(self, array):
+        # (rows, columns, factor * factor, ...) blocks, the remainder is cut
+        n = self.factor
+        rows, columns = array.shape[0] // n, array.shape[1] // n
+        blocks = array[: rows * n, : columns * n].reshape(
+            (rows, n, columns, n) + array.shape[2:]
+        )
+        return blocks.swapaxes(1, 2).reshape((rows, columns, n * n) + array.shape[2:])
+
+    def image(self, img):
+        """Decimated depth image, 0 stays invalid."""
+        if self.factor == 1:
+            return img
+        if self.mode == "stride":
+            return img[:: self.factor, :: self.factor]
+        blocks = self._blocks(img).astype(np.float32)
+        blocks[blocks == 0] = np.nan
+        with warnings.catch_warnings():
+            # blocks without any valid depth
+            warnings.simplefilter("ignore", RuntimeWarning)
+            median = np.nanmedian(blocks, axis=2)
+        return np.rint(np.nan_to_num(median)).astype(img.dtype)
+
+    def lut(self, lut, width, height):
+        """Lookup table of the decimated images of a width x height sensor."""
+        if self.factor == 1:
+            return lut
+        rays = lut.reshape((height, width, 3))
+        if self.mode == "stride":
+            rays = rays[:: self.factor, :: self.factor]
+        else:
+            # the ray through the middle of every block
+            rays = self._blocks(rays).mean(axis=2)
+        return np.ascontiguousarray(rays.reshape((-1, 3)), dtype=lut.dtype)
+
+    @property
+    def pinhole_scale(self):
+        return 1.0 / self.factor
+
+
+def add_decimation_arguments(parser):
+    parser.add_argument(
+        "--decimation",
+        type=int,
+        default=1,
+        help="Reduce the depth images by this factor per axis before turning "
+        "them into point clouds",
+    )
+    parser.add_argument(
+        "--decimation_mode",
+        default="stride",
+        choices=DECIMATION_MODES,
+        help="Keep every n-th pixel, or the median depth of every n x n block",
+    )
+
+
+def decimation_from_arguments(args):
+    """The DepthDecimation of the add_decimation_arguments() options, None
+    without decimation."""
+    if args.decimation == 1:
+        return None
+    return DepthDecimation(args.decimation, args.decimation_mode)
@@ -0,0 +1,85 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from connection import HololensInterface
+
+# Item types returned by the device portal file listing
+FILE_TYPE = 32
+FOLDER_TYPE = 16
+
+
+class DeviceRecordings:
+    """Cached listing of the recordings stored in the StreamRecorder LocalState.
+
+    The per-recording listings are requested concurrently and kept for ttl
+    seconds, so consecutive console commands share one scan of the device.
+    Every entry holds the file items of the recording with their total size.
+    """
+
+    def __init__(
+        self,
+        holo: HololensInterface,
+        package_full_name: str,
+        ttl: float = 30.0,
+        max_workers: int = 8,
+    ):
+        self.holo = holo
+        self.package_full_name = package_full_name
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.entries = None
+        self.timestamp = 0.0
+
+    def invalidate(self):
+        with self.lock:
+            self.entries = None
+
+    def get_files(self, name):
+        return self.holo.get_files(
+            "LocalAppData", self.package_full_name, f"LocalState/{name}"
+        )
+
+    def _scan(self):
+        folders = self.holo.get_files(
+            "LocalAppData", self.package_full_name, "LocalState"
+        )
+        folders = [folder for folder in folders if folder["Type"] == FOLDER_TYPE]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            listings = list(
+                executor.map(lambda folder: self.get_files(folder["Id"]), folders)
+            )
+
+        entries = {}
+        for folder, items in zip(folders, listings):
+            if len(items) == 0:
+                continue
+            files = [item for item in items if item["Type"] == FILE_TYPE]
+            entries[folder["Id"]] = {
+                "name": folder["Id"],
+                "date": folder.get("DateCreated"),
+                "files": files,
+                "count": len(files),
+                "size": sum(item.get("FileSize", 0) for item in files),
+            }
+        return entries
+
+    def list(self, refresh: bool = False):
+        """Recording entries sorted by name."""
+        with self.lock:
+            expired = time.monotonic() - self.timestamp > self.ttl
+            if refresh or expired or self.entries is None:
+                self.entries = self._scan()
+                self.timestamp = time.monotonic()
+            return [self.entries[name] for name in sorted(self.entries)]
+
+    def names(self, refresh: bool = False):
+        return [entry["name"] for entry in self.list(refresh)]
+
+    def get(self, name: str):
+        for entry in self.list():
+            if entry["name"] == name:
+                return entry
+        return None
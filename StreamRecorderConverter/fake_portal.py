@@ -0,0 +1,352 @@
+"""Local stand-in for the HoloLens Device Portal.
+
+Serves a folder as the LocalState of an installed StreamRecorder package, so
+the console and the download code can be run and timed without a device:
+
+    python fake_portal.py --root ./fake_device --port 8080 --bandwidth 5
+    python recorder_console.py --address 127.0.0.1:8080 --http
+
+Every sub-folder of root is a recording. --bandwidth throttles each transfer to
+emulate the device Wi-Fi link, --drop_after cuts file transfers short to
+exercise resuming (file downloads honor Range requests unless --no_range).
+--expire_after rotates the CSRF token (answering 403 to the old one) and
+--error_rate answers a share of the requests with 503, to exercise the retries
+and re-login of the client.
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+from connection import TokenBucket
+
+PACKAGE_FULL_NAME = "StreamRecorder_1.0.0.0_arm64__fakeportal"
+PACKAGE_RELATIVE_ID = "StreamRecorder!App"
+CSRF_TOKEN = "fake-csrf-token"
+# seconds between the windows (1601) and unix (1970) epochs
+EPOCH_DIFFERENCE = 11644473600
+CHUNK_SIZE = 64 * 1024
+
+
+def filetime(seconds):
+    return int((seconds + EPOCH_DIFFERENCE) * 1e7)
+
+
+class FakePortalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def authorized(self):
+        if self.server.auth:
+            expected = "Basic " + base64.b64encode(self.server.auth.encode()).decode()
+            if self.headers.get("Authorization") != expected:
+                self.send_error_response(401)
+                return False
+        return self.session_valid()
+
+    def session_valid(self):
+        if self.path == "/" or not self.server.expire_after:
+            return True
+        with self.server.lock:
+            self.server.n_requests += 1
+            if self.server.n_requests % self.server.expire_after == 0:
+                self.server.csrf_token = "fake-csrf-token-{}".format(
+                    self.server.n_requests
+                )
+            token = self.server.csrf_token
+        if self.headers.get("X-CSRF-Token") == token:
+            return True
+        self.send_error_response(403)
+        return False
+
+    def failed(self):
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.send_error_response(503)
+            return True
+        return False
+
+    def send_error_response(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_json(self, content):
+        body = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, f, n_bytes, drop_after=0):
+        bucket = TokenBucket(self.server.bandwidth)
+        if drop_after:
+            n_bytes = min(n_bytes, drop_after)
+            # the client sees the connection go away mid transfer
+            self.close_connection = True
+        while n_bytes > 0:
+            chunk = f.read(min(CHUNK_SIZE, n_bytes))
+            if not chunk:
+                break
+            bucket.take(len(chunk))
+            self.server.link.take(len(chunk))
+            self.wfile.write(chunk)
+            n_bytes -= len(chunk)
+
+    def resolve(self, params, name_key=None):
+        # paths look like \LocalState\<recording>
+        rel = params.get("path", [""])[0].replace("\\", "/").strip("/")
+        parts = [part for part in rel.split("/") if part]
+        if parts and parts[0] == "LocalState":
+            parts = parts[1:]
+        path = self.server.root.joinpath(*parts)
+        if name_key:
+            path = path / params[name_key][0]
+        path = path.resolve()
+        if self.server.root not in path.parents and path != self.server.root:
+            return None
+        return path
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not self.authorized() or self.failed():
+            return
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+
+        if url.path == "/":
+            body = b"<html>fake device portal</html>"
+            self.send_response(200)
+            with self.server.lock:
+                token = self.server.csrf_token
+            self.send_header("Set-Cookie", f"CSRF-Token={token}; Path=/")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif url.path == "/api/app/packagemanager/packages":
+            self.send_json(
+                {
+                    "InstalledPackages": [
+                        {
+                            "Name": "StreamRecorder",
+                            "PackageFullName": PACKAGE_FULL_NAME,
+                            "PackageRelativeId": PACKAGE_RELATIVE_ID,
+                        }
+                    ]
+                }
+            )
+        elif url.path == "/api/filesystem/apps/files":
+            self.list_files(params)
+        elif url.path == "/api/filesystem/apps/file":
+            self.get_file(params)
+        elif url.path == "/api/filesystem/apps/folder":
+            self.get_folder(params)
+        else:
+            self.send_error_response(404)
+
+    def do_DELETE(self):
+        if not self.authorized() or self.failed():
+            return
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path != "/api/filesystem/apps/file" or "filename" not in params:
+            self.send_error_response(404)
+            return
+
+        path = self.resolve(params, "filename")
+        if path is None or not path.exists():
+            self.send_error_response(404)
+            return
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+        self.send_error_response(200)
+
+    def list_files(self, params):
+        folder = self.resolve(params)
+        if folder is None or not folder.is_dir():
+            self.send_error_response(404)
+            return
+
+        items = []
+        for path in sorted(folder.iterdir()):
+            stat = path.stat()
+            items.append(
+                {
+                    "CurrentDir": str(folder.relative_to(self.server.root)),
+                    "DateCreated": filetime(stat.st_mtime),
+                    "FileSize": stat.st_size if path.is_file() else 0,
+                    "Id": path.name,
+                    "Name": path.name,
+                    "SubPath": path.name,
+                    "Type": 32 if path.is_file() else 16,
+                }
+            )
+        self.send_json({"Items": items})
+
+    def get_file(self, params):
+        path = self.resolve(params, "filename")
+        if path is None or not path.is_file():
+            self.send_error_response(404)
+            return
+
+        size = path.stat().st_size
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            self.send_stream(f, size - start, self.server.drop_after)
+
+    def get_folder(self, params):
+        folder = self.resolve(params)
+        if folder is None or not folder.is_dir():
+            self.send_error_response(404)
+            return
+
+        with tempfile.TemporaryFile() as archive:
+            with zipfile.ZipFile(archive, "w") as z:
+                for path in sorted(folder.rglob("*")):
+                    if path.is_file():
+                        z.write(path, path.relative_to(folder))
+            size = archive.tell()
+            archive.seek(0)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            self.send_stream(archive, size)
+
+
+class FakePortalServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        root,
+        auth=None,
+        bandwidth=0.0,
+        link_bandwidth=0.0,
+        latency=0.0,
+        drop_after=0,
+        ranges=True,
+        verbose=False,
+        expire_after=0,
+        error_rate=0.0,
+    ):
+        super().__init__(address, FakePortalHandler)
+        self.root = Path(root).resolve()
+        self.auth = auth
+        self.bandwidth = bandwidth
+        self.link = TokenBucket(link_bandwidth)
+        self.latency = latency
+        self.drop_after = drop_after
+        self.ranges = ranges
+        self.verbose = verbose
+        self.expire_after = expire_after
+        self.error_rate = error_rate
+        self.csrf_token = CSRF_TOKEN
+        self.n_requests = 0
+        self.lock = threading.Lock()
+
+
+def serve_in_thread(root, port=0, **kwargs):
+    """Start a fake portal on localhost in a background thread, returns the
+    server (server.server_address holds the port that was picked)."""
+    server = FakePortalServer(("127.0.0.1", port), root, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake HoloLens device portal.")
+    parser.add_argument(
+        "--root", required=True, help="Folder served as the StreamRecorder LocalState"
+    )
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument(
+        "--auth", default=None, help="Require basic auth as user:password"
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=0.0,
+        help="Per transfer bandwidth limit in MB/s, unlimited when 0",
+    )
+    parser.add_argument(
+        "--link_bandwidth",
+        type=float,
+        default=0.0,
+        help="Total bandwidth limit of all transfers in MB/s, unlimited when 0",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Added latency per request in s"
+    )
+    parser.add_argument(
+        "--drop_after",
+        type=float,
+        default=0.0,
+        help="Drop file transfers after this many MB, never when 0",
+    )
+    parser.add_argument("--no_range", action="store_true", help="Ignore Range requests")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    parser.add_argument(
+        "--expire_after",
+        type=int,
+        default=0,
+        help="Rotate the CSRF token every this many requests, never when 0",
+    )
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        default=0.0,
+        help="Share of requests answered with 503 Service Unavailable",
+    )
+
+    args = parser.parse_args()
+    os.makedirs(args.root, exist_ok=True)
+    server = FakePortalServer(
+        ("127.0.0.1", args.port),
+        args.root,
+        args.auth,
+        args.bandwidth * 1024 * 1024,
+        args.link_bandwidth * 1024 * 1024,
+        args.latency,
+        int(args.drop_after * 1024 * 1024),
+        not args.no_range,
+        args.verbose,
+        args.expire_after,
+        args.error_rate,
+    )
+    print(f"Serving {args.root} on http://127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,200 @@
+"""Pull recordings from several HoloLens devices at once.
+
+The devices are listed in a JSON fleet configuration:
+
+    {
+        "workspace": "downloads",
+        "max_transfers": 8,
+        "bandwidth": 0,
+        "max_downloads": 4,
+        "timeout": 30,
+        "request_log": "requests.jsonl",
+        "devices": [
+            {"name": "hl1", "address": "10.0.0.208", "user": "admin22", "password": "admin22"},
+            {"name": "hl2", "address": "10.0.0.209", "user": "admin22", "password": "admin22"}
+        ]
+    }
+
+Every device gets its own session and is synced into workspace/<name>.
+max_transfers caps the concurrent file transfers of the whole fleet and
+bandwidth (MB/s, unlimited when 0) their combined rate, max_downloads the
+concurrent transfers of a single device. timeout is the read timeout in
+seconds and the optional request_log collects the metrics of every request of
+every device as JSON lines. A device can set "http": true to be
+reached over plain http, e.g. a local fake_portal.py.
+
+    python fleet.py sync --config fleet.json
+"""
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from connection import (
+    Auth,
+    HololensInterface,
+    RequestLog,
+    TransferLimiter,
+    format_size,
+)
+from device_recordings import DeviceRecordings
+from workspace_sync import execute_sync, plan_sync, print_plan
+
+
+def load_fleet(config_path):
+    with open(config_path) as f:
+        config = json.load(f)
+    names = [device["name"] for device in config["devices"]]
+    if len(set(names)) != len(names):
+        raise ValueError("Device names in the fleet configuration must be unique")
+    return config
+
+
+class FleetDevice:
+    """Session, recording listing and workspace folder of one fleet device."""
+
+    def __init__(
+        self,
+        device,
+        w_path,
+        limiter: TransferLimiter,
+        max_downloads=4,
+        timeout=30.0,
+        on_request=None,
+    ):
+        self.name = device["name"]
+        self.w_path = w_path / self.name
+        self.max_downloads = max_downloads
+
+        auth = None
+        if device.get("user") is not None:
+            auth = Auth(device["user"], device.get("password", ""))
+        self.holo = HololensInterface(
+            device["address"],
+            auth=auth,
+            https=not device.get("http", False),
+            pool_size=max_downloads + 2,
+            limiter=limiter,
+            timeout=(5.0, timeout),
+            on_request=on_request,
+        )
+        self.recordings = None
+
+    def connect(self):
+        self.holo.connect()
+        if not self.holo.is_connected():
+            raise ValueError(f"Could not log in to {self.name}")
+        for package in self.holo.get_packages():
+            if package["Name"] == "StreamRecorder":
+                self.recordings = DeviceRecordings(
+                    self.holo, package["PackageFullName"]
+                )
+                break
+        else:
+            raise ValueError(f"StreamRecorder not installed on {self.name}")
+        self.w_path.mkdir(parents=True, exist_ok=True)
+        return self
+
+    def plan(self):
+        return plan_sync(self.recordings, self.w_path)
+
+    def sync(self, plan, delete=False):
+        execute_sync(
+            self.holo,
+            self.recordings,
+            plan,
+            self.w_path,
+            self.max_downloads,
+            delete=delete,
+        )
+
+
+def for_each_device(function, devices):
+    """Run function(device) concurrently, returns {name: result} of the devices
+    that succeeded, failures are reported and left out."""
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(len(devices), 1)) as executor:
+        futures = {executor.submit(function, device): device for device in devices}
+        for future, device in futures.items():
+            try:
+                results[device.name] = future.result()
+            except Exception as e:
+                print(f"[!] Device {device.name} failed: {e}")
+    return results
+
+
+def connect_fleet(config, w_path=None):
+    w_path = Path(w_path or config.get("workspace", "downloads"))
+    limiter = TransferLimiter(
+        config.get("max_transfers", 0), config.get("bandwidth", 0) * 1024 * 1024
+    )
+    request_log = config.get("request_log")
+    on_request = RequestLog(request_log) if request_log else None
+    devices = [
+        FleetDevice(
+            device,
+            w_path,
+            limiter,
+            config.get("max_downloads", 4),
+            config.get("timeout", 30.0),
+            on_request,
+        )
+        for device in config["devices"]
+    ]
+    connected = for_each_device(lambda device: device.connect(), devices)
+    return [device for device in devices if device.name in connected]
+
+
+def list_fleet(devices):
+    listings = for_each_device(lambda device: device.recordings.list(), devices)
+    for device in devices:
+        if device.name not in listings:
+            continue
+        recordings = listings[device.name]
+        print("[!] {}: {} recordings".format(device.name, len(recordings)))
+        for recording in recordings:
+            size = format_size(recording["size"])
+            print(
+                "    {}  {} files, {}".format(
+                    recording["name"], recording["count"], size
+                )
+            )
+
+
+def sync_fleet(devices, dry=False, delete=False):
+    plans = for_each_device(lambda device: device.plan(), devices)
+    for device in devices:
+        if device.name in plans:
+            print(f"[!] {device.name}:")
+            print_plan(plans[device.name])
+    if dry:
+        return
+
+    devices = [device for device in devices if device.name in plans]
+    for_each_device(lambda device: device.sync(plans[device.name], delete), devices)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync a fleet of HoloLens devices.")
+    parser.add_argument("command", choices=["list", "sync"], help="What to do")
+    parser.add_argument(
+        "--config", required=True, help="JSON file listing the fleet devices"
+    )
+    parser.add_argument(
+        "--workspace", default=None, help="Download folder, overrides the config"
+    )
+    parser.add_argument(
+        "--dry", action="store_true", help="Only print the sync plan of every device"
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="Delete the recordings verified in the workspace from the devices",
+    )
+
+    args = parser.parse_args()
+    devices = connect_fleet(load_fleet(args.config), args.workspace)
+    if args.command == "list":
+        list_fleet(devices)
+    else:
+        sync_fleet(devices, args.dry, args.delete)
@@ -0,0 +1,216 @@
+"""Time window and stride of the frames the processing stages work on.
+
+--start and --end take seconds from the start of the recording ("90",
+"1:30", "1:02:03.5"), negative ones count from its end, or absolute times:
+a timestamp in 100ns ticks as written by the recorder or an ISO date-time in
+UTC ("2021-06-01T14:03:00"). --stride keeps every n-th frame of each stream
+in the window and --fps keeps at most that many frames per second.
+
+The stages apply the same selection to the timestamps of every stream, so
+the extraction only reads the selected members of the tars and the PV
+images, point clouds and hand/eye overlays match up.
+"""
+import re
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from recording_files import load_tar_timestamps
+
+HundredsOfNsPerSecond = 10**7
+# recorder timestamps are 100ns ticks since 1601 (Windows file time)
+TICKS_EPOCH = datetime(1601, 1, 1, tzinfo=timezone.utc)
+# numbers this large are timestamps, about three years of ticks
+MIN_ABSOLUTE_TICKS = 10**15
+CLOCK_PATTERN = re.compile(r"^-?(\d+:){1,2}\d+(\.\d*)?$")
+
+
+def parse_time(text):
+    """("relative", seconds) or ("absolute", ticks) of a --start/--end."""
+    text = text.strip()
+    if re.fullmatch(r"\d+", text) and int(text) >= MIN_ABSOLUTE_TICKS:
+        return ("absolute", int(text))
+    if CLOCK_PATTERN.match(text):
+        sign = -1 if text.startswith("-") else 1
+        seconds = 0.0
+        for part in text.lstrip("-").split(":"):
+            seconds = seconds * 60 + float(part)
+        return ("relative", sign * seconds)
+    try:
+        return ("relative", float(text))
+    except ValueError:
+        pass
+    try:
+        date = datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"Unknown time {text}")
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return ("absolute", (date - TICKS_EPOCH) // timedelta(microseconds=1) * 10)
+
+
+def csv_bounds(csv_path):
+    """Timestamps of the first and the last row of the head/hand/eye csv."""
+    with open(csv_path, "rb") as f:
+        first = f.readline()
+        # a row of the 861 column csv is about 10kB
+        f.seek(0, 2)
+        f.seek(max(f.tell() - 1024 * 1024, 0))
+        rows = [row for row in f.read().splitlines() if row.strip()]
+    if not first.strip() or not rows:
+        return []
+    return [int(float(first.split(b",")[0])), int(float(rows[-1].split(b",")[0]))]
+
+
+def recording_bounds(recording_path):
+    """First and last timestamp over all streams of a recording, read from
+    the tar indexes, pv.txt and the ends of the csv."""
+    timestamps = []
+    for tar_path in recording_path.glob("*.tar"):
+        stream = load_tar_timestamps(tar_path)
+        if len(stream):
+            timestamps += [stream[0], stream[-1]]
+    for pv_info_path in recording_path.glob("*pv.txt"):
+        with open(pv_info_path) as f:
+            rows = [row for row in f.readlines()[1:] if row.strip()]
+        if rows:
+            timestamps += [int(rows[0].split(",")[0]), int(rows[-1].split(",")[0])]
+    for csv_path in recording_path.glob("*_eye.csv"):
+        timestamps += csv_bounds(csv_path)
+    if not timestamps:
+        raise ValueError(f"No timestamps in {recording_path}")
+    return int(min(timestamps)), int(max(timestamps))
+
+
+def stream_timestamps(recording_path, stream_name):
+    """All timestamps of a stream, which a selection is always made from:
+    selecting again from the extracted frames would apply the stride twice.
+    PV frames are taken from pv.txt, like the stages that use their poses."""
+    if stream_name == "PV":
+        pv_info_path = next(recording_path.glob("*pv.txt"), None)
+        if pv_info_path is not None:
+            with open(pv_info_path) as f:
+                rows = [row for row in f.readlines()[1:] if row.strip()]
+            return np.array([int(row.split(",")[0]) for row in rows], dtype=np.int64)
+    return load_tar_timestamps(recording_path / f"{stream_name}.tar")
+
+
+class FrameSelection:
+    """Frames of the [start, end] window, every stride-th of them or at most
+    fps per second. Relative times are resolved per recording."""
+
+    def __init__(self, start=None, end=None, stride=1, fps=None):
+        if stride < 1:
+            raise ValueError("The stride has to be at least 1")
+        if fps is not None and fps <= 0:
+            raise ValueError("The fps have to be positive")
+        self.start = parse_time(start) if start is not None else None
+        self.end = parse_time(end) if end is not None else None
+        self.stride = stride
+        self.fps = fps
+        self.texts = {"start": start, "end": end, "stride": stride, "fps": fps}
+        self.windows = {}
+
+    def __bool__(self):
+        # False when every frame is selected
+        return (
+            self.start is not None
+            or self.end is not None
+            or self.stride > 1
+            or self.fps is not None
+        )
+
+    def __repr__(self):
+        return "FrameSelection({})".format(
+            ", ".join(f"{k}={v!r}" for k, v in self.texts.items() if v is not None)
+        )
+
+    def to_dict(self):
+        return dict(self.texts)
+
+    def _resolve(self, time, bounds):
+        kind, value = time
+        if kind == "absolute":
+            return value
+        if value < 0:
+            return bounds[1] + int(value * HundredsOfNsPerSecond)
+        return bounds[0] + int(value * HundredsOfNsPerSecond)
+
+    def window(self, recording_path):
+        """First and last selected timestamp of a recording, None for open
+        ends."""
+        key = str(recording_path)
+        if key not in self.windows:
+            times = [self.start, self.end]
+            bounds = None
+            if any(t is not None and t[0] == "relative" for t in times):
+                bounds = recording_bounds(recording_path)
+            self.windows[key] = tuple(
+                self._resolve(t, bounds) if t is not None else None for t in times
+            )
+        return self.windows[key]
+
+    def mask(self, timestamps, recording_path):
+        """Boolean mask of the selected timestamps of a stream, which can be
+        in any order."""
+        timestamps = np.asarray(timestamps).astype(np.int64)
+        selected = np.ones(len(timestamps), dtype=bool)
+        if not self or not len(timestamps):
+            return selected
+        first, last = self.window(recording_path)
+        if first is not None:
+            selected &= timestamps >= first
+        if last is not None:
+            selected &= timestamps <= last
+
+        order = np.argsort(timestamps, kind="stable")
+        order = order[selected[order]]
+        if self.fps is not None and len(order):
+            # the first frame of every 1/fps interval of the window
+            origin = first if first is not None else timestamps[order[0]]
+            period = HundredsOfNsPerSecond / self.fps
+            buckets = np.floor((timestamps[order] - origin) / period)
+            order = order[np.r_[True, buckets[1:] != buckets[:-1]]]
+        order = order[:: self.stride]
+
+        mask = np.zeros(len(timestamps), dtype=bool)
+        mask[order] = True
+        return mask
+
+    def select(self, timestamps, recording_path):
+        timestamps = np.asarray(timestamps)
+        return timestamps[self.mask(timestamps, recording_path)]
+
+    def select_stream(self, recording_path, stream_name):
+        """Selected timestamps of a stream, see stream_timestamps()."""
+        timestamps = stream_timestamps(recording_path, stream_name)
+        return self.select(timestamps, recording_path)
+
+
+def add_selection_arguments(parser):
+    parser.add_argument(
+        "--start",
+        default=None,
+        help="Start of the frames to process: seconds from the start of the "
+        "recording ('90', '1:30'), from its end when negative, a timestamp or "
+        "an ISO date-time (UTC)",
+    )
+    parser.add_argument(
+        "--end", default=None, help="End of the frames to process, like --start"
+    )
+    parser.add_argument(
+        "--stride", type=int, default=1, help="Process every n-th frame of a stream"
+    )
+    parser.add_argument(
+        "--fps",
+        type=float,
+        default=None,
+        help="Process at most this many frames per second of a stream",
+    )
+
+
+def selection_from_arguments(args):
+    """The FrameSelection of the add_selection_arguments() options, None
+    when every frame is processed."""
+    selection = FrameSelection(args.start, args.end, args.stride, args.fps)
+    return selection if selection else None
@@ -0,0 +1,349 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+# The eye gaze is always stored in the last columns of the head/hand/eye csv:
+# present flag, origin (vector, homog), direction (vector, homog), distance.
+# Eye-only recordings have these columns right after the timestamp.
+GAZE_COLUMNS = 10
+HundredsOfNsToSeconds = 1e-7
+
+EVENT_FIXATION = 1
+EVENT_SACCADE = 2
+EVENT_NAMES = {EVENT_FIXATION: "fixation", EVENT_SACCADE: "saccade"}
+
+
+def load_gaze_data(csv_path):
+    """Load the timestamps and eye gaze columns of a head/hand/eye csv.
+
+    Only the gaze columns are converted, so this works for both the full and
+    the eye-only csv layout and is much faster than load_head_hand_eye_data.
+
+    Returns:
+        timestamps (N,) int64, gaze data (N, 9) as in load_head_hand_eye_data
+        and gaze availability (N,) bool
+    """
+    with open(csv_path) as f:
+        first_line = f.readline()
+    if not first_line.strip():
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 9)), np.zeros(0, dtype=bool)
+
+    n_columns = first_line.count(",") + 1
+    usecols = [0] + list(range(n_columns - GAZE_COLUMNS, n_columns))
+    data = np.loadtxt(
+        csv_path,
+        delimiter=",",
+        usecols=usecols,
+        dtype=[("timestamp", np.int64), ("gaze", np.float64, (GAZE_COLUMNS,))],
+        ndmin=1,
+    )
+    gaze = data["gaze"]
+    return data["timestamp"], gaze[:, 1:], gaze[:, 0] == 1
+
+
+def get_eye_gaze_points(gaze_data):
+    """Vectorized get_eye_gaze_point over an (N, 9) array of gaze samples."""
+    origin_homog = gaze_data[:, :4]
+    direction_homog = gaze_data[:, 4:8]
+    norm = np.linalg.norm(direction_homog, axis=1, keepdims=True)
+    direction_homog = direction_homog / np.where(norm > 0.0, norm, 1.0)
+    # if no distance was recorded, set 1m by default
+    dist = np.where(gaze_data[:, 8] > 0.0, gaze_data[:, 8], 1.0)
+    points = origin_homog + direction_homog * dist[:, np.newaxis]
+
+    return points[:, :3]
+
+
+def get_gaze_directions(gaze_data):
+    directions = gaze_data[:, 4:7]
+    norm = np.linalg.norm(directions, axis=1, keepdims=True)
+    return directions / np.where(norm > 0.0, norm, 1.0)
+
+
+def angular_velocities(timestamps, directions, available):
+    """Angular velocity in deg/s of each sample with respect to the previous one.
+
+    Samples without a valid predecessor take the velocity of the next sample,
+    unavailable samples are NaN.
+    """
+    n_samples = len(timestamps)
+    velocities = np.full(n_samples, np.nan)
+    if n_samples < 2:
+        return velocities
+
+    dt = np.diff(timestamps) * HundredsOfNsToSeconds
+    cross = np.linalg.norm(np.cross(directions[:-1], directions[1:]), axis=1)
+    dot = np.sum(directions[:-1] * directions[1:], axis=1)
+    angles = np.degrees(np.arctan2(cross, dot))
+
+    valid = available[:-1] & available[1:] & (dt > 0)
+    velocities[1:][valid] = angles[valid] / dt[valid]
+
+    # first sample of every valid run
+    backfill = np.flatnonzero(np.isnan(velocities[:-1]) & available[:-1] & valid)
+    velocities[backfill] = velocities[backfill + 1]
+    return velocities
+
+
+def label_ivt(velocities, velocity_threshold=30.0):
+    """Velocity-threshold identification: samples slower than the threshold
+    are fixation samples, the others saccade samples and NaNs are unlabeled."""
+    labels = np.zeros(len(velocities), dtype=np.int8)
+    valid = ~np.isnan(velocities)
+    labels[valid] = np.where(
+        velocities[valid] < velocity_threshold, EVENT_FIXATION, EVENT_SACCADE
+    )
+    return labels
+
+
+def _sparse_table(values, op):
+    # table[k, i] = op(values[i : i + 2**k]), clamped at the end of the array
+    levels = [values]
+    width = 1
+    while 2 * width <= len(values):
+        prev = levels[-1]
+        level = prev.copy()
+        level[: len(values) - width] = op(prev[: len(values) - width], prev[width:])
+        levels.append(level)
+        width *= 2
+    return np.stack(levels)
+
+
+def _range_query(table, op, lo, hi):
+    # op over values[lo : hi + 1]
+    k = np.log2(hi - lo + 1).astype(int)
+    return op(table[k, lo], table[k, hi - (1 << k) + 1])
+
+
+def label_idt(
+    timestamps, directions, available, dispersion_threshold=1.0, min_duration=0.1
+):
+    """Dispersion-threshold identification.
+
+    A fixation is the longest run of at least min_duration seconds whose
+    dispersion (azimuth range + elevation range, in degrees) stays under the
+    threshold. Windows are found for all start samples at once with range
+    min/max queries, so only the greedy walk over fixations is sequential.
+
+    Returns:
+        sample labels and the first sample of every fixation, as consecutive
+        fixations are not necessarily separated by saccade samples
+    """
+    n_samples = len(timestamps)
+    labels = np.zeros(n_samples, dtype=np.int8)
+    if n_samples == 0:
+        return labels, np.zeros(0, dtype=int)
+
+    azimuth = np.zeros(n_samples)
+    elevation = np.zeros(n_samples)
+    # the gaze looks down the negative z axis
+    x, y, z = directions[available].T
+    azimuth[available] = np.degrees(np.unwrap(np.arctan2(x, -z)))
+    elevation[available] = np.degrees(np.arctan2(y, np.hypot(x, z)))
+
+    tables = [
+        (_sparse_table(values, op), op)
+        for values in (azimuth, elevation)
+        for op in (np.maximum, np.minimum)
+    ]
+    missing = np.concatenate(([0], np.cumsum(~available)))
+
+    def dispersion(lo, hi):
+        az_max, az_min, el_max, el_min = [
+            _range_query(table, op, lo, hi) for table, op in tables
+        ]
+        d = (az_max - az_min) + (el_max - el_min)
+        return np.where(missing[hi + 1] - missing[lo] > 0, np.inf, d)
+
+    starts = np.arange(n_samples)
+    min_ticks = min_duration / HundredsOfNsToSeconds
+    ends = np.searchsorted(timestamps, timestamps + min_ticks)
+    candidates = ends < n_samples
+    starts, lo = starts[candidates], ends[candidates]
+    candidates = dispersion(starts, lo) <= dispersion_threshold
+    starts, lo = starts[candidates], lo[candidates]
+
+    # grow every window as long as the dispersion stays under the threshold
+    hi = np.full(len(starts), n_samples - 1)
+    while np.any(lo < hi):
+        mid = (lo + hi + 1) // 2
+        ok = dispersion(starts, mid) <= dispersion_threshold
+        lo = np.where(ok, mid, lo)
+        hi = np.where(ok, hi, mid - 1)
+
+    fixation_end = np.full(n_samples, -1)
+    fixation_end[starts] = lo
+    # next fixation candidate at or after every sample
+    next_start = np.full(n_samples + 1, n_samples)
+    next_start[starts] = starts
+    next_start = np.minimum.accumulate(next_start[::-1])[::-1]
+
+    fixation_starts = []
+    i = next_start[0]
+    while i < n_samples:
+        end = fixation_end[i]
+        labels[i : end + 1] = EVENT_FIXATION
+        fixation_starts.append(i)
+        i = next_start[end + 1]
+
+    labels[available & (labels == 0)] = EVENT_SACCADE
+    return labels, np.array(fixation_starts, dtype=int)
+
+
+def segment_events(
+    labels,
+    timestamps,
+    directions,
+    points,
+    velocities,
+    min_fixation_duration=0.0,
+    event_starts=None,
+):
+    """Group runs of equal labels into events with per-event statistics.
+    event_starts optionally forces additional event boundaries."""
+    if len(labels) == 0:
+        return []
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(labels)) + 1))
+    if event_starts is not None:
+        starts = np.union1d(starts, event_starts)
+    ends = np.concatenate((starts[1:], [len(labels)])) - 1
+    event_labels = labels[starts]
+    n_samples = ends - starts + 1
+
+    mean_points = np.add.reduceat(points, starts, axis=0) / n_samples[:, np.newaxis]
+    velocities = np.nan_to_num(velocities)
+    peak_velocities = np.maximum.reduceat(velocities, starts)
+    mean_velocities = np.add.reduceat(velocities, starts) / n_samples
+    dot = np.sum(directions[starts] * directions[ends], axis=1)
+    amplitudes = np.degrees(np.arccos(np.clip(dot, -1.0, 1.0)))
+    durations = (timestamps[ends] - timestamps[starts]) * HundredsOfNsToSeconds
+
+    keep = event_labels > 0
+    keep &= (event_labels != EVENT_FIXATION) | (durations >= min_fixation_duration)
+
+    events = []
+    for i in np.flatnonzero(keep):
+        events.append(
+            (
+                EVENT_NAMES[event_labels[i]],
+                timestamps[starts[i]],
+                timestamps[ends[i]],
+                durations[i] * 1e3,
+                n_samples[i],
+                *mean_points[i],
+                amplitudes[i],
+                peak_velocities[i],
+                mean_velocities[i],
+            )
+        )
+    return events
+
+
+def save_events(output_path, events):
+    with open(output_path, "w") as f:
+        f.write(
+            "event,start_timestamp,end_timestamp,duration_ms,n_samples,"
+            "x,y,z,amplitude_deg,peak_velocity_deg_s,mean_velocity_deg_s\n"
+        )
+        for event in events:
+            f.write(
+                "{},{},{},{:.1f},{},{:.4f},{:.4f},{:.4f},{:.3f},{:.1f},{:.1f}\n".format(
+                    *event
+                )
+            )
+
+
+def detect_gaze_events(
+    csv_path,
+    method="ivt",
+    velocity_threshold=30.0,
+    dispersion_threshold=1.0,
+    min_fixation_duration=0.1,
+):
+    timestamps, gaze_data, gaze_available = load_gaze_data(csv_path)
+    directions = get_gaze_directions(gaze_data)
+    points = get_eye_gaze_points(gaze_data)
+    velocities = angular_velocities(timestamps, directions, gaze_available)
+
+    event_starts = None
+    if method == "ivt":
+        labels = label_ivt(velocities, velocity_threshold)
+    elif method == "idt":
+        labels, event_starts = label_idt(
+            timestamps,
+            directions,
+            gaze_available,
+            dispersion_threshold,
+            min_fixation_duration,
+        )
+    else:
+        raise ValueError(f"Unknown gaze event detection method: {method}")
+
+    return segment_events(
+        labels,
+        timestamps,
+        directions,
+        points,
+        velocities,
+        min_fixation_duration,
+        event_starts,
+    )
+
+
+def process_gaze_events(folder, method="ivt", **kwargs):
+    print("")
+    head_hat_stream_path = list(folder.glob("*_eye.csv"))[0]
+    print(f"Detecting gaze events ({method})")
+    events = detect_gaze_events(head_hat_stream_path, method, **kwargs)
+
+    output_path = folder / f"gaze_events_{method}.csv"
+    save_events(output_path, events)
+    n_fixations = sum(event[0] == "fixation" for event in events)
+    print(
+        "Saved {} fixations and {} saccades to {}".format(
+            n_fixations, len(events) - n_fixations, output_path
+        )
+    )
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect fixations and saccades.")
+    parser.add_argument(
+        "--recording_path", required=True, help="Path to recording folder"
+    )
+    parser.add_argument(
+        "--method",
+        default="ivt",
+        choices=["ivt", "idt"],
+        help="Velocity (I-VT) or dispersion (I-DT) threshold identification",
+    )
+    parser.add_argument(
+        "--velocity_threshold",
+        type=float,
+        default=30.0,
+        help="I-VT saccade velocity threshold in deg/s",
+    )
+    parser.add_argument(
+        "--dispersion_threshold",
+        type=float,
+        default=1.0,
+        help="I-DT fixation dispersion threshold in degrees",
+    )
+    parser.add_argument(
+        "--min_fixation_duration",
+        type=float,
+        default=0.1,
+        help="Minimum fixation duration in seconds",
+    )
+
+    args = parser.parse_args()
+    process_gaze_events(
+        Path(args.recording_path),
+        args.method,
+        velocity_threshold=args.velocity_threshold,
+        dispersion_threshold=args.dispersion_threshold,
+        min_fixation_duration=args.min_fixation_duration,
+    )
@@ -0,0 +1,261 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+import open3d as o3d
+
+from gaze_analytics import load_gaze_data, get_gaze_directions
+
+# voxel coordinates are packed into 21 bits each
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+
+
+def pack_keys(voxels):
+    voxels = voxels.astype(np.int64) + KEY_OFFSET
+    x, y, z = voxels[..., 0], voxels[..., 1], voxels[..., 2]
+    return (x << (2 * KEY_BITS)) | (y << KEY_BITS) | z
+
+
+class VoxelHash:
+    """Sparse voxel occupancy of a point set, stored as sorted voxel keys with
+    the centroid of the points falling into each voxel.
+
+    Rays are marched against a coarse, dilated copy of the occupancy first, so
+    the fine voxels are only probed around the coarse cells a ray runs through.
+    """
+
+    def __init__(self, voxel_size, keys, centroids, coarse_factor=8):
+        self.voxel_size = voxel_size
+        self.keys = keys
+        self.centroids = centroids
+        self.coarse_size = voxel_size * coarse_factor
+
+        # every coarse cell next to an occupied one, so that a coarse sample
+        # within one cell of an occupied fine voxel always reports a hit
+        coarse = np.unique(np.floor(centroids / self.coarse_size), axis=0)
+        neighbours = np.stack(
+            np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1]), axis=-1
+        ).reshape((-1, 3))
+        dilated = coarse[:, np.newaxis, :] + neighbours[np.newaxis, :, :]
+        self.coarse_keys = np.unique(pack_keys(dilated.reshape((-1, 3))))
+
+    @classmethod
+    def from_points(cls, points, voxel_size):
+        keys = pack_keys(np.floor(points / voxel_size))
+        keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        centroids = np.zeros((len(keys), 3))
+        for axis in range(3):
+            centroids[:, axis] = np.bincount(inverse, weights=points[:, axis])
+        centroids /= counts[:, np.newaxis]
+        return cls(voxel_size, keys, centroids)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def _lookup(all_keys, points, size):
+        keys = pack_keys(np.floor(points / size))
+        if not len(all_keys):
+            # a scene without points
+            return np.full(keys.shape, -1)
+        ids = np.clip(np.searchsorted(all_keys, keys), 0, len(all_keys) - 1)
+        return np.where(all_keys[ids] == keys, ids, -1)
+
+    def lookup(self, points):
+        """Index of the occupied voxel containing each point, -1 if empty."""
+        return self._lookup(self.keys, points, self.voxel_size)
+
+    def cast_rays(self, origins, directions, max_distance=10.0, batch_size=4096):
+        """March every ray in half-voxel steps and return the distance to the
+        first occupied voxel along it (its centroid projected on the ray), or
+        NaN when nothing is hit within max_distance."""
+        step = self.voxel_size / 2.0
+        coarse_steps = np.arange(0, np.ceil(max_distance / self.coarse_size) + 1)
+        coarse_steps *= self.coarse_size
+        # fine steps covering the half cell on both sides of a coarse sample
+        n_fine = int(np.ceil(self.coarse_size / step))
+        fine_offsets = (np.arange(n_fine) - n_fine // 2) * step
+        distances = np.full(len(origins), np.nan)
+
+        for start in range(0, len(origins), batch_size):
+            o = origins[start : start + batch_size]
+            d = directions[start : start + batch_size]
+            samples = (
+                o[:, np.newaxis, :] + d[:, np.newaxis, :] * coarse_steps[:, np.newaxis]
+            )
+            coarse_hit = self._lookup(self.coarse_keys, samples, self.coarse_size) >= 0
+            # (ray, coarse step) pairs, sorted by ray and then distance
+            ray_ids, step_ids = np.nonzero(coarse_hit)
+            if not len(ray_ids):
+                continue
+
+            t = coarse_steps[step_ids, np.newaxis] + fine_offsets
+            in_range = (t > 0) & (t <= max_distance)
+            samples = (
+                o[ray_ids, np.newaxis, :]
+                + d[ray_ids, np.newaxis, :] * t[..., np.newaxis]
+            )
+            ids = self.lookup(samples)
+            hit = (ids >= 0) & in_range
+            pair_hit = np.any(hit, axis=1)
+            first = np.argmax(hit, axis=1)
+
+            # the first pair with a hit is the closest one for every ray
+            pair_ids = np.flatnonzero(pair_hit)
+            hit_rays, unique_ids = np.unique(ray_ids[pair_ids], return_index=True)
+            pair_ids = pair_ids[unique_ids]
+            voxel_ids = ids[pair_ids, first[pair_ids]]
+            offsets = self.centroids[voxel_ids] - o[hit_rays]
+            distances[start + hit_rays] = np.sum(offsets * d[hit_rays], axis=1)
+        return distances
+
+
+def load_fused_point_cloud(folder, voxel_size):
+    """Fuse the world space point clouds saved by save_pclouds into a voxel hash."""
+    keys = []
+    centroids = []
+    for sensor_name in ["Depth Long Throw", "Depth AHaT"]:
+        paths = [
+            path
+            for path in sorted((folder / sensor_name).glob("*.ply"))
+            if not path.stem.endswith("_cam")
+        ]
+        if len(paths):
+            print(f"Fusing {len(paths)} {sensor_name} point clouds")
+        for path in paths:
+            print(".", end="", flush=True)
+            points = np.asarray(o3d.io.read_point_cloud(str(path)).points)
+            if len(points):
+                index = VoxelHash.from_points(points, voxel_size)
+                keys.append(index.keys)
+                centroids.append(index.centroids)
+    print("")
+    if not len(keys):
+        raise FileNotFoundError(f"No world space point clouds found in {folder}")
+
+    # merge the per frame voxels, averaging the centroids of shared voxels
+    keys = np.concatenate(keys)
+    centroids = np.concatenate(centroids)
+    keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    merged = np.zeros((len(keys), 3))
+    for axis in range(3):
+        merged[:, axis] = np.bincount(inverse, weights=centroids[:, axis])
+    merged /= counts[:, np.newaxis]
+    return VoxelHash(voxel_size, keys, merged)
+
+
+def cast_rays_on_mesh(mesh, origins, directions, max_distance=10.0):
+    """Cast the rays against the triangles of a mesh through the Open3D BVH."""
+    scene = o3d.t.geometry.RaycastingScene()
+    scene.add_triangles(o3d.t.geometry.TriangleMesh.from_legacy(mesh))
+    rays = np.hstack((origins, directions)).astype(np.float32)
+    result = scene.cast_rays(o3d.core.Tensor(rays))
+    distances = result["t_hit"].numpy().astype(np.float64)
+    distances[~np.isfinite(distances) | (distances > max_distance)] = np.nan
+    return distances
+
+
+def compute_gaze_hits(
+    folder,
+    geometry="pointcloud",
+    geometry_path=None,
+    voxel_size=0.02,
+    max_distance=10.0,
+    batch_size=4096,
+):
+    print("")
+    head_hat_stream_path = list(folder.glob("*_eye.csv"))[0]
+    timestamps, gaze_data, gaze_available = load_gaze_data(head_hat_stream_path)
+    origins = gaze_data[gaze_available, :3]
+    directions = get_gaze_directions(gaze_data)[gaze_available]
+
+    if geometry == "mesh":
+        mesh_path = geometry_path or folder / "pinhole_projection" / "tsdf-mesh.ply"
+        mesh = o3d.io.read_triangle_mesh(str(mesh_path))
+        print(f"Casting {len(origins)} gaze rays on {mesh_path}")
+        if hasattr(o3d, "t") and hasattr(o3d.t.geometry, "RaycastingScene"):
+            distances = cast_rays_on_mesh(mesh, origins, directions, max_distance)
+        else:
+            # older Open3D versions: fall back to a voxel hash of the surface
+            n_points = int(mesh.get_surface_area() / voxel_size**2) + 1
+            points = np.asarray(mesh.sample_points_uniformly(n_points).points)
+            index = VoxelHash.from_points(points, voxel_size)
+            distances = index.cast_rays(origins, directions, max_distance, batch_size)
+    else:
+        if geometry_path:
+            points = np.asarray(o3d.io.read_point_cloud(str(geometry_path)).points)
+            index = VoxelHash.from_points(points, voxel_size)
+        else:
+            index = load_fused_point_cloud(folder, voxel_size)
+        print(f"Casting {len(origins)} gaze rays on {len(index)} voxels")
+        distances = index.cast_rays(origins, directions, max_distance, batch_size)
+
+    hit_distances = np.full(len(timestamps), np.nan)
+    hit_distances[gaze_available] = distances
+    hit_points = np.full((len(timestamps), 3), np.nan)
+    hit_points[gaze_available] = origins + directions * distances[:, np.newaxis]
+    hits = ~np.isnan(hit_distances)
+
+    output_path = folder / "gaze_hits.npz"
+    np.savez(
+        output_path,
+        timestamps=timestamps,
+        hits=hits,
+        hit_points=hit_points,
+        hit_distances=hit_distances,
+        recorded_distances=gaze_data[:, 8],
+    )
+    print(
+        "Hit {} of {} gaze samples, saved to {}".format(
+            np.count_nonzero(hits), np.count_nonzero(gaze_available), output_path
+        )
+    )
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Intersect eye gaze with the scene.")
+    parser.add_argument(
+        "--recording_path", required=True, help="Path to recording folder"
+    )
+    parser.add_argument(
+        "--geometry",
+        default="pointcloud",
+        choices=["pointcloud", "mesh"],
+        help="Intersect with the fused depth point clouds or the tsdf mesh",
+    )
+    parser.add_argument(
+        "--geometry_path",
+        required=False,
+        default=None,
+        help="Point cloud or mesh to use instead of the recording outputs",
+    )
+    parser.add_argument(
+        "--voxel_size",
+        type=float,
+        default=0.02,
+        help="Voxel size of the point cloud spatial index in meters",
+    )
+    parser.add_argument(
+        "--max_distance",
+        type=float,
+        default=10.0,
+        help="Maximum gaze ray length in meters",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=4096,
+        help="Number of rays marched at once",
+    )
+
+    args = parser.parse_args()
+    compute_gaze_hits(
+        Path(args.recording_path),
+        args.geometry,
+        args.geometry_path,
+        args.voxel_size,
+        args.max_distance,
+        args.batch_size,
+    )
@@ -0,0 +1,218 @@
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+from connection import format_size, format_rate
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """A background download or processing job of the recorder console.
+
+    Runners report their progress through file_progress() (bytes, for
+    transfers) or stage() (processing stages), both raise JobCancelled once
+    the job has been cancelled.
+    """
+
+    def __init__(self, id, kind, name, state=QUEUED, created=None, error=None):
+        self.id = id
+        self.kind = kind
+        self.name = name
+        self.state = state
+        self.created = created or time.time()
+        self.error = error
+        self.started = None
+        self.finished = None
+        self.unit = "stages" if kind == "process" else "B"
+        self.done = 0
+        self.total = None
+        self.files = {}
+        self.cancel_requested = threading.Event()
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "name": self.name,
+            "state": self.state,
+            "created": self.created,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, content):
+        return cls(
+            content["id"],
+            content["kind"],
+            content["name"],
+            content["state"],
+            content["created"],
+            content.get("error"),
+        )
+
+    def check(self):
+        if self.cancel_requested.is_set():
+            raise JobCancelled()
+
+    def file_progress(self, filename, done, total=None):
+        with self.lock:
+            self.files[filename] = done
+            self.done = sum(self.files.values())
+        self.check()
+
+    def stage(self, index, count, name):
+        self.check()
+        self.done = index
+        self.total = count
+
+    def describe_progress(self):
+        if self.started is None:
+            return ""
+        if self.unit != "B":
+            total = self.total if self.total is not None else "?"
+            return "{}/{} stages".format(self.done, total)
+        text = format_size(self.done)
+        if self.total:
+            text += " / {} ({:.0f}%)".format(
+                format_size(self.total), 100 * self.done / self.total
+            )
+        if self.state == RUNNING and self.started:
+            elapsed = time.time() - self.started
+            text += ", " + format_rate(self.done, elapsed)
+            if self.total and self.done:
+                eta = elapsed * (self.total - self.done) / self.done
+                text += ", ETA {:.0f}s".format(eta)
+        return text
+
+
+class JobManager:
+    """Queue of background jobs run by worker threads.
+
+    runners maps a job kind to a function taking the job. The queue is saved
+    to state_path on every change, jobs that were queued or running when the
+    console stopped are queued again when it starts.
+    """
+
+    def __init__(self, state_path, runners, max_workers=1):
+        self.state_path = state_path
+        self.runners = runners
+        self.jobs = []
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+        resumed = self._load()
+        if resumed:
+            print("[!] Resuming {} background jobs".format(resumed))
+
+        self.workers = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(max_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def _load(self):
+        if not os.path.exists(self.state_path):
+            return 0
+        with open(self.state_path) as f:
+            self.jobs = [Job.from_dict(content) for content in json.load(f)]
+        resumed = 0
+        for job in self.jobs:
+            if job.state not in FINISHED_STATES:
+                job.state = QUEUED
+                self.queue.put(job)
+                resumed += 1
+        return resumed
+
+    def _save(self):
+        # called with the lock held
+        tmp_path = str(self.state_path) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([job.to_dict() for job in self.jobs], f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def _set_state(self, job, state, error=None):
+        with self.lock:
+            job.state = state
+            job.error = error
+            if state == RUNNING:
+                job.started = time.time()
+            elif state in FINISHED_STATES:
+                job.finished = time.time()
+                if state == DONE and job.total:
+                    job.done = job.total
+            self._save()
+            self.changed.notify_all()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job.state != QUEUED:
+                continue
+            self._set_state(job, RUNNING)
+            error = None
+            try:
+                self.runners[job.kind](job)
+            except JobCancelled:
+                state = CANCELLED
+            except Exception as e:
+                traceback.print_exc()
+                state, error = FAILED, str(e)
+            else:
+                state = DONE
+            print("\n[!] Job {} ({} {}) {}".format(job.id, job.kind, job.name, state))
+            self._set_state(job, state, error)
+
+    def submit(self, kind, name):
+        with self.lock:
+            job = Job(max((job.id for job in self.jobs), default=0) + 1, kind, name)
+            self.jobs.append(job)
+            self._save()
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        for job in self.jobs:
+            if job.id == job_id:
+                return job
+        return None
+
+    def cancel(self, job):
+        with self.lock:
+            if job.state == QUEUED:
+                job.state = CANCELLED
+                self._save()
+                self.changed.notify_all()
+            elif job.state == RUNNING:
+                job.cancel_requested.set()
+
+    def wait(self, job=None, timeout=None):
+        """Wait for one job, or for all of them when job is None. Returns
+        False when they are still not finished after timeout seconds."""
+        with self.lock:
+            return self.changed.wait_for(
+                lambda: all(
+                    j.state in FINISHED_STATES for j in ([job] if job else self.jobs)
+                ),
+                timeout,
+            )
+
+    def clear(self):
+        """Forget the finished jobs."""
+        with self.lock:
+            self.jobs = [job for job in self.jobs if job.state not in FINISHED_STATES]
+            self._save()
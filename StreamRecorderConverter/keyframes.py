@@ -0,0 +1,102 @@
+"""Keyframes of a depth stream, selected from the poses of the device.
+
+While the wearer stands still, consecutive depth frames add almost no new
+geometry. A frame is kept when the device moved at least min_translation
+meters or turned at least min_rotation degrees since the last kept frame,
+the other frames are dropped from the point clouds, the pinhole projection
+and the TSDF integration.
+"""
+import numpy as np
+
+from stage_metrics import add_counter
+
+DEFAULT_TRANSLATION = 0.05
+DEFAULT_ROTATION = 5.0
+
+
+class KeyframeSelector:
+    """Keeps the frames whose pose moved past the thresholds since the last
+    kept frame, the first frame and frames without a pose are always kept."""
+
+    def __init__(
+        self, min_translation=DEFAULT_TRANSLATION, min_rotation=DEFAULT_ROTATION
+    ):
+        self.min_translation = min_translation
+        self.min_rotation = min_rotation
+
+    def __repr__(self):
+        return "KeyframeSelector({} m, {} degrees)".format(
+            self.min_translation, self.min_rotation
+        )
+
+    def to_dict(self):
+        return {
+            "min_translation": self.min_translation,
+            "min_rotation": self.min_rotation,
+        }
+
+    def mask(self, poses):
+        """Boolean mask of the keyframes of a sequence of 4x4 poses (None
+        where a frame has no pose), in time order."""
+        keep = np.ones(len(poses), dtype=bool)
+        ids = [i for i, pose in enumerate(poses) if pose is not None]
+        if len(ids) < 2:
+            return keep
+        stacked = np.array([poses[i] for i in ids], dtype=float)
+        translations = stacked[:, :3, 3]
+        rotations = stacked[:, :3, :3]
+
+        last = 0
+        for j in range(1, len(ids)):
+            translation = np.linalg.norm(translations[j] - translations[last])
+            # trace of the relative rotation, cos(angle) = (trace - 1) / 2
+            trace = np.sum(rotations[last] * rotations[j])
+            angle = np.degrees(np.arccos(np.clip((trace - 1) / 2, -1.0, 1.0)))
+            if translation >= self.min_translation or angle >= self.min_rotation:
+                last = j
+            else:
+                keep[ids[j]] = False
+        return keep
+
+    def report(self, mask, name):
+        """Print and count the frames a mask drops."""
+        dropped = int(len(mask) - np.count_nonzero(mask))
+        print(
+            "Keyframes of {}: {} of {} frames kept, {} dropped".format(
+                name, len(mask) - dropped, len(mask), dropped
+            )
+        )
+        add_counter("keyframes dropped", dropped)
+        return dropped
+
+
+def add_keyframe_arguments(parser):
+    parser.add_argument(
+        "--keyframe_translation",
+        type=float,
+        default=None,
+        help="Only process depth frames after the device moved this many meters "
+        f"(or turned --keyframe_rotation), {DEFAULT_TRANSLATION} by default "
+        "when --keyframe_rotation is given",
+    )
+    parser.add_argument(
+        "--keyframe_rotation",
+        type=float,
+        default=None,
+        help="Only process depth frames after the device turned this many "
+        f"degrees (or moved --keyframe_translation), {DEFAULT_ROTATION} by "
+        "default when --keyframe_translation is given",
+    )
+
+
+def keyframes_from_arguments(args):
+    """The KeyframeSelector of the add_keyframe_arguments() options, None
+    when every frame is processed."""
+    translation = args.keyframe_translation
+    rotation = args.keyframe_rotation
+    if translation is None and rotation is None:
+        return None
+    return KeyframeSelector(
+        DEFAULT_TRANSLATION if translation is None else translation,
+        DEFAULT_ROTATION if rotation is None else rotation,
+    )
@@ -0,0 +1,163 @@
+import fnmatch
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from connection import HololensInterface
+from device_recordings import DeviceRecordings, FILE_TYPE
+from process_all import build_stages, is_eye_only, process_eye_only
+from stream_health import check_stream_health
+from workspace_sync import COMPLETE, local_file_state
+
+
+class StageScheduler:
+    """Runs the processing stages of a recording as soon as their inputs exist.
+
+    Files are reported with file_done() while they arrive, every stage whose
+    files and required stages are complete is handed to a small pool of stage
+    runners. Stages depending on a failed stage are skipped.
+    """
+
+    def __init__(self, w_path, stages, filenames, max_stages=1):
+        self.w_path = w_path
+        self.pending = list(stages)
+        self.filenames = list(filenames)
+        self.done_files = set()
+        self.done_stages = set()
+        self.failed_stages = set()
+        self.running = 0
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_stages)
+
+    def _files_ready(self, patterns):
+        return all(
+            filename in self.done_files
+            for pattern in patterns
+            for filename in fnmatch.filter(self.filenames, pattern)
+        )
+
+    def _submit_ready(self):
+        # called with the condition held
+        for stage in list(self.pending):
+            name, patterns, required_stages, _ = stage
+            if any(required in self.failed_stages for required in required_stages):
+                print(f"[!] Skipping {name}")
+                self.pending.remove(stage)
+                self.failed_stages.add(name)
+            elif self._files_ready(patterns) and all(
+                required in self.done_stages for required in required_stages
+            ):
+                self.pending.remove(stage)
+                self.running += 1
+                self.executor.submit(self._run, stage)
+        self.condition.notify_all()
+
+    def _run(self, stage):
+        name, _, _, function = stage
+        print(f"[!] Starting {name}")
+        start = time.perf_counter()
+        try:
+            function(self.w_path)
+        except Exception:
+            traceback.print_exc()
+            print(f"[!] {name} failed")
+            failed = True
+        else:
+            print(f"\n[!] Finished {name} in {time.perf_counter() - start:.1f}s")
+            failed = False
+
+        with self.condition:
+            self.running -= 1
+            (self.failed_stages if failed else self.done_stages).add(name)
+            self._submit_ready()
+
+    def file_done(self, filename):
+        with self.condition:
+            self.done_files.add(filename)
+            self._submit_ready()
+
+    def wait(self):
+        """Wait until no stage can run anymore, returns the stages left over."""
+        with self.condition:
+            self._submit_ready()
+            while self.running:
+                self.condition.wait()
+        self.executor.shutdown()
+        return [stage[0] for stage in self.pending]
+
+
+def download_order(file):
+    # small metadata files first, then PV which most stages wait for
+    is_tar = file["Id"].endswith(".tar")
+    return (is_tar, file["Id"] != "PV.tar", file.get("FileSize", 0))
+
+
+def download_and_process(
+    holo: HololensInterface,
+    recordings: DeviceRecordings,
+    name,
+    w_path,
+    max_downloads=4,
+    max_stages=1,
+    project_hand_eye=False,
+    overlay_output="video",
+    overlay_scale=1.0,
+    progress=None,
+):
+    """Download a recording and process every file as soon as it has arrived,
+    so the processing of PV overlaps with the transfer of the depth tars.
+    progress is passed on to HololensInterface.download_files."""
+    recording = recordings.get(name)
+    files = recording["files"] if recording else recordings.get_files(name)
+    files = sorted((f for f in files if f["Type"] == FILE_TYPE), key=download_order)
+    filenames = [file["Id"] for file in files]
+
+    recording_path = w_path / name
+    recording_path.mkdir(exist_ok=True)
+
+    start = time.perf_counter()
+    stages = build_stages(filenames, project_hand_eye, overlay_output, overlay_scale)
+    scheduler = StageScheduler(recording_path, stages, filenames, max_stages)
+
+    to_download = []
+    for file in files:
+        filename = file["Id"]
+        if local_file_state(recording_path / filename, file) == COMPLETE:
+            print("[!] => Skipping, already downloaded:", filename)
+            scheduler.file_done(filename)
+        else:
+            to_download.append(filename)
+
+    print(f"[!] Downloading and processing recording {name}...")
+    try:
+        holo.download_files(
+            "LocalAppData",
+            to_download,
+            recording_path,
+            recordings.package_full_name,
+            f"LocalState/{name}",
+            max_workers=max_downloads,
+            on_complete=scheduler.file_done,
+            progress=progress,
+        )
+    finally:
+        recordings.invalidate()
+        download_time = time.perf_counter() - start
+        # let the stages that already started finish
+        left_over = scheduler.wait()
+
+    if left_over:
+        print("[!] Stages not run:", ", ".join(left_over))
+
+    if is_eye_only(recording_path):
+        process_eye_only(recording_path)
+    elif len(stages):
+        print("")
+        check_stream_health(recording_path)
+
+    print(
+        "[!] Recording {} done in {:.1f}s (downloads took {:.1f}s)".format(
+            name, time.perf_counter() - start, download_time
+        )
+    )
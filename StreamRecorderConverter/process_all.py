@@ -7,37 +7,239 @@
  PURPOSE, MERCHANTABILITY, OR NON-INFRINGEMENT.
 """
 import argparse
+from functools import partial
 from pathlib import Path
-from project_hand_eye_to_pv import project_hand_eye_to_pv
-from utils import check_framerates, extract_tar_file
-from save_pclouds import save_pclouds
-from convert_images import convert_images
 
+import numpy as np
 
-def process_all(w_path, project_hand_eye=False):
-    # Extract all tar
-    for tar_fname in w_path.glob("*.tar"):
+from depth_decimation import add_decimation_arguments, decimation_from_arguments
+from frame_selection import add_selection_arguments, selection_from_arguments
+from gaze_analytics import load_gaze_data
+from keyframes import add_keyframe_arguments, keyframes_from_arguments
+from stage_metrics import PROFILE_MODES, RecordingMetrics, count, timer
+from worker_pool import set_thread_policy
+from stream_health import (
+    CSV_STREAM,
+    REPORT_FILENAME,
+    check_stream_health,
+    health_report,
+    print_report,
+    save_report,
+)
+
+
+def is_eye_only(w_path):
+    # Recordings made with only the eye stream enabled contain nothing but the csv
+    has_eye = any(w_path.glob("*_eye.csv"))
+    has_other = any(w_path.glob("*.tar")) or any(w_path.glob("*pv.txt"))
+    return has_eye and not has_other
+
+
+def process_eye_only(w_path, selection=None):
+    """Convert an eye-only recording without loading the vision libraries."""
+    head_hat_stream_path = next(w_path.glob("*_eye.csv"))
+    print(f"Processing eye-only recording {head_hat_stream_path.name}")
+    with timer("load_gaze_data"):
+        timestamps, gaze_data, gaze_available = load_gaze_data(head_hat_stream_path)
+    if selection:
+        selected = selection.mask(timestamps, w_path)
+        timestamps = timestamps[selected]
+        gaze_data = gaze_data[selected]
+        gaze_available = gaze_available[selected]
+    count(len(timestamps), head_hat_stream_path.stat().st_size)
+
+    np.savez(
+        w_path / "gaze.npz",
+        timestamps=timestamps,
+        gaze_available=gaze_available,
+        origins=gaze_data[:, :3],
+        directions=gaze_data[:, 4:7],
+        distances=gaze_data[:, 8],
+    )
+
+    report = health_report({CSV_STREAM: timestamps})
+    report["streams"][CSV_STREAM]["eye_present"] = (
+        float(np.mean(gaze_available)) if len(gaze_available) else 0.0
+    )
+    if selection:
+        report["selection"] = selection.to_dict()
+    save_report(w_path / REPORT_FILENAME, report)
+    print_report(report)
+
+
+# Stages import the vision libraries themselves, eye-only recordings never load them
+def extract_stage(w_path, tar_name, selection=None):
+    from recording_files import extract_tar_file
+
+    tar_fname = w_path / tar_name
+    timestamps = None
+    if selection:
+        timestamps = selection.select_stream(w_path, tar_fname.stem)
+        print(f"Extracting {len(timestamps)} frames of {tar_fname}")
+    else:
         print(f"Extracting {tar_fname}")
-        tar_output = ""
-        tar_output = w_path / Path(tar_fname.stem)
-        tar_output.mkdir(exist_ok=True)
-        extract_tar_file(tar_fname, tar_output)
+    tar_output = w_path / Path(tar_fname.stem)
+    tar_output.mkdir(exist_ok=True)
+    n_members = extract_tar_file(tar_fname, tar_output, timestamps)
+    count(n_members, tar_fname.stat().st_size)
 
-    # Process PV if recorded
-    if (w_path / "PV.tar").exists():
-        # Convert images
-        convert_images(w_path)
 
-        # Project
+def convert_pv_stage(w_path, selection=None):
+    from convert_images import convert_images
+
+    convert_images(w_path, selection)
+
+
+def project_hand_eye_stage(
+    w_path, overlay_output="video", overlay_scale=1.0, selection=None
+):
+    from project_hand_eye_to_pv import project_hand_eye_to_pv
+
+    project_hand_eye_to_pv(w_path, overlay_output, overlay_scale, selection=selection)
+
+
+def save_pclouds_stage(
+    w_path, sensor_name, selection=None, keyframes=None, decimation=None
+):
+    from save_pclouds import save_pclouds
+
+    save_pclouds(
+        w_path,
+        sensor_name,
+        selection=selection,
+        keyframes=keyframes,
+        decimation=decimation,
+    )
+
+
+def build_stages(
+    filenames,
+    project_hand_eye=False,
+    overlay_output="video",
+    overlay_scale=1.0,
+    selection=None,
+    keyframes=None,
+    decimation=None,
+):
+    """Processing stages of a recording made of the given files.
+
+    Every stage is a tuple (name, file patterns, stage names, function) and
+    can run once all recording files matching its patterns are present and
+    the stages it names have finished. The function takes the recording
+    path. Stages are listed in an order that satisfies their dependencies.
+    All stages only process the frames of the selection, if given, the
+    point clouds only the keyframes of the keyframes.KeyframeSelector, from
+    depth images reduced by the depth_decimation.DepthDecimation.
+    """
+    stages = []
+    for tar_name in sorted(f for f in filenames if f.endswith(".tar")):
+        stages.append(
+            (
+                f"extract {tar_name}",
+                [tar_name],
+                [],
+                partial(extract_stage, tar_name=tar_name, selection=selection),
+            )
+        )
+
+    # Process PV if recorded
+    has_pv = "PV.tar" in filenames
+    if has_pv:
+        stages.append(
+            (
+                "convert PV",
+                ["*pv.txt"],
+                ["extract PV.tar"],
+                partial(convert_pv_stage, selection=selection),
+            )
+        )
         if project_hand_eye:
-            project_hand_eye_to_pv(w_path)
-    # Process depth if recorded
+            stages.append(
+                (
+                    "project hand/eye",
+                    ["*pv.txt", "*_eye.csv"],
+                    ["convert PV"],
+                    partial(
+                        project_hand_eye_stage,
+                        overlay_output=overlay_output,
+                        overlay_scale=overlay_scale,
+                        selection=selection,
+                    ),
+                )
+            )
+
+    # Process depth if recorded, colored from the converted PV images
     for sensor_name in ["Depth Long Throw", "Depth AHaT"]:
-        if (w_path / "{}.tar".format(sensor_name)).exists():
-            # Save point clouds
-            save_pclouds(w_path, sensor_name)
+        if f"{sensor_name}.tar" in filenames:
+            required_stages = [f"extract {sensor_name}.tar"]
+            if has_pv:
+                required_stages.append("convert PV")
+            stages.append(
+                (
+                    f"point clouds {sensor_name}",
+                    [f"{sensor_name}_*", "*pv.txt"],
+                    required_stages,
+                    partial(
+                        save_pclouds_stage,
+                        sensor_name=sensor_name,
+                        selection=selection,
+                        keyframes=keyframes,
+                        decimation=decimation,
+                    ),
+                )
+            )
+    return stages
+
+
+def process_all(
+    w_path,
+    project_hand_eye=False,
+    overlay_output="video",
+    overlay_scale=1.0,
+    on_stage=None,
+    profile_stage=None,
+    profile_mode="cprofile",
+    selection=None,
+    keyframes=None,
+    decimation=None,
+):
+    """Run all processing stages of a recording. on_stage(index, count, name)
+    is called before every stage, an exception raised from it stops the
+    processing between two stages. With a frame_selection.FrameSelection
+    only the selected frames are processed, with a keyframes.KeyframeSelector
+    only the keyframes of the depth streams are turned into point clouds and
+    a depth_decimation.DepthDecimation reduces their depth images first.
+
+    Timings, frame and byte counts, worker utilization and peak RSS of every
+    stage are written to <recording>/metrics.json, the stages whose name
+    contains profile_stage are profiled (see stage_metrics.RecordingMetrics)."""
+    metrics = RecordingMetrics(w_path, profile_stage, profile_mode)
+    if is_eye_only(w_path):
+        with metrics.stage("eye"):
+            process_eye_only(w_path, selection)
+        metrics.print_summary()
+        return
+
+    filenames = [path.name for path in w_path.iterdir() if path.is_file()]
+    stages = build_stages(
+        filenames,
+        project_hand_eye,
+        overlay_output,
+        overlay_scale,
+        selection,
+        keyframes,
+        decimation,
+    )
+    for i, (name, _, _, function) in enumerate(stages):
+        if on_stage:
+            on_stage(i, len(stages), name)
+        with metrics.stage(name):
+            function(w_path)
+
     print("")
-    check_framerates(w_path)
+    with metrics.stage("stream health"):
+        check_stream_health(w_path, selection)
+    metrics.print_summary()
 
 
 if __name__ == "__main__":
@@ -51,9 +253,65 @@ if __name__ == "__main__":
         action="store_true",
         help="Project hand joints (and eye gaze, if recorded) to rgb images",
     )
+    parser.add_argument(
+        "--overlay_output",
+        default="video",
+        choices=["video", "png"],
+        help="Render the hand/eye overlays to a video or to a png sequence",
+    )
+    parser.add_argument(
+        "--overlay_scale",
+        type=float,
+        default=1.0,
+        help="Downscale factor for the hand/eye overlays, below 1 also cuts "
+        "copying the video frames from the workers",
+    )
+    parser.add_argument(
+        "--profile_stage",
+        default=None,
+        help="Profile the stages whose name contains this, e.g. 'convert PV'",
+    )
+    parser.add_argument(
+        "--profile_mode",
+        default="cprofile",
+        choices=PROFILE_MODES,
+        help="Profile with cProfile or by sampling the stack every 5ms",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes of every stage, all cores by default",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="OpenCV/OpenMP/BLAS threads per worker, cores / workers by default, "
+        "0 for the library defaults",
+    )
+    parser.add_argument(
+        "--affinity",
+        action="store_true",
+        help="Pin every worker to its own cores (Linux only)",
+    )
+    add_selection_arguments(parser)
+    add_keyframe_arguments(parser)
+    add_decimation_arguments(parser)
 
     args = parser.parse_args()
+    set_thread_policy(args.workers, args.threads_per_worker, args.affinity)
 
     w_path = Path(args.recording_path)
 
-    process_all(w_path, args.project_hand_eye)
+    process_all(
+        w_path,
+        args.project_hand_eye,
+        args.overlay_output,
+        args.overlay_scale,
+        profile_stage=args.profile_stage,
+        profile_mode=args.profile_mode,
+        selection=selection_from_arguments(args),
+        keyframes=keyframes_from_arguments(args),
+        decimation=decimation_from_arguments(args),
+    )
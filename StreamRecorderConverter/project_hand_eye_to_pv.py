@@ -12,7 +12,15 @@ import numpy as np
 from pathlib import Path
 import ast
 
-from utils import load_head_hand_eye_data
+from utils import PROJECTION_FILENAME, load_head_hand_eye_data
+from frame_selection import add_selection_arguments, selection_from_arguments
+from gaze_analytics import get_eye_gaze_points
+from hand_defs import HandJointIndex
+from stage_metrics import TimedTask, count, timer
+from worker_pool import stage_pool
+
+JOINT_COUNT = HandJointIndex.Count.value
+VIDEO_FILENAME = "hands_proj.mp4"
 
 
 def process_timestamps(path):
@@ -77,7 +85,9 @@ def get_eye_gaze_point(gaze_data):
     return point[:3]
 
 
-def project_hand_eye_to_pv(folder):
+def project_hand_eye_to_pv(
+    folder, output="video", scale=1.0, workers=None, selection=None
+):
     print("")
     head_hat_stream_path = list(folder.glob("*_eye.csv"))[0]
     pv_info_path = list(folder.glob("*pv.txt"))[0]
@@ -85,16 +95,17 @@ def project_hand_eye_to_pv(folder):
     assert len(pv_paths)
 
     # load head, hand, eye data
-    (
-        timestamps,
-        _,
-        left_hand_transs,
-        left_hand_transs_available,
-        right_hand_transs,
-        right_hand_transs_available,
-        gaze_data,
-        gaze_available,
-    ) = load_head_hand_eye_data(head_hat_stream_path)
+    with timer("load_head_hand_eye_data"):
+        (
+            timestamps,
+            _,
+            left_hand_transs,
+            left_hand_transs_available,
+            right_hand_transs,
+            right_hand_transs_available,
+            gaze_data,
+            gaze_available,
+        ) = load_head_hand_eye_data(head_hat_stream_path)
 
     eye_str = " and eye gaze" if np.any(gaze_available) else ""
     print("Projecting hand joints{} to PV".format(eye_str))
@@ -111,60 +122,236 @@ def project_hand_eye_to_pv(folder):
     ) = load_pv_data(pv_info_path)
 
     principal_point = np.array([ox, oy])
+    if selection:
+        selected = selection.mask(frame_timestamps, folder)
+        frame_timestamps = frame_timestamps[selected]
+        focal_lengths = focal_lengths[selected]
+        pv2world_transforms = pv2world_transforms[selected]
+
+    # project every joint and the gaze point for all pv frames at once
+    with timer("project_points_batch"):
+        hand_ids = match_timestamps(frame_timestamps, timestamps)
+        points = np.concatenate(
+            (
+                left_hand_transs[hand_ids],
+                right_hand_transs[hand_ids],
+                get_eye_gaze_points(gaze_data[hand_ids])[:, np.newaxis, :],
+            ),
+            axis=1,
+        )
+        available = np.zeros(points.shape[:2], dtype=bool)
+        available[:, :JOINT_COUNT] = left_hand_transs_available[hand_ids, np.newaxis]
+        available[:, JOINT_COUNT:-1] = right_hand_transs_available[hand_ids, np.newaxis]
+        available[:, -1] = gaze_available[hand_ids]
+        xy, valid = project_points_batch(
+            points, pv2world_transforms, focal_lengths, principal_point, width
+        )
+        valid &= available
 
-    n_frames = len(pv_paths)
     output_folder = folder / "eye_hands"
     output_folder.mkdir(exist_ok=True)
-    for pv_id in range(n_frames):
-        print(".", end="", flush=True)
-        pv_path = pv_paths[pv_id]
-        sample_timestamp = int(str(pv_path.name).replace(".png", ""))
+    np.savez(
+        output_folder / PROJECTION_FILENAME,
+        timestamps=frame_timestamps,
+        hand_eye_ids=hand_ids,
+        xy=xy.astype(np.float32),
+        valid=valid,
+    )
 
-        hand_ts = match_timestamp(sample_timestamp, timestamps)
-        # print('Frame-hand delta: {:.3f}ms'.format((sample_timestamp - timestamps[hand_ts]) * 1e-4))
-
-        img = cv2.imread(str(pv_path))
-        # pinhole
-        K = np.array(
-            [
-                [focal_lengths[pv_id][0], 0, principal_point[0]],
-                [0, focal_lengths[pv_id][1], principal_point[1]],
-                [0, 0, 1],
-            ]
-        )
-        try:
-            Rt = np.linalg.inv(pv2world_transforms[pv_id])
-        except np.linalg.LinAlgError:
-            print("No pv2world transform")
+    render_hand_eye_overlays(
+        pv_paths,
+        frame_timestamps,
+        xy,
+        valid,
+        output_folder,
+        output=output,
+        scale=scale,
+        workers=workers,
+    )
+
+
+def match_timestamps(targets, all_timestamps):
+    """Vectorized match_timestamp: index of the closest entry of all_timestamps
+    for each of the targets (ties resolve to the earlier timestamp)."""
+    all_timestamps = np.asarray(all_timestamps)
+    targets = np.asarray(targets)
+    if len(all_timestamps) == 1:
+        return np.zeros(len(targets), dtype=int)
+
+    order = np.argsort(all_timestamps, kind="stable")
+    sorted_timestamps = all_timestamps[order]
+    ids = np.clip(np.searchsorted(sorted_timestamps, targets), 1, len(order) - 1)
+    left = sorted_timestamps[ids - 1]
+    right = sorted_timestamps[ids]
+    ids -= (targets - left) <= (right - targets)
+    return order[ids]
+
+
+def project_points_batch(
+    points, pv2world_transforms, focal_lengths, principal_point, width
+):
+    """Project world points onto their pv frames with a pinhole model.
+
+    Args:
+        points ([np.array]): (N_frames, N_points, 3) world space points
+        pv2world_transforms ([np.array]): (N_frames, 4, 4) pv to world transforms
+        focal_lengths ([np.array]): (N_frames, 2) focal lengths
+        principal_point ([np.array]): principal point (ox, oy)
+        width ([int]): pv image width, the image x axis is mirrored
+
+    Returns:
+        (N_frames, N_points, 2) pixel coordinates and a (N_frames, N_points)
+        mask, false where the frame has no pose or the point is behind the camera
+    """
+    n_frames, n_points, _ = points.shape
+    xy = np.zeros((n_frames, n_points, 2))
+    valid = np.zeros((n_frames, n_points), dtype=bool)
+
+    # frames without a pose are recorded with a singular transform
+    has_pose = np.abs(np.linalg.det(pv2world_transforms)) > 1e-12
+    if not np.any(has_pose):
+        print("No pv2world transform")
+        return xy, valid
+
+    Rt = np.linalg.inv(pv2world_transforms[has_pose])
+    points_pv = np.einsum("nij,nkj->nki", Rt[:, :3, :3], points[has_pose])
+    points_pv += Rt[:, np.newaxis, :3, 3]
+
+    # the pv camera looks down its negative z axis
+    z = points_pv[..., 2]
+    in_front = z < 0.0
+    z = np.where(in_front, z, -1.0)
+    focal_lengths = focal_lengths[has_pose, np.newaxis, :]
+    xy_pv = focal_lengths * points_pv[..., :2] / z[..., np.newaxis] + principal_point
+    xy_pv[..., 0] = width - xy_pv[..., 0]
+
+    xy[has_pose] = xy_pv
+    valid[has_pose] = in_front
+    return xy, valid
+
+
+def overlay_pixel(point_xy, width, scale):
+    # the unmirrored x is cut to an integer before mirroring it, as the
+    # overlays have always been drawn
+    x = width - int(width - point_xy[0])
+    return int(x * scale), int(point_xy[1] * scale)
+
+
+def render_overlay(pv_path, points_xy, colors, output_path, scale):
+    img = cv2.imread(str(pv_path))
+    if img is None:
+        print(f"\n[!] Cannot read {pv_path}, skipping it")
+        return None
+    width = img.shape[1]
+    if scale != 1.0:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    for point_xy, color in zip(points_xy, colors):
+        ixy = overlay_pixel(point_xy, width, scale)
+        img = cv2.circle(img, ixy, radius=3, color=color)
+
+    if output_path is None:
+        return img
+    cv2.imwrite(output_path, img)
+
+
+def render_overlay_task(args):
+    print(".", end="", flush=True)
+    return render_overlay(*args)
+
+
+def render_hand_eye_overlays(
+    pv_paths,
+    frame_timestamps,
+    xy,
+    valid,
+    output_folder,
+    output="video",
+    scale=1.0,
+    workers=None,
+):
+    """Draw the projected hand joints and gaze point on the pv frames.
+
+    Frames are sharded across a pool of workers. With output="video" the frames
+    are encoded in order to eye_hands/hands_proj.mp4, with output="png" every
+    worker writes its own eye_hands/handsprojNNNN.png images. PV frames that
+    cannot be read are skipped.
+
+    For the video every rendered frame is sent back to the parent process,
+    about 6MB per 1920x1080 frame, which can limit the speedup of the pool;
+    a scale below 1 shrinks that by scale^2.
+
+    Args:
+        pv_paths ([list]): Sorted pv png paths
+        frame_timestamps ([np.array]): Timestamps of the rows of xy and valid
+        xy ([np.array]): (N_frames, 53, 2) projected pixel coordinates
+        valid ([np.array]): (N_frames, 53) validity mask
+        output_folder ([Path]): Output folder
+        output ([str]): "video" or "png"
+        scale ([float]): Downscale factor applied to the rendered frames
+        workers ([int]): Number of worker processes, all cores by default
+    """
+    frame_ids = {timestamp: i for i, timestamp in enumerate(frame_timestamps)}
+    # left hand, right hand, gaze
+    colors = np.array(
+        [(0, 0, 255)] * JOINT_COUNT + [(0, 255, 0)] * JOINT_COUNT + [(255, 0, 0)]
+    )
+
+    tasks = []
+    for pv_id, pv_path in enumerate(pv_paths):
+        sample_timestamp = int(str(pv_path.name).replace(".png", ""))
+        frame_id = frame_ids.get(sample_timestamp)
+        if frame_id is None:
             continue
-        rvec, _ = cv2.Rodrigues(Rt[:3, :3])
-        tvec = Rt[:3, 3]
-
-        colors = [(0, 0, 255), (0, 255, 0), (255, 0, 0)]
-        hands = [
-            (left_hand_transs, left_hand_transs_available),
-            (right_hand_transs, right_hand_transs_available),
-        ]
-        for hand_id, hand in enumerate(hands):
-            transs, avail = hand
-            if avail[hand_ts]:
-                for joint in transs[hand_ts]:
-                    hand_tr = joint.reshape((1, 3))
-                    xy, _ = cv2.projectPoints(hand_tr, rvec, tvec, K, None)
-                    ixy = (int(xy[0][0][0]), int(xy[0][0][1]))
-                    ixy = (width - ixy[0], ixy[1])
-                    img = cv2.circle(img, ixy, radius=3, color=colors[hand_id])
-
-        if gaze_available[hand_ts]:
-            point = get_eye_gaze_point(gaze_data[hand_ts])
-            xy, _ = cv2.projectPoints(point.reshape((1, 3)), rvec, tvec, K, None)
-            ixy = (int(xy[0][0][0]), int(xy[0][0][1]))
-            ixy = (width - ixy[0], ixy[1])
-            img = cv2.circle(img, ixy, radius=3, color=colors[2])
-
-        cv2.imwrite(
-            str(output_folder / "hands") + "proj{}.png".format(str(pv_id).zfill(4)), img
+
+        point_ids = valid[frame_id]
+        output_path = None
+        if output == "png":
+            output_path = str(output_folder / "hands") + "proj{}.png".format(
+                str(pv_id).zfill(4)
+            )
+        tasks.append(
+            (
+                pv_path,
+                xy[frame_id, point_ids],
+                [tuple(map(int, c)) for c in colors[point_ids]],
+                output_path,
+                scale,
+            )
         )
+    if not len(tasks):
+        return
+    count(len(tasks), sum(task[0].stat().st_size for task in tasks))
+
+    timed_render = TimedTask(render_overlay_task)
+    with stage_pool(workers) as (p, workers):
+        chunksize = max(1, min(16, len(tasks) // (4 * workers)))
+        if output == "png":
+            for result in p.imap_unordered(timed_render, tasks, chunksize):
+                timed_render.done(result)
+            return
+
+        # frames come back in order so they can be appended to the video
+        timestamps = [int(task[0].stem) for task in tasks]
+        fps = 1e7 / np.median(np.diff(timestamps)) if len(tasks) > 1 else 30.0
+        video = None
+        for result in p.imap(timed_render, tasks, chunksize):
+            img = timed_render.done(result)
+            if img is None:
+                continue
+            if video is None:
+                height, width, _ = img.shape
+                video = cv2.VideoWriter(
+                    str(output_folder / VIDEO_FILENAME),
+                    cv2.VideoWriter_fourcc(*"mp4v"),
+                    fps,
+                    (width, height),
+                )
+            with timer("encode video"):
+                video.write(img)
+        if video is None:
+            print("\n[!] No PV frame could be read, no overlay video written")
+            return
+        video.release()
 
 
 if __name__ == "__main__":
@@ -173,6 +360,32 @@ if __name__ == "__main__":
     parser.add_argument(
         "--recording_path", required=True, help="Path to recording folder"
     )
+    parser.add_argument(
+        "--output",
+        default="video",
+        choices=["video", "png"],
+        help="Render the overlays to a video or to a png sequence",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Downscale factor for the rendered overlays (e.g. 0.5 for quick "
+        "reviews), the video frames are copied from the workers at this size",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of rendering processes, all cores by default",
+    )
+    add_selection_arguments(parser)
 
     args = parser.parse_args()
-    project_hand_eye_to_pv(Path(args.recording_path))
+    project_hand_eye_to_pv(
+        Path(args.recording_path),
+        args.output,
+        args.scale,
+        args.workers,
+        selection_from_arguments(args),
+    )
@@ -1,8 +1,24 @@
+import argparse
 import cmd
 from pathlib import Path
 from process_all import process_all
-
-from connection import HololensInterface, Auth
+from pipeline import download_and_process
+from batch_process import ORDERS, batch_process, memory_budget
+from worker_pool import set_thread_policy
+
+from connection import HololensInterface, Auth, RequestLog, format_size
+from device_recordings import DeviceRecordings, FILE_TYPE
+from jobs import JobManager, RUNNING
+from workspace_summary import WorkspaceSummaries, matches, parse_filters
+from workspace_sync import (
+    COMPLETE,
+    INCOMPLETE,
+    NEW,
+    execute_sync,
+    local_file_state,
+    plan_sync,
+    print_plan,
+)
 
 
 class RecorderShell(cmd.Cmd):
@@ -15,10 +31,11 @@ class RecorderShell(cmd.Cmd):
 
     ruler = "-"
 
-    def __init__(self, w_path, holo: HololensInterface):
+    def __init__(self, w_path, holo: HololensInterface, max_downloads=4, max_jobs=1):
         super().__init__()
         self.holo = holo
         self.w_path = w_path
+        self.max_downloads = max_downloads
 
         packages = holo.get_packages()
         self.package_full_name = None
@@ -33,6 +50,18 @@ class RecorderShell(cmd.Cmd):
         else:
             raise ValueError("StreamRecorder not installed on device")
 
+        self.recordings = DeviceRecordings(holo, self.package_full_name)
+        self.jobs = JobManager(
+            w_path / "jobs.json",
+            {
+                "download": self.run_download_job,
+                "fetch": self.run_fetch_job,
+                "process": self.run_process_job,
+                "sync": self.run_sync_job,
+            },
+            max_jobs,
+        )
+
         self.do_list(None)
 
     def do_help(self, arg):
@@ -51,57 +80,69 @@ class RecorderShell(cmd.Cmd):
         list_workspace_recordings(self.w_path)
 
     def get_device_list(self):
-        recordings = self.holo.get_files(
-            "LocalAppData", self.package_full_name, "LocalState"
-        )
-
-        recording_names = []
-        for r in recordings:
-            files = self.holo.get_files(
-                "LocalAppData", self.package_full_name, f"LocalState/{r['Id']}"
-            )
-            if len(files) > 0:
-                recording_names.append(r["Id"])
-
-        recording_names.sort()
-        return recording_names
+        return self.recordings.names()
 
     def do_list_device(self, arg):
 
-        recording_names = self.get_device_list()
+        recordings = self.recordings.list(refresh=arg == "refresh")
 
-        for i, recording_name in enumerate(recording_names):
-            print("[{: 6d}]  {}".format(i, recording_name))
-        if len(recording_names) == 0:
+        for i, recording in enumerate(recordings):
+            print(
+                "[{: 6d}]  {}  ({} files, {})".format(
+                    i,
+                    recording["name"],
+                    recording["count"],
+                    format_size(recording["size"]),
+                )
+            )
+        if len(recordings) == 0:
             print("=> No recordings found on Hololens")
 
     def do_list_workspace(self, arg):
-        list_workspace_recordings(self.w_path)
+        try:
+            filters = parse_filters(arg)
+        except ValueError as e:
+            print(f"[!] Unknown filter {e}")
+            return
+        list_workspace_recordings(self.w_path, filters)
+
+    def get_recording_files(self, name):
+        recording = self.recordings.get(name)
+        return recording["files"] if recording else self.recordings.get_files(name)
 
-    def download_recording(self, name):
+    def download_recording(self, name, files=None, progress=None):
 
         recording_path = self.w_path / name
         recording_path.mkdir(exist_ok=True)
 
         print("[!] Downloading recording {}...".format(name))
 
-        files = self.holo.get_files(
-            "LocalAppData", self.package_full_name, f"LocalState/{name}"
-        )
+        if files is None:
+            files = self.get_recording_files(name)
 
+        filenames = []
         for file in files:
-            if file["Type"] != 32:
+            if file["Type"] != FILE_TYPE:
                 continue
 
             destination_path = recording_path / file["Id"]
-            if destination_path.exists():
+            if local_file_state(destination_path, file) == COMPLETE:
                 print("[!] => Skipping, already downloaded:", file["Id"])
                 continue
 
             print("    => Downloading:", file["Id"])
-            self.holo.download_file(
-                "LocalAppData", file["Id"], self.package_full_name, f"LocalState/{name}"
-            ).save(destination_path)
+            filenames.append(file["Id"])
+
+        self.holo.download_files(
+            "LocalAppData",
+            filenames,
+            recording_path,
+            self.package_full_name,
+            f"LocalState/{name}",
+            max_workers=self.max_downloads,
+            progress=progress,
+        )
+        self.recordings.invalidate()
 
     def delete_recording(self, name):
 
@@ -109,6 +150,7 @@ class RecorderShell(cmd.Cmd):
         self.holo.delete_file(
             "LocalAppData", name, self.package_full_name, "LocalState"
         )
+        self.recordings.invalidate()
 
     def do_download(self, arg):
         try:
@@ -118,10 +160,41 @@ class RecorderShell(cmd.Cmd):
         except ValueError:
             print(f"[!] I can't download {arg}")
 
+    def do_fetch(self, arg):
+        try:
+            recording_idx = int(arg)
+            if recording_idx is not None:
+                download_and_process(
+                    self.holo,
+                    self.recordings,
+                    self.get_device_list()[recording_idx],
+                    self.w_path,
+                    self.max_downloads,
+                    project_hand_eye=True,
+                )
+        except ValueError:
+            print(f"[!] I can't fetch {arg}")
+
     def do_download_all(self, arg):
-        recordings = self.get_device_list()
+        # one listing for all downloads, invalidating it does not rescan
+        recordings = self.recordings.list()
         for record in recordings:
-            self.download_recording(record)
+            self.download_recording(record["name"], record["files"])
+
+    def do_sync(self, arg):
+        options = arg.split()
+        plan = plan_sync(self.recordings, self.w_path)
+        print_plan(plan)
+        if "dry" in options:
+            return
+        execute_sync(
+            self.holo,
+            self.recordings,
+            plan,
+            self.w_path,
+            self.max_downloads,
+            delete="delete" in options,
+        )
 
     def do_delete_all(self, arg):
         recordings = self.get_device_list()
@@ -141,8 +214,7 @@ class RecorderShell(cmd.Cmd):
             recording_idx = int(arg)
             if recording_idx is not None:
                 try:
-                    recording_names = sorted(self.w_path.glob("*"))
-                    recording_name = recording_names[recording_idx]
+                    recording_name = get_workspace_list(self.w_path)[recording_idx]
                 except IndexError:
                     print("[!] => Recording does not exist")
                 else:
@@ -150,6 +222,141 @@ class RecorderShell(cmd.Cmd):
         except ValueError:
             print(f"[!] I can't extract {arg}")
 
+    def do_batch(self, arg):
+        order = "smallest"
+        names = []
+        try:
+            for word in arg.split():
+                if word in ORDERS:
+                    order = word
+                else:
+                    names.append(get_workspace_list(self.w_path)[int(word)].name)
+        except (IndexError, ValueError):
+            print(f"[!] I can't batch process {arg}")
+            return
+        batch_process(
+            self.w_path,
+            names or None,
+            order,
+            max_memory=memory_budget(),
+            project_hand_eye=True,
+        )
+
+    def start_transfer_job(self, job, files):
+        # count what is already in the workspace as done
+        files = [file for file in files if file["Type"] == FILE_TYPE]
+        job.total = sum(file.get("FileSize", 0) for file in files)
+        for file in files:
+            if local_file_state(self.w_path / job.name / file["Id"], file) == COMPLETE:
+                job.file_progress(file["Id"], file.get("FileSize", 0))
+        return files
+
+    def run_download_job(self, job):
+        files = self.start_transfer_job(job, self.get_recording_files(job.name))
+        self.download_recording(job.name, files, job.file_progress)
+
+    def run_fetch_job(self, job):
+        self.start_transfer_job(job, self.get_recording_files(job.name))
+        download_and_process(
+            self.holo,
+            self.recordings,
+            job.name,
+            self.w_path,
+            self.max_downloads,
+            project_hand_eye=True,
+            progress=job.file_progress,
+        )
+
+    def run_process_job(self, job):
+        process_all(self.w_path / job.name, True, on_stage=job.stage)
+
+    def run_sync_job(self, job):
+        plan = plan_sync(self.recordings, self.w_path)
+        print_plan(plan)
+        job.total = sum(
+            file.get("FileSize", 0)
+            for entry in plan
+            for file in entry[NEW] + entry[INCOMPLETE]
+        )
+        execute_sync(
+            self.holo,
+            self.recordings,
+            plan,
+            self.w_path,
+            self.max_downloads,
+            delete=job.name == "delete",
+            progress=job.file_progress,
+        )
+
+    def do_bg(self, arg):
+        args = arg.split()
+        if len(args) == 0 or args[0] not in self.jobs.runners:
+            print(f"[!] I can't run {arg} in the background")
+            return
+        kind = args[0]
+        if kind == "sync":
+            name = "delete" if "delete" in args[1:] else "all"
+        else:
+            try:
+                recording_idx = int(args[1])
+                if kind == "process":
+                    name = get_workspace_list(self.w_path)[recording_idx].name
+                else:
+                    name = self.get_device_list()[recording_idx]
+            except (IndexError, ValueError):
+                print(f"[!] I can't run {arg} in the background")
+                return
+        job = self.jobs.submit(kind, name)
+        print(f"[!] Queued job {job.id}: {kind} {name}")
+
+    def do_jobs(self, arg):
+        if arg == "clear":
+            self.jobs.clear()
+        for job in self.jobs.jobs:
+            print(
+                "[{: 6d}]  {:8s} {:10s} {}  {}".format(
+                    job.id,
+                    job.kind,
+                    job.state,
+                    job.name,
+                    job.error if job.error else job.describe_progress(),
+                )
+            )
+        if len(self.jobs.jobs) == 0:
+            print("    => No background jobs")
+
+    def get_job(self, arg):
+        try:
+            job = self.jobs.get(int(arg))
+        except ValueError:
+            job = None
+        if job is None:
+            print(f"[!] There is no job {arg}")
+        return job
+
+    def do_wait(self, arg):
+        job = self.get_job(arg) if arg else None
+        if arg and job is None:
+            return
+        try:
+            while not self.jobs.wait(job, timeout=1.0):
+                running = [j for j in self.jobs.jobs if j.state == RUNNING]
+                print(
+                    "\r    => "
+                    + "; ".join(f"{j.id}: {j.describe_progress()}" for j in running),
+                    end="",
+                    flush=True,
+                )
+        except KeyboardInterrupt:
+            print("")
+            return
+        print("")
+
+    def do_cancel(self, arg):
+        job = self.get_job(arg)
+        if job is not None:
+            self.jobs.cancel(job)
+
 
 def print_help():
     print("Available commands:")
@@ -157,20 +364,76 @@ def print_help():
     print("  reconnect:                Reconnect to the device portal")
     print("  exit:                     Exit the console loop")
     print("  list:                     List all recordings")
-    print("  list_device:              List all recordings on the HoloLens")
-    print("  list_workspace:           List all recordings in the workspace")
+    print("  list_device [refresh]:    List all recordings on the HoloLens")
+    print("  list_workspace [filters]: List the recordings in the workspace, filters:")
+    print("                            (un)processed, partial, raw, has <stream>")
     print("  download X:               Download recording X from the HoloLens")
     print("  download_all:             Download all recordings from the HoloLens")
+    print("  sync [dry] [delete]:      Download new and incomplete files")
     print("  delete X:                 Delete recording X from the HoloLens")
     print("  delete_all:               Delete all recordings from the HoloLens")
     print("  process X:                Process recording X ")
-
-
-def list_workspace_recordings(w_path):
-    recording_names = sorted(w_path.glob("*"))
-    for i, recording_name in enumerate(recording_names):
-        print("[{: 6d}]  {}".format(i, recording_name.name))
-    if len(recording_names) == 0:
+    print("  fetch X:                  Download and process recording X together")
+    print("  batch [X...] [order]:     Process recordings X... or all unprocessed ones")
+    print("                            on one worker pool, order: smallest (default),")
+    print("                            largest, newest or oldest first")
+    print("  bg download|fetch|process X, bg sync [delete]:")
+    print("                            Run the command as a background job")
+    print("  jobs [clear]:             List background jobs (clear the finished ones)")
+    print("  wait [X]:                 Wait for job X or all jobs with their progress")
+    print("  cancel X:                 Cancel job X")
+
+
+def get_workspace_list(w_path):
+    # hidden folders, like the job queue of work_queue.py, are no recordings
+    return sorted(
+        path
+        for path in w_path.glob("*")
+        if path.is_dir() and not path.name.startswith(".")
+    )
+
+
+STREAM_ABBREVIATIONS = {
+    "Depth AHaT": "AHaT",
+    "Depth Long Throw": "LT",
+    "VLC LF": "LF",
+    "VLC RF": "RF",
+    "VLC LL": "LL",
+    "VLC RR": "RR",
+    "Head/hand/eye": "eye",
+}
+
+
+def list_workspace_recordings(w_path, filters=()):
+    recording_names = get_workspace_list(w_path)
+    summaries = WorkspaceSummaries(w_path).summaries(recording_names)
+    width = max((len(path.name) for path in recording_names), default=0)
+    n_listed = 0
+    for i, (recording_name, summary) in enumerate(zip(recording_names, summaries)):
+        if summary is None:
+            if not filters:
+                print("[{: 6d}]  {}".format(i, recording_name.name))
+            continue
+        if not matches(summary, filters):
+            continue
+        streams = " ".join(
+            "{}:{}".format(STREAM_ABBREVIATIONS.get(name, name), stream["frames"])
+            for name, stream in summary["streams"].items()
+        )
+        print(
+            "[{: 6d}]  {}  {:7.1f}s {:>9s}  {:9s} {}/{}  {}".format(
+                i,
+                recording_name.name.ljust(width),
+                summary["duration_s"],
+                format_size(summary["size"]),
+                summary["state"],
+                summary["stages_done"],
+                summary["stages"],
+                streams,
+            )
+        )
+        n_listed += 1
+    if n_listed == 0:
         print("    => No recordings found in workspace")
 
 
@@ -184,14 +447,61 @@ def main():
         "downloads"
     )  # set to desired download folder path
 
+    parser = argparse.ArgumentParser(description="Recorder console.")
+    parser.add_argument("--address", default=address, help="Device portal address")
+    parser.add_argument("--user", default=None, help="Device portal user")
+    parser.add_argument("--password", default=None, help="Device portal password")
+    parser.add_argument("--workspace", default=w_path, help="Download folder")
+    parser.add_argument(
+        "--http",
+        action="store_true",
+        help="Connect over plain http (e.g. to a local fake_portal.py)",
+    )
+    parser.add_argument(
+        "--max_downloads",
+        type=int,
+        default=4,
+        help="Number of files downloaded concurrently",
+    )
+    parser.add_argument(
+        "--max_jobs",
+        type=int,
+        default=1,
+        help="Number of background jobs run concurrently",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30.0,
+        help="Seconds to wait for the device portal before retrying a request",
+    )
+    parser.add_argument(
+        "--request_log",
+        default=None,
+        help="Append the metrics of every request as JSON lines to this file",
+    )
+    args = parser.parse_args()
+    # before any stage loads the vision libraries
+    set_thread_policy()
+    if args.user is not None:
+        login = Auth(args.user, args.password or "")
+    w_path = Path(args.workspace)
+
     w_path.mkdir(exist_ok=True)
-    holo = HololensInterface(address, auth=login).connect()
+    holo = HololensInterface(
+        args.address,
+        auth=login,
+        https=not args.http,
+        pool_size=max(args.max_downloads, 1) + 2,
+        timeout=(5.0, args.timeout),
+        on_request=RequestLog(args.request_log) if args.request_log else None,
+    ).connect()
 
     print()
     print_help()
     print()
 
-    rs = RecorderShell(w_path, holo)
+    rs = RecorderShell(w_path, holo, args.max_downloads, args.max_jobs)
     rs.cmdloop()
 
 
@@ -0,0 +1,61 @@
+"""Files of a recording and the frames in its tars.
+
+Kept free of the vision libraries, so that the workspace listing, the stream
+health report and eye-only recordings can use them without loading OpenCV.
+"""
+import tarfile
+from pathlib import Path
+
+import numpy as np
+
+# Projected pixel coordinates of the hand joints and gaze point for every pv frame,
+# stored as xy (N_frames, 53, 2) and valid (N_frames, 53) in eye_hands/. Points are
+# ordered as 26 left hand joints, 26 right hand joints and the gaze point.
+PROJECTION_FILENAME = "hand_eye_projection.npz"
+
+folders_extensions = [
+    ("PV", "bytes"),
+    ("Depth AHaT", "[0-9].pgm"),
+    ("Depth Long Throw", "[0-9].pgm"),
+    ("VLC LF", "[0-9].pgm"),
+    ("VLC RF", "[0-9].pgm"),
+    ("VLC LL", "[0-9].pgm"),
+    ("VLC RR", "[0-9].pgm"),
+]
+
+
+def member_timestamp(name):
+    """Frame timestamp of a tar member ('<timestamp>.pgm', '<timestamp>_ab.pgm',
+    '<timestamp>.bytes'), None for other members."""
+    stem = Path(name).stem.split("_")[0]
+    return int(stem) if stem.isdigit() else None
+
+
+def extract_tar_file(tar_filename, output_path, timestamps=None):
+    """Extract a tar, returns the number of members extracted. With
+    timestamps, frames with other timestamps are skipped without reading
+    their data."""
+    tar = tarfile.open(tar_filename)
+    members = tar.getmembers()
+    if timestamps is not None:
+        timestamps = set(int(t) for t in timestamps)
+        members = [
+            member
+            for member in members
+            if member_timestamp(member.name) in timestamps
+            or member_timestamp(member.name) is None
+        ]
+    tar.extractall(output_path, members)
+    tar.close()
+    return len(members)
+
+
+def load_tar_timestamps(tar_filename, sort=True):
+    """Frame timestamps of a recording tar, read from the member headers
+    without extracting anything (the '<timestamp>_ab.pgm' images are skipped).
+    With sort=False they are returned in recording order."""
+    with tarfile.open(tar_filename, "r:") as tar:
+        stems = [Path(name).stem for name in tar.getnames()]
+    timestamps = [int(stem) for stem in stems if stem.isdigit()]
+    timestamps = np.array(timestamps, dtype=np.int64)
+    return np.sort(timestamps) if sort else timestamps
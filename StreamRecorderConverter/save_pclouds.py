@@ -7,14 +7,20 @@
  PURPOSE, MERCHANTABILITY, OR NON-INFRINGEMENT.
 """
 import argparse
+import json
 import multiprocessing
+from functools import partial
 from pathlib import Path
 
 import numpy as np
 import cv2
 import open3d as o3d
 
+from depth_decimation import add_decimation_arguments, decimation_from_arguments
+from frame_selection import add_selection_arguments, selection_from_arguments
+from keyframes import add_keyframe_arguments, keyframes_from_arguments
 from project_hand_eye_to_pv import load_pv_data, match_timestamp
+from stage_metrics import TimedTask, count
 from utils import (
     extract_tar_file,
     load_lut,
@@ -22,6 +28,7 @@ from utils import (
     project_on_depth,
     project_on_pv,
 )
+from worker_pool import stage_pool
 
 
 def save_output_txt_files(folder, shared_dict):
@@ -45,7 +52,8 @@ def save_output_txt_files(folder, shared_dict):
             with open(str(traj_path), "w") as tf:
                 with open(str(odo_path), "w") as of:
                     i = 0
-                    for timestamp in shared_dict:
+                    # frames are saved out of order by the pool
+                    for timestamp in sorted(shared_dict.keys()):
                         df.write(f"{timestamp} {shared_dict[timestamp][0]}\n")
                         rf.write(f"{timestamp} {shared_dict[timestamp][1]}\n")
                         camera_string = " ".join(map(str, shared_dict[timestamp][2]))
@@ -59,6 +67,39 @@ def save_output_txt_files(folder, shared_dict):
                         i = i + 1
 
 
+def shard_path(folder, sensor_name, frame_range):
+    start, stop = frame_range
+    return folder / "{} {:07d}-{:07d}.json".format(sensor_name, start, stop)
+
+
+def save_pinhole_shard(output_path, shared_dict):
+    """Save the shared_dict entries of a frame range for merge_pinhole_shards()"""
+    content = {
+        stem: [str(depth), str(rgb), np.asarray(center).tolist(), pose.tolist()]
+        for stem, (depth, rgb, center, pose) in shared_dict.items()
+    }
+    with open(output_path, "w") as f:
+        json.dump(content, f)
+
+
+def merge_pinhole_shards(folder, sensor_name):
+    """Write the txt files of the pinhole projection from the frame range
+    shards of a sensor, returns the number of shards merged."""
+    pinhole_folder = folder / "pinhole_projection"
+    shard_paths = sorted(pinhole_folder.glob(f"{sensor_name} *-*.json"))
+    if not shard_paths:
+        return 0
+    merged = {}
+    for path in shard_paths:
+        with open(path) as f:
+            for stem, (depth_tmp, rgb_tmp, center, pose) in json.load(f).items():
+                merged[stem] = [depth_tmp, rgb_tmp, center, np.array(pose)]
+    save_output_txt_files(pinhole_folder, merged)
+    for path in shard_paths:
+        path.unlink()
+    return len(shard_paths)
+
+
 def save_single_pcloud(
     shared_dict,
     path,
@@ -78,6 +119,7 @@ def save_single_pcloud(
     clamp_max,
     depth_path_suffix,
     disable_project_pinhole,
+    decimation=None,
 ):
     suffix = "_cam" if save_in_cam_space else ""
     output_path = str(path)[:-4] + f"{suffix}.ply"
@@ -92,8 +134,6 @@ def save_single_pcloud(
     timestamp = extract_timestamp(path.name.replace(depth_path_suffix, ""))
     # load depth img
     img = cv2.imread(str(path), -1)
-    height, width = img.shape
-    assert len(lut) == width * height
 
     # Clamp values if requested
     if clamp_min > 0 and clamp_max > 0:
@@ -104,6 +144,12 @@ def save_single_pcloud(
         img[img < clamp_min] = 0
         img[img > clamp_max] = 0
 
+    # the lut was decimated the same way by save_pclouds
+    if decimation is not None:
+        img = decimation.image(img)
+    height, width = img.shape
+    assert len(lut) == width * height
+
     # Get xyz points in camera space
     points = get_points_in_cam_space(img, lut)
     if save_in_cam_space:
@@ -139,10 +185,11 @@ def save_single_pcloud(
                 # Project depth on virtual pinhole camera and save corresponding
                 # rgb image inside <workspace>/pinhole_projection folder
                 if not disable_project_pinhole:
-                    # Create virtual pinhole camera
-                    scale = 1
-                    width = 320 * scale
-                    height = 288 * scale
+                    # Create virtual pinhole camera, as coarse as the
+                    # decimated depth so that its images have no holes
+                    scale = 1 if decimation is None else decimation.pinhole_scale
+                    width = int(320 * scale)
+                    height = int(288 * scale)
                     focal_length = 200 * scale
                     intrinsic_matrix = np.array(
                         [
@@ -155,14 +202,15 @@ def save_single_pcloud(
                         points, rgb, intrinsic_matrix, width, height
                     )
 
-                    # Save depth image
-                    depth_proj_folder = pinhole_folder / "depth" / f"{pv_ts}.png"
+                    # Save depth image, named after the depth frame since
+                    # several depth frames can match the same pv frame
+                    depth_proj_folder = pinhole_folder / "depth" / f"{path.stem}.png"
                     depth_proj_path = str(depth_proj_folder)[:-4] + f"{suffix}_proj.png"
                     depth = (depth * DEPTH_SCALING_FACTOR).astype(np.uint16)
                     cv2.imwrite(depth_proj_path, (depth).astype(np.uint16))
 
                     # Save rgb image
-                    rgb_proj_folder = pinhole_folder / "rgb" / f"{pv_ts}.png"
+                    rgb_proj_folder = pinhole_folder / "rgb" / f"{path.stem}.png"
                     rgb_proj_path = str(rgb_proj_folder)[:-4] + f"{suffix}_proj.png"
                     cv2.imwrite(rgb_proj_path, rgb_proj)
 
@@ -273,7 +321,19 @@ def save_pclouds(
     clamp_max=0.0,
     depth_path_suffix="",
     disable_project_pinhole=False,
+    frame_range=None,
+    selection=None,
+    keyframes=None,
+    decimation=None,
 ):
+    """Save the point clouds of a depth sensor, of the frames of the
+    frame_selection.FrameSelection if given. With a keyframes.KeyframeSelector
+    the frames are also thinned out by the rig2world poses, for the point
+    clouds and the pinhole projection. A depth_decimation.DepthDecimation
+    reduces every depth image (and the lut) before the unprojection, the
+    pinhole camera is scaled down to match. With frame_range=(start, stop)
+    only those of the frames (in timestamp order) are saved and the pinhole
+    projection lists are left in a shard file, see merge_pinhole_shards()."""
     print("")
     print("Saving point clouds")
 
@@ -288,7 +348,11 @@ def save_pclouds(
     has_pv = False
     try:
         if __name__ == "__main__":
-            extract_tar_file(str(folder / "PV.tar"), folder / "PV")
+            pv_tar_path = folder / "PV.tar"
+            timestamps = None
+            if selection:
+                timestamps = selection.select_stream(folder, "PV")
+            extract_tar_file(str(pv_tar_path), folder / "PV", timestamps)
     except FileNotFoundError:
         pass
 
@@ -305,6 +369,12 @@ def save_pclouds(
             _,
         ) = load_pv_data(list(pv_info_path)[0])
         principal_point = np.array([ox, oy])
+        if selection:
+            # only the selected pv frames are converted
+            selected = selection.mask(pv_timestamps, folder)
+            pv_timestamps = pv_timestamps[selected]
+            focal_lengths = focal_lengths[selected]
+            pv2world_transforms = pv2world_transforms[selected]
     else:
         pv_timestamps = (
             focal_lengths
@@ -339,45 +409,84 @@ def save_pclouds(
 
     # Extract tar only when calling the script directly
     if __name__ == "__main__":
-        extract_tar_file(str(folder / "{}.tar".format(sensor_name)), str(depth_path))
+        tar_path = folder / "{}.tar".format(sensor_name)
+        timestamps = None
+        if selection:
+            timestamps = selection.select_stream(folder, sensor_name)
+        extract_tar_file(str(tar_path), str(depth_path), timestamps)
 
     # Depth path suffix used for now only if we load masked AHAT
     depth_paths = sorted(depth_path.glob("*[0-9]{}.pgm".format(depth_path_suffix)))
     assert len(list(depth_paths)) > 0
+    if decimation is not None:
+        # decimate the lut once, the images are decimated per frame
+        height, width = cv2.imread(str(depth_paths[0]), -1).shape
+        lut = decimation.lut(lut, width, height)
+        print(f"Decimating {sensor_name} to {len(lut)} of {width * height} points")
+    timestamps = [
+        extract_timestamp(path.name.replace(depth_path_suffix, ""))
+        for path in depth_paths
+    ]
+    if selection:
+        # the folder can hold only the frames extracted for the selection
+        selected = set(selection.select_stream(folder, sensor_name).tolist())
+        depth_paths = [p for p, t in zip(depth_paths, timestamps) if t in selected]
+        timestamps = [t for t in timestamps if t in selected]
+    keep = None
+    if keyframes is not None:
+        # over all frames, so that the shards of a sensor agree on them
+        poses = rig2world_transforms
+        if poses is None and (folder / rig2world).exists():
+            poses = load_rig2world_transforms(folder / rig2world)
+        keep = keyframes.mask([(poses or {}).get(t) for t in timestamps])
+    if frame_range is not None:
+        depth_paths = depth_paths[frame_range[0] : frame_range[1]]
+        if keep is not None:
+            keep = keep[frame_range[0] : frame_range[1]]
+    if keep is not None:
+        keyframes.report(keep, sensor_name)
+        depth_paths = [path for path, kept in zip(depth_paths, keep) if kept]
+    count(len(depth_paths), sum(path.stat().st_size for path in depth_paths))
 
     # Create shared dictionary to save odometry and file list
     manager = multiprocessing.Manager()
     shared_dict = manager.dict()
 
-    multiprocess_pool = multiprocessing.Pool(multiprocessing.cpu_count())
-    for path in depth_paths:
-        multiprocess_pool.apply_async(
-            save_single_pcloud(
-                shared_dict,
-                path,
-                folder,
-                pinhole_folder,
-                save_in_cam_space,
-                lut,
-                has_pv,
-                focal_lengths,
-                principal_point,
-                rig2world_transforms,
-                rig2cam,
-                pv_timestamps,
-                pv2world_transforms,
-                discard_no_rgb,
-                clamp_min,
-                clamp_max,
-                depth_path_suffix,
-                disable_project_pinhole,
-            )
+    # the calibration and poses are sent once per chunk of frames
+    save_frame = TimedTask(
+        partial(
+            save_single_pcloud,
+            shared_dict,
+            folder=folder,
+            pinhole_folder=pinhole_folder,
+            save_in_cam_space=save_in_cam_space,
+            lut=lut,
+            has_pv=has_pv,
+            focal_lengths=focal_lengths,
+            principal_point=principal_point,
+            rig2world_transforms=rig2world_transforms,
+            rig2cam=rig2cam,
+            pv_timestamps=pv_timestamps,
+            pv2world_transforms=pv2world_transforms,
+            discard_no_rgb=discard_no_rgb,
+            clamp_min=clamp_min,
+            clamp_max=clamp_max,
+            depth_path_suffix=depth_path_suffix,
+            disable_project_pinhole=disable_project_pinhole,
+            decimation=decimation,
         )
-    multiprocess_pool.close()
-    multiprocess_pool.join()
+    )
+    with stage_pool() as (pool, workers):
+        chunksize = max(1, min(8, len(depth_paths) // (4 * workers)))
+        for result in pool.imap_unordered(save_frame, depth_paths, chunksize):
+            save_frame.done(result)
 
     if not disable_project_pinhole and has_pv:
-        save_output_txt_files(pinhole_folder, shared_dict)
+        if frame_range is not None:
+            output_path = shard_path(pinhole_folder, sensor_name, frame_range)
+            save_pinhole_shard(output_path, shared_dict)
+        else:
+            save_output_txt_files(pinhole_folder, shared_dict)
 
 
 if __name__ == "__main__":
@@ -427,7 +536,14 @@ if __name__ == "__main__":
         "to work on postprocessed ones (e.g. masked AHAT)",
     )
 
+    add_selection_arguments(parser)
+    add_keyframe_arguments(parser)
+    add_decimation_arguments(parser)
+
     args = parser.parse_args()
+    selection = selection_from_arguments(args)
+    keyframes = keyframes_from_arguments(args)
+    decimation = decimation_from_arguments(args)
     for sensor_name in ["Depth Long Throw", "Depth AHaT"]:
         if (Path(args.recording_path) / f"{sensor_name}.tar").exists():
             save_pclouds(
@@ -439,4 +555,7 @@ if __name__ == "__main__":
                 args.clamp_max,
                 args.depth_path_suffix,
                 args.disable_project_pinhole,
+                selection=selection,
+                keyframes=keyframes,
+                decimation=decimation,
             )
@@ -0,0 +1,325 @@
+"""Timers and counters of the processing stages, saved per recording.
+
+process_all records every stage with RecordingMetrics.stage(), the converters
+report into the stage that is running in their thread through the module
+level hooks count(), add_counter(), timer() and the TimedTask pool wrapper. The hooks do
+nothing when no stage is recorded, e.g. when a converter script is run on its
+own.
+"""
+import cProfile
+import collections
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_FILENAME = "metrics.json"
+PROFILE_MODES = ["cprofile", "sample"]
+SAMPLE_INTERVAL = 0.005
+
+# stages of several recordings run side by side in batch_process
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def current_stage():
+    return getattr(_local, "stage", None)
+
+
+def peak_rss():
+    """Peak RSS in bytes of this process and of its largest finished child."""
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    self_usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_usage * scale, children_usage * scale
+
+
+def cpu_time():
+    # children are only accounted once they have been waited for, the stage
+    # pools are joined before the stages return
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class StageMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.status = "running"
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.frames = 0
+        self.bytes = 0
+        self.workers = 0
+        self.worker_busy_s = 0.0
+        self.timers = {}
+        self.counters = {}
+        self.peak_rss_self = 0
+        self.peak_rss_children = 0
+        self.profile = None
+
+    def add_time(self, name, elapsed):
+        timer = self.timers.setdefault(name, {"calls": 0, "total_s": 0.0, "max_s": 0.0})
+        timer["calls"] += 1
+        timer["total_s"] += elapsed
+        timer["max_s"] = max(timer["max_s"], elapsed)
+
+    def to_dict(self):
+        content = {
+            "name": self.name,
+            "status": self.status,
+            "wall_s": self.wall_s,
+            "cpu_s": self.cpu_s,
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "frames_per_s": self.frames / self.wall_s if self.wall_s > 0 else 0.0,
+            "workers": self.workers,
+            "worker_busy_s": self.worker_busy_s,
+            "worker_utilization": (
+                self.worker_busy_s / (self.workers * self.wall_s)
+                if self.workers and self.wall_s > 0
+                else None
+            ),
+            "peak_rss_self": self.peak_rss_self,
+            "peak_rss_children": self.peak_rss_children,
+            "timers": self.timers,
+        }
+        if self.counters:
+            content["counters"] = self.counters
+        if self.profile:
+            content["profile"] = self.profile
+        return content
+
+
+class StackSampler:
+    """Samples the stack of a thread from a background thread, a profile with
+    a fixed overhead for stages where cProfile distorts the timings."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.n_samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.n_samples += 1
+            # every function on the stack gets the sample (cumulative)
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                key = "{}:{}:{}".format(
+                    os.path.basename(code.co_filename),
+                    code.co_firstlineno,
+                    code.co_name,
+                )
+                if key not in seen:
+                    self.samples[key] += 1
+                    seen.add(key)
+                frame = frame.f_back
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def save(self, output_path, top=30):
+        content = {
+            "interval_s": self.interval,
+            "samples": self.n_samples,
+            "cumulative": [
+                {"function": key, "samples": n, "share": n / max(self.n_samples, 1)}
+                for key, n in self.samples.most_common(top)
+            ],
+        }
+        with open(output_path, "w") as f:
+            json.dump(content, f, indent=2)
+        return content
+
+
+class RecordingMetrics:
+    """Metrics of the stages processed for one recording, saved to
+    <recording>/metrics.json.
+
+    With profile_stage set, the stages whose name contains it run under
+    cProfile (profile_mode="cprofile") or the stack sampler ("sample"), the
+    profile is written next to the metrics. Both only see the main process,
+    the pool workers are covered by the worker time of the stage.
+    """
+
+    def __init__(self, recording_path, profile_stage=None, profile_mode="cprofile"):
+        if profile_mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {profile_mode}")
+        self.recording_path = recording_path
+        self.profile_stage = profile_stage
+        self.profile_mode = profile_mode
+        self.started = time.time()
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def profile_path(self, stage_name, extension):
+        slug = "".join(c if c.isalnum() else "_" for c in stage_name)
+        return self.recording_path / f"profile_{slug}.{extension}"
+
+    @contextmanager
+    def profiled(self, stage):
+        if not self.profile_stage or self.profile_stage not in stage.name:
+            yield
+            return
+        if self.profile_mode == "cprofile":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                output_path = self.profile_path(stage.name, "prof")
+                profile.dump_stats(str(output_path))
+                stage.profile = output_path.name
+                print(f"\n[!] Profile of {stage.name} saved to {output_path}")
+                pstats.Stats(profile).sort_stats("cumulative").print_stats(15)
+        else:
+            sampler = StackSampler(threading.get_ident())
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                output_path = self.profile_path(stage.name, "json")
+                sampler.save(output_path)
+                stage.profile = output_path.name
+                print(f"\n[!] Profile of {stage.name} saved to {output_path}")
+
+    @contextmanager
+    def stage(self, name):
+        """Record the stage run in the with block."""
+        stage = StageMetrics(name)
+        with self.lock:
+            self.stages.append(stage)
+        _local.stage = stage
+        start = time.perf_counter()
+        start_cpu = cpu_time()
+        try:
+            with self.profiled(stage):
+                yield stage
+        except BaseException:
+            stage.status = "failed"
+            raise
+        else:
+            stage.status = "done"
+        finally:
+            stage.wall_s = time.perf_counter() - start
+            stage.cpu_s = cpu_time() - start_cpu
+            stage.peak_rss_self, stage.peak_rss_children = peak_rss()
+            _local.stage = None
+            self.save()
+
+    def to_dict(self):
+        return {
+            "recording": self.recording_path.name,
+            "started": self.started,
+            "total_s": sum(stage.wall_s for stage in self.stages),
+            "cpu_count": os.cpu_count(),
+            "stages": [stage.to_dict() for stage in self.stages],
+        }
+
+    def save(self):
+        output_path = self.recording_path / METRICS_FILENAME
+        tmp_path = str(output_path) + ".tmp"
+        with self.lock:
+            with open(tmp_path, "w") as f:
+                json.dump(self.to_dict(), f, indent=2)
+            os.replace(tmp_path, output_path)
+
+    def print_summary(self):
+        print("[!] Stage metrics ({})".format(METRICS_FILENAME))
+        for stage in self.stages:
+            content = stage.to_dict()
+            text = "    {}: {:.2f}s".format(stage.name, stage.wall_s)
+            if stage.frames:
+                text += ", {} frames ({:.1f}/s)".format(
+                    stage.frames, content["frames_per_s"]
+                )
+            if content["worker_utilization"] is not None:
+                text += ", {} workers {:.0%} busy".format(
+                    stage.workers, content["worker_utilization"]
+                )
+            for name, value in stage.counters.items():
+                text += f", {value} {name}"
+            print(text)
+
+
+# Hooks for the converters, no-ops when no stage is recorded
+def count(frames=0, n_bytes=0):
+    stage = current_stage()
+    if stage is not None:
+        with _lock:
+            stage.frames += frames
+            stage.bytes += n_bytes
+
+
+def add_counter(name, n=1):
+    """Add to a named count of the running stage, e.g. of skipped frames."""
+    stage = current_stage()
+    if stage is not None:
+        with _lock:
+            stage.counters[name] = stage.counters.get(name, 0) + n
+
+
+@contextmanager
+def timer(name):
+    """Time a hot section of the running stage, calls are aggregated."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage = current_stage()
+        if stage is not None:
+            with _lock:
+                stage.add_time(name, time.perf_counter() - start)
+
+
+def pool_started(workers):
+    stage = current_stage()
+    if stage is not None:
+        stage.workers = max(stage.workers, workers)
+
+
+class TimedTask:
+    """Picklable wrapper of a pool task returning (busy seconds, result).
+
+    The stage running where the task is created gets the busy time of the
+    results passed to done(), which can be the callback of apply_async.
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.stage = current_stage()
+
+    def __getstate__(self):
+        # the stage stays in the process that collects the results
+        return {"function": self.function, "stage": None}
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        result = self.function(*args)
+        return time.perf_counter() - start, result
+
+    def done(self, timed_result):
+        """Account the busy time of a result, returns the task result."""
+        elapsed, result = timed_result
+        if self.stage is not None:
+            with _lock:
+                self.stage.worker_busy_s += elapsed
+        return result
@@ -0,0 +1,251 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from frame_selection import add_selection_arguments, selection_from_arguments
+from gaze_analytics import load_gaze_data
+from recording_files import folders_extensions, load_tar_timestamps
+
+REPORT_FILENAME = "stream_health.json"
+CSV_STREAM = "Head/hand/eye"
+# streams whose timestamps are compared with each other
+CROSS_STREAMS = ["PV", "Depth AHaT", "Depth Long Throw", CSV_STREAM]
+HundredsOfNsToMilliseconds = 1e-4
+# a delta larger than this many nominal periods is counted as a gap
+GAP_FACTOR = 1.5
+
+
+def timestamp_health(timestamps):
+    """Sampling statistics of a stream from its timestamps (100ns ticks)."""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    health = {"n_samples": int(len(timestamps))}
+    if len(timestamps) < 2:
+        return health
+
+    deltas = np.diff(timestamps) * HundredsOfNsToMilliseconds
+    period = float(np.median(deltas))
+    jitter = np.abs(deltas - period)
+    gaps = deltas > GAP_FACTOR * period
+    dropped = np.round(deltas[gaps] / period) - 1 if period > 0 else np.zeros(0)
+
+    health.update(
+        {
+            "duration_s": float((timestamps[-1] - timestamps[0]) * 1e-7),
+            "period_ms": period,
+            "fps": 1e3 / period if period > 0 else 0.0,
+            "mean_fps": 1e3 / float(np.mean(deltas)) if np.mean(deltas) > 0 else 0.0,
+            "jitter_ms": {
+                "p50": float(np.percentile(jitter, 50)),
+                "p95": float(np.percentile(jitter, 95)),
+                "p99": float(np.percentile(jitter, 99)),
+                "max": float(np.max(jitter)),
+            },
+            "n_gaps": int(np.count_nonzero(gaps)),
+            "max_gap_ms": float(np.max(deltas[gaps])) if np.any(gaps) else 0.0,
+            "n_dropped": int(np.sum(dropped)),
+            "n_duplicates": int(np.count_nonzero(deltas == 0)),
+            "n_out_of_order": int(np.count_nonzero(deltas < 0)),
+        }
+    )
+    return health
+
+
+def print_health(name, health):
+    if health["n_samples"] < 2:
+        print("{}: {} samples".format(name, health["n_samples"]))
+        return
+    print(
+        "{}: {} samples, {:.1f}s, {:.3f}fps, jitter p95 {:.3f}ms, "
+        "{} gaps ({} dropped), {} duplicates".format(
+            name,
+            health["n_samples"],
+            health["duration_s"],
+            health["fps"],
+            health["jitter_ms"]["p95"],
+            health["n_gaps"],
+            health["n_dropped"],
+            health["n_duplicates"],
+        )
+    )
+
+
+def save_report(output_path, report):
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def recording_streams(recording_path):
+    """Timestamps of every stream of a recording, in recording order.
+
+    Sensor timestamps come from the tar indexes (or the extracted folders when
+    the tar is gone, PV also from pv.txt) and the head/hand/eye timestamps from the csv, so nothing
+    needs to be extracted. Also returns the eye gaze availability, if any.
+    """
+    streams = {}
+    for sensor_name, extension in folders_extensions:
+        tar_path = recording_path / f"{sensor_name}.tar"
+        if tar_path.exists():
+            streams[sensor_name] = load_tar_timestamps(tar_path, sort=False)
+        elif (recording_path / sensor_name).is_dir():
+            paths = (recording_path / sensor_name).glob("*%s" % extension)
+            streams[sensor_name] = np.sort(
+                np.array([int(path.stem) for path in paths], dtype=np.int64)
+            )
+
+    if "PV" not in streams:
+        for pv_info_path in recording_path.glob("*pv.txt"):
+            # one line per frame after the intrinsics line
+            streams["PV"] = np.loadtxt(
+                pv_info_path,
+                delimiter=",",
+                usecols=0,
+                skiprows=1,
+                dtype=np.int64,
+                ndmin=1,
+            )
+
+    gaze_available = None
+    for csv_path in recording_path.glob("*_eye.csv"):
+        timestamps, _, gaze_available = load_gaze_data(csv_path)
+        streams[CSV_STREAM] = timestamps
+    return streams, gaze_available
+
+
+def cross_stream_offsets(timestamps, reference):
+    """Offsets from every timestamp to the nearest reference timestamp (ms)."""
+    timestamps = np.sort(timestamps)
+    reference = np.sort(reference)
+    if len(reference) > 1:
+        idx = np.clip(np.searchsorted(reference, timestamps), 1, len(reference) - 1)
+        before = reference[idx - 1]
+        after = reference[idx]
+        nearest = np.where(timestamps - before <= after - timestamps, before, after)
+    else:
+        nearest = np.full_like(timestamps, reference[0])
+    offsets = np.abs(timestamps - nearest) * HundredsOfNsToMilliseconds
+    return {
+        "start_ms": float((timestamps[0] - reference[0]) * HundredsOfNsToMilliseconds),
+        "end_ms": float((timestamps[-1] - reference[-1]) * HundredsOfNsToMilliseconds),
+        "nearest_ms": {
+            "p50": float(np.percentile(offsets, 50)),
+            "p95": float(np.percentile(offsets, 95)),
+            "max": float(np.max(offsets)),
+        },
+    }
+
+
+def health_report(streams):
+    """Per stream health and the offsets between the PV, depth and eye streams."""
+    report = {"streams": {}, "offsets": {}}
+    for name, timestamps in streams.items():
+        report["streams"][name] = timestamp_health(timestamps)
+
+    names = [name for name in CROSS_STREAMS if len(streams.get(name, [])) > 0]
+    for i, name in enumerate(names):
+        for reference in names[i + 1 :]:
+            report["offsets"][f"{name} <-> {reference}"] = cross_stream_offsets(
+                streams[name], streams[reference]
+            )
+    return report
+
+
+def print_report(report):
+    for name, health in report["streams"].items():
+        print_health(name, health)
+    for pair, offsets in report["offsets"].items():
+        print(
+            "{}: start {:+.1f}ms, end {:+.1f}ms, nearest p50 {:.3f}ms, "
+            "p95 {:.3f}ms".format(
+                pair,
+                offsets["start_ms"],
+                offsets["end_ms"],
+                offsets["nearest_ms"]["p50"],
+                offsets["nearest_ms"]["p95"],
+            )
+        )
+
+
+def check_report(report, max_drop_rate=None, max_offset_ms=None):
+    """Problems of a report against the thresholds, empty when it passes."""
+    problems = []
+    for name, health in report["streams"].items():
+        if health["n_samples"] < 2:
+            problems.append(f"{name}: {health['n_samples']} samples")
+            continue
+        if health["n_out_of_order"]:
+            problems.append(f"{name}: {health['n_out_of_order']} out of order")
+        drop_rate = health["n_dropped"] / (health["n_samples"] + health["n_dropped"])
+        if max_drop_rate is not None and drop_rate > max_drop_rate:
+            problems.append(f"{name}: {100 * drop_rate:.1f}% dropped")
+    if max_offset_ms is not None:
+        for pair, offsets in report["offsets"].items():
+            if offsets["nearest_ms"]["p50"] > max_offset_ms:
+                problems.append(
+                    "{}: {:.1f}ms apart".format(pair, offsets["nearest_ms"]["p50"])
+                )
+    return problems
+
+
+def check_stream_health(recording_path, selection=None):
+    """Write stream_health.json for a recording and print the summary. With a
+    frame_selection.FrameSelection only the selected frames are checked."""
+    streams, gaze_available = recording_streams(recording_path)
+    if selection:
+        for name, timestamps in streams.items():
+            selected = selection.mask(timestamps, recording_path)
+            streams[name] = timestamps[selected]
+            if name == CSV_STREAM and gaze_available is not None:
+                gaze_available = gaze_available[selected]
+    report = health_report(streams)
+    if selection:
+        report["selection"] = selection.to_dict()
+    if gaze_available is not None:
+        report["streams"][CSV_STREAM]["eye_present"] = (
+            float(np.mean(gaze_available)) if len(gaze_available) else 0.0
+        )
+    save_report(recording_path / REPORT_FILENAME, report)
+    print_report(report)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the stream timestamps of recordings without extracting them."
+    )
+    parser.add_argument(
+        "--recording_path",
+        required=True,
+        nargs="+",
+        help="Path to recording folder(s)",
+    )
+    parser.add_argument(
+        "--max_drop_rate",
+        type=float,
+        default=None,
+        help="Reject recordings with a larger share of dropped frames in a stream",
+    )
+    parser.add_argument(
+        "--max_offset_ms",
+        type=float,
+        default=None,
+        help="Reject recordings whose streams are further apart (median, in ms)",
+    )
+
+    add_selection_arguments(parser)
+
+    args = parser.parse_args()
+    selection = selection_from_arguments(args)
+
+    n_failed = 0
+    for recording_path in args.recording_path:
+        print(f"[!] {recording_path}")
+        report = check_stream_health(Path(recording_path), selection)
+        problems = check_report(report, args.max_drop_rate, args.max_offset_ms)
+        for problem in problems:
+            print(f"    => {problem}")
+        print("[!] {}".format("FAIL" if problems else "PASS"))
+        n_failed += len(problems) > 0
+    sys.exit(1 if n_failed else 0)
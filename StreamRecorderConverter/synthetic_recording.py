@@ -0,0 +1,299 @@
+"""Write fake recordings in the formats of the StreamRecorder app.
+
+The files follow RMCameraReader, VideoFrameProcessor and HeTHaTEyeStream:
+PV.tar with BGRA '<timestamp>.bytes' frames and <name>_pv.txt, depth tars
+with big-endian 16 bit '<timestamp>.pgm' and '<timestamp>_ab.pgm' images,
+VLC tars with 8 bit '<timestamp>.pgm' images, '<sensor>_lut.bin',
+'<sensor>_extrinsics.txt', '<sensor>_rig2world.txt' and the 861 column
+<name>_head_hand_eye.csv. The scene is a wall and a sphere in front of a
+slowly moving head, so the converters have realistic work to do.
+"""
+import argparse
+import io
+import tarfile
+from pathlib import Path
+
+import numpy as np
+
+# name, (width, height), default fps, bytes per pixel
+SENSORS = {
+    "PV": ((760, 428), 30.0, 4),
+    "Depth AHaT": ((512, 512), 45.0, 2),
+    "Depth Long Throw": ((320, 288), 5.0, 2),
+    "VLC LF": ((640, 480), 30.0, 1),
+    "VLC RF": ((640, 480), 30.0, 1),
+    "VLC LL": ((640, 480), 30.0, 1),
+    "VLC RR": ((640, 480), 30.0, 1),
+}
+EYE_FPS = 60.0
+JOINT_COUNT = 26
+# ticks of 100ns, a date in 2021
+START_TIMESTAMP = 132700000000000000
+HundredsOfNsPerSecond = 10**7
+# AHaT depth beyond this many mm is not valid
+AHAT_MAX_DEPTH = 1055
+
+
+def frame_timestamps(duration, fps, offset=0):
+    n_frames = int(duration * fps)
+    ticks = np.round(np.arange(n_frames) * HundredsOfNsPerSecond / fps)
+    return START_TIMESTAMP + offset + ticks.astype(np.int64)
+
+
+def head_pose(timestamps):
+    """Head (rig) to world transforms swaying slowly around the origin."""
+    t = (timestamps - START_TIMESTAMP) / HundredsOfNsPerSecond
+    angles = 0.2 * np.sin(0.5 * t)
+    transforms = np.tile(np.eye(4), (len(t), 1, 1))
+    transforms[:, 0, 0] = np.cos(angles)
+    transforms[:, 0, 2] = np.sin(angles)
+    transforms[:, 2, 0] = -np.sin(angles)
+    transforms[:, 2, 2] = np.cos(angles)
+    transforms[:, 0, 3] = 0.1 * np.sin(0.3 * t)
+    transforms[:, 1, 3] = 0.02 * np.sin(1.1 * t)
+    return transforms
+
+
+def format_rows(timestamps, values):
+    # timestamps do not fit into float64 without losing ticks
+    return "".join(
+        "{},{}\n".format(timestamp, ",".join(map(str, row)))
+        for timestamp, row in zip(timestamps.tolist(), values.tolist())
+    )
+
+
+def add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def pgm(image, max_value):
+    header = "P5\n{} {}\n{}\n".format(image.shape[1], image.shape[0], max_value)
+    data = image.astype(">u2" if max_value > 255 else np.uint8).tobytes()
+    return header.encode("ascii") + data
+
+
+def make_lut(width, height, focal):
+    """Unit ray directions of a pinhole camera, as in RMCameraReader::DumpCalibration."""
+    u, v = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+    xy = np.stack(
+        ((u - width / 2) / focal, (v - height / 2) / focal, np.ones_like(u)), -1
+    )
+    return (xy / np.linalg.norm(xy, axis=-1, keepdims=True)).reshape((-1, 3))
+
+
+def render_depth(lut, rig2world, rig2cam, max_depth):
+    """Radial depth in mm of a wall 2m away with a 30cm sphere in front of it."""
+    cam2world = rig2world @ np.linalg.inv(rig2cam)
+    origin = cam2world[:3, 3]
+    directions = lut @ cam2world[:3, :3].T
+
+    # wall z = -2 in world space, the sensors look along -z
+    with np.errstate(divide="ignore", invalid="ignore"):
+        depth = (-2.0 - origin[2]) / directions[:, 2]
+    depth = np.where(depth > 0, depth, np.inf)
+
+    center = np.array([0.0, 0.0, -1.0])
+    oc = origin - center
+    b = directions @ oc
+    disc = b**2 - (oc @ oc - 0.3**2)
+    hit = -b - np.sqrt(np.maximum(disc, 0))
+    depth = np.where((disc > 0) & (hit > 0), np.minimum(depth, hit), depth)
+
+    depth_mm = np.round(depth * 1000)
+    return np.where(depth_mm <= max_depth, depth_mm, 0)
+
+
+def write_camera_sensor(folder, sensor_name, duration, fps, rng, offset):
+    (width, height), _, bytes_per_pixel = SENSORS[sensor_name]
+    timestamps = frame_timestamps(duration, fps, offset)
+    is_depth = bytes_per_pixel == 2
+    lut = make_lut(width, height, focal=width / 2)
+    lut.astype(np.float32).tofile(folder / f"{sensor_name}_lut.bin")
+
+    # the sensors look along -z of the rig, the depth cameras slightly down
+    rig2cam = np.diag([1.0, -1.0, -1.0, 1.0])
+    rig2cam[:3, 3] = [0.0, -0.02, 0.01] if is_depth else [0.05, 0.0, 0.0]
+    with open(folder / f"{sensor_name}_extrinsics.txt", "w") as f:
+        f.write(",".join(map(str, rig2cam.ravel())) + "\n")
+
+    rig2world = head_pose(timestamps)
+    with open(folder / f"{sensor_name}_rig2world.txt", "w") as f:
+        f.write(format_rows(timestamps, rig2world.reshape((-1, 16))))
+
+    max_depth = AHAT_MAX_DEPTH if sensor_name == "Depth AHaT" else 7500
+    with tarfile.open(folder / f"{sensor_name}.tar", "w") as tar:
+        for timestamp, transform in zip(timestamps, rig2world):
+            if is_depth:
+                depth = render_depth(lut, transform, rig2cam, max_depth)
+                depth = depth.reshape((height, width))
+                ab = np.clip(4e6 / np.maximum(depth, 1) ** 1.2, 0, 65535)
+                ab += rng.integers(0, 64, size=ab.shape)
+                add_member(tar, f"{timestamp}_ab.pgm", pgm(ab, 65535))
+                add_member(tar, f"{timestamp}.pgm", pgm(depth, 65535))
+            else:
+                image = rng.integers(0, 256, size=(height, width), dtype=np.uint8)
+                add_member(tar, f"{timestamp}.pgm", pgm(image, 255))
+    return len(timestamps)
+
+
+def write_pv(folder, name, duration, fps, rng, offset):
+    (width, height), _, _ = SENSORS["PV"]
+    timestamps = frame_timestamps(duration, fps, offset)
+    focal = 0.75 * width
+
+    # PV looks along -z of the head, as the camera on the device
+    pv2world = head_pose(timestamps)
+    with open(folder / f"{name}_pv.txt", "w") as f:
+        f.write("{},{},{},{}\n".format(width / 2, height / 2, width, height))
+        values = np.hstack(
+            (np.full((len(timestamps), 2), focal), pv2world.reshape((-1, 16)))
+        )
+        f.write(format_rows(timestamps, values))
+
+    gradient = np.linspace(0, 255, width, dtype=np.uint8)
+    base = np.empty((height, width, 4), dtype=np.uint8)
+    base[:, :, 0] = gradient
+    base[:, :, 1] = gradient[::-1]
+    base[:, :, 2] = np.linspace(0, 255, height, dtype=np.uint8)[:, None]
+    base[:, :, 3] = 255
+    with tarfile.open(folder / "PV.tar", "w") as tar:
+        for i, timestamp in enumerate(timestamps):
+            # shift and add noise so the png encoder cannot cheat
+            frame = np.roll(base, i * 4, axis=1)
+            frame[:, :, :3] += rng.integers(
+                0, 8, size=(height, width, 3), dtype=np.uint8
+            )
+            add_member(tar, f"{timestamp}.bytes", frame.tobytes())
+    return len(timestamps)
+
+
+def write_head_hand_eye(folder, name, duration, fps, rng, eye_only=False):
+    timestamps = frame_timestamps(duration, fps)
+    n = len(timestamps)
+    head = head_pose(timestamps)
+
+    # joints half a meter in front of the head
+    def hand(x):
+        joints = np.tile(np.eye(4), (n, JOINT_COUNT, 1, 1))
+        local = np.array([x, -0.2, -0.45]) + rng.normal(0, 0.03, (n, JOINT_COUNT, 3))
+        joints[:, :, :3, 3] = np.einsum("nij,nkj->nki", head[:, :3, :3], local)
+        joints[:, :, :3, 3] += head[:, None, :3, 3]
+        present = (rng.random(n) > 0.05).astype(float)
+        return present, joints.reshape((n, -1))
+
+    gaze_present = (rng.random(n) > 0.02).astype(float)
+    origin = np.hstack((head[:, :3, 3], np.ones((n, 1))))
+    direction = np.hstack((-head[:, :3, 2], np.zeros((n, 1))))
+    direction[:, :3] += rng.normal(0, 0.05, (n, 3))
+    distance = rng.uniform(0.5, 2.0, n)
+    gaze = np.hstack((gaze_present[:, None], origin, direction, distance[:, None]))
+
+    if eye_only:
+        values = gaze
+    else:
+        left_present, left = hand(-0.15)
+        right_present, right = hand(0.15)
+        values = np.hstack(
+            (
+                head.reshape((n, 16)),
+                left_present[:, None],
+                left,
+                right_present[:, None],
+                right,
+                gaze,
+            )
+        )
+    with open(folder / f"{name}_head_hand_eye.csv", "w") as f:
+        f.write(format_rows(timestamps, values))
+    return n
+
+
+def write_recording(
+    folder,
+    duration=5.0,
+    sensors=("PV", "Depth AHaT", "Depth Long Throw"),
+    fps=None,
+    eye=True,
+    eye_only=False,
+    seed=0,
+):
+    """Write a fake recording into folder, returns the frame count per stream.
+
+    fps optionally overrides the frame rate of sensors (and "eye")."""
+    fps = fps or {}
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    name = "2021-01-01-000000"
+    rng = np.random.default_rng(seed)
+
+    frames = {}
+    if not eye_only:
+        for i, sensor_name in enumerate(sensors):
+            sensor_fps = fps.get(sensor_name, SENSORS[sensor_name][1])
+            # the streams do not start at the same time on device
+            offset = 1000 * (i + 1)
+            if sensor_name == "PV":
+                frames[sensor_name] = write_pv(
+                    folder, name, duration, sensor_fps, rng, offset
+                )
+            else:
+                frames[sensor_name] = write_camera_sensor(
+                    folder, sensor_name, duration, sensor_fps, rng, offset
+                )
+    if eye or eye_only:
+        frames["Head/hand/eye"] = write_head_hand_eye(
+            folder, name, duration, fps.get("eye", EYE_FPS), rng, eye_only
+        )
+    return frames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic recording.")
+    parser.add_argument(
+        "--recording_path", required=True, help="Path to the recording folder to write"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=5.0, help="Length of the recording in s"
+    )
+    parser.add_argument(
+        "--sensors",
+        nargs="*",
+        default=["PV", "Depth AHaT", "Depth Long Throw"],
+        choices=list(SENSORS),
+        help="Camera streams to write",
+    )
+    parser.add_argument(
+        "--fps",
+        nargs="*",
+        default=[],
+        help="Frame rate overrides as <sensor>=<fps>, e.g. 'PV=15' or 'eye=30'",
+    )
+    parser.add_argument(
+        "--no_eye", action="store_true", help="Do not write the head/hand/eye csv"
+    )
+    parser.add_argument(
+        "--eye_only",
+        action="store_true",
+        help="Write only the 11 column csv of an eye-only recording",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    args = parser.parse_args()
+    fps = {}
+    for override in args.fps:
+        sensor_name, value = override.rsplit("=", 1)
+        fps[sensor_name] = float(value)
+
+    frames = write_recording(
+        Path(args.recording_path),
+        args.duration,
+        args.sensors,
+        fps,
+        not args.no_eye,
+        args.eye_only,
+        args.seed,
+    )
+    for stream, n_frames in frames.items():
+        print(f"{stream}: {n_frames} frames")
@@ -0,0 +1,49 @@
+"""process_all on a synthetic recording with a frame selection, run with
+
+    python -m pytest test_frame_selection.py
+
+from this folder. Needs open3d for the point clouds.
+"""
+import pytest
+
+from frame_selection import FrameSelection
+from synthetic_recording import write_recording
+
+SENSOR_NAME = "Depth Long Throw"
+
+
+def count_files(folder, pattern):
+    return len(list(folder.glob(pattern)))
+
+
+@pytest.mark.parametrize(
+    "selection, fps",
+    [
+        (FrameSelection(stride=2), {"PV": 10}),
+        # depth frames match PV frames the stride skipped
+        (FrameSelection(stride=2), {"PV": 15, SENSOR_NAME: 7}),
+        (FrameSelection(start="1", end="-1", fps=3), {"PV": 15}),
+    ],
+)
+def test_selection_applied_once(tmp_path, selection, fps):
+    # skipped where open3d is missing or cannot load its libraries
+    pytest.importorskip("open3d", exc_type=ImportError)
+    from process_all import process_all
+    from utils import load_tar_timestamps
+
+    write_recording(tmp_path, duration=4.0, sensors=("PV", SENSOR_NAME), fps=fps)
+    process_all(tmp_path, selection=selection)
+
+    n_pv = len(selection.select_stream(tmp_path, "PV"))
+    n_depth = len(selection.select_stream(tmp_path, SENSOR_NAME))
+    assert 0 < n_pv < len(load_tar_timestamps(tmp_path / "PV.tar"))
+    assert count_files(tmp_path / "PV", "*.png") == n_pv
+    assert count_files(tmp_path / "PV", "*.bytes") == 0
+    assert count_files(tmp_path / SENSOR_NAME, "*[0-9].pgm") == n_depth
+    assert count_files(tmp_path / SENSOR_NAME, "*.ply") == n_depth
+
+    pinhole_folder = tmp_path / "pinhole_projection"
+    with open(pinhole_folder / "rgb.txt") as f:
+        assert len(f.readlines()) == n_depth
+    assert count_files(pinhole_folder / "rgb", "*.png") == n_depth
+    assert count_files(pinhole_folder / "depth", "*.png") == n_depth
@@ -0,0 +1,128 @@
+"""The shared workspace job queue with several nodes, run with
+
+    python -m pytest test_work_queue.py
+
+from this folder. Uses eye-only recordings, which need neither OpenCV nor
+open3d.
+"""
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from frame_selection import FrameSelection
+from gaze_analytics import load_gaze_data
+from synthetic_recording import write_recording
+from work_queue import (
+    DONE,
+    FAILED,
+    PENDING,
+    WorkQueue,
+    new_job,
+    process_arguments,
+    read_json,
+    recording_jobs,
+)
+
+HERE = Path(__file__).parent
+N_RECORDINGS = 6
+N_NODES = 3
+
+
+def run_queue(w_path, command, *args):
+    return subprocess.Popen(
+        [sys.executable, "work_queue.py", command, "--workspace", str(w_path)]
+        + list(args),
+        cwd=HERE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+
+
+def test_every_job_runs_once(tmp_path):
+    for i in range(N_RECORDINGS):
+        write_recording(tmp_path / f"rec{i}", duration=2.0, eye_only=True, seed=i)
+    # the selection travels with the jobs
+    submit = run_queue(tmp_path, "submit", "--stride", "2")
+    assert submit.wait(60) == 0, submit.stdout.read()
+
+    nodes = [
+        run_queue(
+            tmp_path, "work", "--node", f"node{i}", "--poll", "0.2", "--exit_when_empty"
+        )
+        for i in range(N_NODES)
+    ]
+    logs = []
+    for node in nodes:
+        out, _ = node.communicate(timeout=120)
+        assert node.returncode == 0, out
+        logs.append(out)
+
+    work_queue = WorkQueue(tmp_path)
+    assert not work_queue.jobs(FAILED)
+    assert work_queue.drained()
+    done = {job_id: read_json(path) for job_id, _, path in work_queue.jobs(DONE)}
+    assert sorted(done) == [f"rec{i}" for i in range(N_RECORDINGS)]
+    for job_id, job in done.items():
+        assert job["attempts"] == 1
+        n_runs = sum(log.count(f": running {job_id} ") for log in logs)
+        assert n_runs == 1
+        timestamps, _, _ = load_gaze_data(next((tmp_path / job_id).glob("*.csv")))
+        n_selected = len(FrameSelection(stride=2).select(timestamps, tmp_path))
+        gaze = np.load(tmp_path / job_id / "gaze.npz")
+        assert len(gaze["timestamps"]) == n_selected < len(timestamps)
+
+
+def test_shards_of_selected_frames(tmp_path):
+    sensor_name = "Depth Long Throw"
+    write_recording(tmp_path, duration=4.0, sensors=(sensor_name,), eye=False)
+    options = {
+        "selection": FrameSelection(stride=3).to_dict(),
+        "keyframes": {"min_translation": 0.1, "min_rotation": 10.0},
+        "decimation": {"factor": 2, "mode": "median"},
+    }
+    jobs = recording_jobs(tmp_path, options, shard_frames=5)
+
+    selection = process_arguments(jobs[0]["options"])["selection"]
+    n_selected = len(selection.select_stream(tmp_path, sensor_name))
+    shards = [job["frames"] for job in jobs if job["kind"] == "pclouds"]
+    assert shards[0][0] == 0 and shards[-1][1] == n_selected
+    assert all(a[1] == b[0] for a, b in zip(shards, shards[1:]))
+    for job in jobs:
+        arguments = process_arguments(job["options"])
+        assert arguments["keyframes"].min_rotation == 10.0
+        assert arguments["decimation"].to_dict() == options["decimation"]
+
+
+def make_stale(claim_path):
+    past = time.time() - 3600
+    os.utime(claim_path, (past, past))
+
+
+def test_stale_claim_requeued_then_failed(tmp_path):
+    work_queue = WorkQueue(tmp_path)
+    work_queue.submit([new_job("rec", "recording", "rec", {})])
+
+    for attempt in [1, 2]:
+        job, claim_path = work_queue.claim(f"node{attempt}")
+        assert job["attempts"] == attempt
+        # a fresh claim is left alone
+        work_queue.recover_stale(stale_after=60, max_attempts=2)
+        assert claim_path.exists()
+        make_stale(claim_path)
+        work_queue.recover_stale(stale_after=60, max_attempts=2)
+        assert not claim_path.exists()
+
+        if attempt == 1:
+            assert work_queue.job_ids(PENDING) == {"rec"}
+            # the stopped node finds its claim gone
+            assert not work_queue.finish(job, claim_path, {})
+
+    assert not work_queue.job_ids(PENDING)
+    assert not work_queue.claim("node3")
+    ((_, _, path),) = work_queue.jobs(FAILED)
+    assert "claimed 2 times" in read_json(path)["error"]
@@ -12,33 +12,25 @@ from pathlib import Path
 import numpy as np
 import open3d as o3d
 
+from keyframes import add_keyframe_arguments, keyframes_from_arguments
 from utils import DEPTH_SCALING_FACTOR
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="TSDF-Integration with open3d")
-    parser.add_argument(
-        "--pinhole_path",
-        required=True,
-        help="Path to folder inside recording containing pinhole projected images "
-        "recordings",
-    )
-
-    parser.add_argument(
-        "--voxel_size",
-        required=False,
-        default=0.04,
-        type=float,
-        help="Voxel size to use for tsdf integration."
-        "Bigger values results in denser but slower reconstructions.",
-    )
-
-    args = parser.parse_args()
-    pinhole_path = Path(args.pinhole_path)
+def integrate_tsdf(pinhole_path, voxel_size=0.04, keyframes=None):
+    """Fuse the pinhole projected depth and rgb images of save_pclouds into a
+    mesh and a point cloud, saved next to them. Returns the point cloud.
+    With a keyframes.KeyframeSelector only the keyframes are integrated."""
     # WARNING: in read_pinhole_camera_trajectory extrinsic gets inverted!
     trajectory = o3d.io.read_pinhole_camera_trajectory(
         str(pinhole_path / "odometry.log")
     )
+    keep = np.ones(len(trajectory.parameters), dtype=bool)
+    if keyframes is not None:
+        # the extrinsics are world to camera
+        keep = keyframes.mask(
+            [np.linalg.inv(p.extrinsic) for p in trajectory.parameters]
+        )
+        keyframes.report(keep, pinhole_path.name)
 
     # Take care of open3d api change from 0.11
     o3d_integration = None
@@ -49,8 +41,8 @@ if __name__ == "__main__":
         o3d_integration = o3d.pipelines.integration
 
     volume = o3d_integration.ScalableTSDFVolume(
-        voxel_length=args.voxel_size,
-        sdf_trunc=args.voxel_size * 3,  # truncation value is set at 3x voxel size
+        voxel_length=voxel_size,
+        sdf_trunc=voxel_size * 3,  # truncation value is set at 3x voxel size
         color_type=o3d_integration.TSDFVolumeColorType.RGB8,
     )
     #   color_type=o3d.integration.TSDFVolumeColorType.NoColor)
@@ -58,7 +50,7 @@ if __name__ == "__main__":
     intrinsic_path = pinhole_path / "calibration.txt"
     rgb_file_list = pinhole_path / "rgb.txt"
     depth_file_list = pinhole_path / "depth.txt"
-    print(f"Integrating {len(trajectory.parameters)} images")
+    print(f"Integrating {np.count_nonzero(keep)} images")
 
     intrinsic_np = np.loadtxt(str(intrinsic_path))
 
@@ -69,6 +61,9 @@ if __name__ == "__main__":
             depth_line = df.readline()
             if not rgb_line or not depth_line:
                 break
+            if not keep[i]:
+                i = i + 1
+                continue
             rgb_path = str(pinhole_path / rgb_line.split()[1])
             depth_path = str(pinhole_path / depth_line.split()[1])
 
@@ -107,4 +102,30 @@ if __name__ == "__main__":
     print(f"Saving point cloud to {pc_path}")
     o3d.io.write_point_cloud(pc_path, pc)
 
+    return pc
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TSDF-Integration with open3d")
+    parser.add_argument(
+        "--pinhole_path",
+        required=True,
+        help="Path to folder inside recording containing pinhole projected images "
+        "recordings",
+    )
+
+    parser.add_argument(
+        "--voxel_size",
+        required=False,
+        default=0.04,
+        type=float,
+        help="Voxel size to use for tsdf integration."
+        "Bigger values results in denser but slower reconstructions.",
+    )
+    add_keyframe_arguments(parser)
+
+    args = parser.parse_args()
+    pc = integrate_tsdf(
+        Path(args.pinhole_path), args.voxel_size, keyframes_from_arguments(args)
+    )
     o3d.visualization.draw_geometries([pc])
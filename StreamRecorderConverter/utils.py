@@ -6,34 +6,24 @@
  IMPLIED WARRANTIES OF FITNESS FOR A PARTICULAR
  PURPOSE, MERCHANTABILITY, OR NON-INFRINGEMENT.
 """
-import tarfile
-
 import numpy as np
 import cv2
 
 from hand_defs import HandJointIndex
 
+# the tar and file name helpers live without the vision libraries
+from recording_files import (
+    PROJECTION_FILENAME,
+    extract_tar_file,
+    folders_extensions,
+    load_tar_timestamps,
+    member_timestamp,
+)
+
 # Depth values are saved inside a 16bit png with the following scaling factor
 # This correponds to the scaling factor used by the TUM slam dataset:w
 DEPTH_SCALING_FACTOR = 5000
 
-folders_extensions = [
-    ("PV", "bytes"),
-    ("Depth AHaT", "[0-9].pgm"),
-    ("Depth Long Throw", "[0-9].pgm"),
-    ("VLC LF", "[0-9].pgm"),
-    ("VLC RF", "[0-9].pgm"),
-    ("VLC LL", "[0-9].pgm"),
-    ("VLC RR", "[0-9].pgm"),
-]
-
-
-def extract_tar_file(tar_filename, output_path):
-    tar = tarfile.open(tar_filename)
-    tar.extractall(output_path)
-    tar.close()
-
-
 def load_lut(lut_filename):
     with open(lut_filename, mode="rb") as depth_file:
         lut = np.frombuffer(depth_file.read(), dtype="f")
@@ -41,40 +31,11 @@ def load_lut(lut_filename):
     return lut
 
 
-def check_framerates(capture_path):
-    HundredsOfNsToMilliseconds = 1e-4
-    MillisecondsToSeconds = 1e-3
+def check_framerates(capture_path, selection=None):
+    # superseded by the stream health report, which also needs no extraction
+    from stream_health import check_stream_health
 
-    def get_avg_delta(timestamps):
-        deltas = [
-            (timestamps[i] - timestamps[i - 1]) for i in range(1, len(timestamps))
-        ]
-        return np.mean(deltas)
-
-    for (img_folder, img_ext) in folders_extensions:
-        base_folder = capture_path / img_folder
-        paths = base_folder.glob("*%s" % img_ext)
-        timestamps = [int(path.stem) for path in paths]
-        if len(timestamps):
-            avg_delta = get_avg_delta(timestamps) * HundredsOfNsToMilliseconds
-            print(
-                "Average {} delta: {:.3f}ms, fps: {:.3f}".format(
-                    img_folder, avg_delta, 1 / (avg_delta * MillisecondsToSeconds)
-                )
-            )
-
-    head_hat_stream_path = capture_path.glob("*eye.csv")
-    try:
-        head_hat_stream_path = next(head_hat_stream_path)
-        timestamps = load_head_hand_eye_data(str(head_hat_stream_path))[0]
-        hh_avg_delta = get_avg_delta(timestamps) * HundredsOfNsToMilliseconds
-        print(
-            "Average hand/head delta: {:.3f}ms, fps: {:.3f}".format(
-                hh_avg_delta, 1 / (hh_avg_delta * MillisecondsToSeconds)
-            )
-        )
-    except StopIteration:
-        pass
+    check_stream_health(capture_path, selection)
 
 
 def load_head_hand_eye_data(csv_path):
@@ -0,0 +1,624 @@
+"""Process workspace recordings on several nodes sharing the workspace.
+
+Jobs are JSON files in <workspace>/.queue, moved between the state folders
+pending/, claimed/, done/ and failed/ with os.rename(), which is atomic on a
+POSIX filesystem (NFS included), so of the nodes renaming the same pending job
+only one gets it. A claimed job is named <job>@<node>.json and its node
+touches it every heartbeat seconds while the job runs. Any node puts claims
+that were not touched for stale_after seconds back in pending/, or in failed/
+after max_attempts claims. The node clocks have to agree (NTP) to well below
+stale_after.
+
+A recording is queued as a single job running all its stages, unless one of
+its depth streams has more than shard_frames frames. Then a "prepare" job runs
+the stages besides the point clouds, the point clouds of every depth stream
+are split in frame ranges run as jobs of their own, and a "merge" job joins
+the pinhole projection lists and the timings of the shards and checks the
+stream health.
+
+    python work_queue.py submit --workspace /mnt/share/downloads
+    python work_queue.py work --workspace /mnt/share/downloads
+    python work_queue.py status --workspace /mnt/share/downloads
+"""
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+from pathlib import Path
+
+from batch_process import select_recordings
+from depth_decimation import (
+    DepthDecimation,
+    add_decimation_arguments,
+    decimation_from_arguments,
+)
+from frame_selection import (
+    FrameSelection,
+    add_selection_arguments,
+    selection_from_arguments,
+)
+from keyframes import KeyframeSelector, add_keyframe_arguments, keyframes_from_arguments
+from process_all import build_stages, is_eye_only, process_all
+from recording_files import load_tar_timestamps
+from stage_metrics import METRICS_FILENAME, RecordingMetrics
+from stream_health import check_stream_health
+from worker_pool import set_thread_policy
+
+QUEUE_FOLDER = ".queue"
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+STATES = [PENDING, CLAIMED, DONE, FAILED]
+DEPTH_SENSORS = ["Depth Long Throw", "Depth AHaT"]
+SHARD_FRAMES = 3000
+HEARTBEAT_S = 10.0
+STALE_AFTER_S = 120.0
+POLL_S = 5.0
+MAX_ATTEMPTS = 3
+# options stored by their to_dict() in the jobs, rebuilt by process_arguments()
+OPTION_CLASSES = {
+    "selection": FrameSelection,
+    "keyframes": KeyframeSelector,
+    "decimation": DepthDecimation,
+}
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(path, content):
+    # the temporary file does not match the *.json listings of the queue
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def options_from_arguments(args):
+    """Job options of the process_all command line options, kept as JSON."""
+    options = {
+        "project_hand_eye": args.project_hand_eye,
+        "overlay_output": args.overlay_output,
+        "overlay_scale": args.overlay_scale,
+    }
+    for key, value in [
+        ("selection", selection_from_arguments(args)),
+        ("keyframes", keyframes_from_arguments(args)),
+        ("decimation", decimation_from_arguments(args)),
+    ]:
+        options[key] = value.to_dict() if value else None
+    return options
+
+
+def process_arguments(options):
+    """The keyword arguments of process_all (and build_stages) of job options."""
+    kwargs = dict(options)
+    for key, option_class in OPTION_CLASSES.items():
+        if kwargs.get(key) is not None:
+            kwargs[key] = option_class(**kwargs[key])
+    return kwargs
+
+
+def default_node():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def new_job(job_id, kind, recording, options, after=(), **fields):
+    job = {
+        "id": job_id,
+        "kind": kind,
+        "recording": recording,
+        "options": options,
+        "after": list(after),
+        "created": time.time(),
+        "attempts": 0,
+    }
+    job.update(fields)
+    return job
+
+
+def recording_jobs(recording_path, options, shard_frames=SHARD_FRAMES):
+    """Jobs processing a recording, options are those of
+    options_from_arguments(). The depth streams are sharded by their selected
+    frames, which save_pclouds splits in frame ranges."""
+    name = recording_path.name
+    selection = process_arguments(options).get("selection")
+    if is_eye_only(recording_path) or not shard_frames:
+        return [new_job(name, "recording", name, options)]
+
+    depth_frames = {}
+    for sensor_name in DEPTH_SENSORS:
+        tar_path = recording_path / f"{sensor_name}.tar"
+        if tar_path.exists() and selection:
+            n_frames = len(selection.select_stream(recording_path, sensor_name))
+            depth_frames[sensor_name] = n_frames
+        elif tar_path.exists():
+            depth_frames[sensor_name] = len(load_tar_timestamps(tar_path))
+    if all(n <= shard_frames for n in depth_frames.values()):
+        return [new_job(name, "recording", name, options)]
+
+    # all depth streams are sharded, the merge writes the pinhole projection
+    # of the last one like process_all
+    prepare = new_job(f"{name}.prepare", "prepare", name, options)
+    jobs = [prepare]
+    for sensor_name, n_frames in depth_frames.items():
+        slug = sensor_name.replace(" ", "_")
+        for start in range(0, n_frames, shard_frames):
+            stop = min(start + shard_frames, n_frames)
+            jobs.append(
+                new_job(
+                    f"{name}.{slug}.{start:07d}-{stop:07d}",
+                    "pclouds",
+                    name,
+                    options,
+                    [prepare["id"]],
+                    sensor=sensor_name,
+                    frames=[start, stop],
+                )
+            )
+    jobs.append(
+        new_job(
+            f"{name}.merge",
+            "merge",
+            name,
+            options,
+            [job["id"] for job in jobs[1:]],
+            sensors=list(depth_frames),
+        )
+    )
+    return jobs
+
+
+class WorkQueue:
+    """The job folders of a workspace, see the module docstring."""
+
+    def __init__(self, w_path):
+        self.w_path = w_path
+        self.path = w_path / QUEUE_FOLDER
+        for state in STATES:
+            (self.path / state).mkdir(parents=True, exist_ok=True)
+
+    def job_path(self, state, job_id, node=None):
+        name = f"{job_id}@{node}.json" if node else f"{job_id}.json"
+        return self.path / state / name
+
+    def jobs(self, state):
+        """(job id, node, path) of the jobs in a state, in job id order."""
+        entries = []
+        for path in sorted((self.path / state).glob("*.json")):
+            job_id, _, node = path.stem.partition("@")
+            entries.append((job_id, node or None, path))
+        return entries
+
+    def job_ids(self, state):
+        return {job_id for job_id, _, _ in self.jobs(state)}
+
+    def submit(self, jobs):
+        """Queue the jobs of recordings without jobs in any state, returns
+        how many were queued."""
+        # job ids are the recording name, optionally followed by .<part>
+        known = set()
+        for state in STATES:
+            known |= {job_id.partition(".")[0] for job_id in self.job_ids(state)}
+        n_queued = 0
+        for job in jobs:
+            if job["recording"] not in known:
+                write_json(self.job_path(PENDING, job["id"]), job)
+                n_queued += 1
+        return n_queued
+
+    def retry_failed(self):
+        """Put the failed jobs back in pending, returns how many."""
+        n_retried = 0
+        for job_id, _, path in self.jobs(FAILED):
+            try:
+                job = read_json(path)
+            except (OSError, ValueError):
+                continue
+            job.update(attempts=0, error=None)
+            # a new pending file, it is only visible once complete
+            write_json(self.job_path(PENDING, job_id), job)
+            path.unlink()
+            n_retried += 1
+        return n_retried
+
+    def _fail_pending(self, path, job, error):
+        target = self.job_path(FAILED, job["id"])
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            return
+        job["error"] = error
+        write_json(target, job)
+        print(f"[!] {job['id']} failed: {error}")
+
+    def claim(self, node):
+        """Claim the first pending job whose dependencies are done, returns
+        (job, claim path) or None."""
+        done = self.job_ids(DONE)
+        failed = self.job_ids(FAILED)
+        for job_id, _, path in self.jobs(PENDING):
+            try:
+                job = read_json(path)
+            except (OSError, ValueError):
+                # claimed by another node in the meantime
+                continue
+            if any(required in failed for required in job["after"]):
+                self._fail_pending(path, job, "a job it depends on failed")
+                continue
+            if not all(required in done for required in job["after"]):
+                continue
+            claim_path = self.job_path(CLAIMED, job_id, node)
+            try:
+                # the rename keeps the mtime, the claim must not look stale
+                os.utime(path)
+                os.rename(path, claim_path)
+            except FileNotFoundError:
+                continue
+            job["attempts"] += 1
+            job.update(node=node, claimed=time.time())
+            write_json(claim_path, job)
+            return job, claim_path
+        return None
+
+    def release(self, job, claim_path):
+        """Give a claimed job back, e.g. when the worker is stopped."""
+        try:
+            os.rename(claim_path, self.job_path(PENDING, job["id"]))
+        except FileNotFoundError:
+            pass
+
+    def finish(self, job, claim_path, result, error=None):
+        """Move a claimed job to done or failed, returns False when the claim
+        was lost to the stale claim recovery meanwhile."""
+        target = self.job_path(FAILED if error else DONE, job["id"])
+        try:
+            os.rename(claim_path, target)
+        except FileNotFoundError:
+            print(f"[!] Lost the claim of {job['id']}, it was requeued")
+            return False
+        job.update(finished=time.time(), result=result, error=error)
+        write_json(target, job)
+        return True
+
+    def recover_stale(self, stale_after=STALE_AFTER_S, max_attempts=MAX_ATTEMPTS):
+        """Requeue the claims not touched for stale_after seconds."""
+        now = time.time()
+        for job_id, node, path in self.jobs(CLAIMED):
+            try:
+                if now - path.stat().st_mtime < stale_after:
+                    continue
+                job = read_json(path)
+            except (OSError, ValueError):
+                continue
+            failed = job["attempts"] >= max_attempts
+            target = self.job_path(FAILED if failed else PENDING, job_id)
+            try:
+                os.rename(path, target)
+            except FileNotFoundError:
+                # recovered by another node
+                continue
+            if failed:
+                job["error"] = f"claimed {max_attempts} times by stopped nodes"
+                # nothing takes jobs from failed/, it can be rewritten
+                write_json(target, job)
+                print(f"[!] {job_id} failed, {node} stopped responding")
+            else:
+                print(f"[!] Requeued {job_id}, {node} stopped responding")
+
+    def drained(self):
+        return not self.jobs(PENDING) and not self.jobs(CLAIMED)
+
+    def results(self, recording_name):
+        """The done jobs of a recording."""
+        jobs = []
+        for job_id, _, path in self.jobs(DONE):
+            if job_id == recording_name or job_id.startswith(recording_name + "."):
+                jobs.append(read_json(path))
+        return jobs
+
+
+class Heartbeat:
+    """Touches a claim every interval seconds while its job runs. Once the
+    claim is gone, lost is set and the job result has to be discarded: the job
+    was requeued and runs (or ran) on another node."""
+
+    def __init__(self, claim_path, interval):
+        self.claim_path = claim_path
+        self.interval = interval
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.claim_path)
+            except FileNotFoundError:
+                self.lost = True
+                print(f"[!] Lost the claim {self.claim_path.name}")
+                return
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def prepare_stage(recording_path, options):
+    """All stages of a sharded recording besides the point clouds."""
+    metrics = RecordingMetrics(recording_path)
+    filenames = [path.name for path in recording_path.iterdir() if path.is_file()]
+    for name, _, _, function in build_stages(filenames, **process_arguments(options)):
+        if not name.startswith("point clouds "):
+            with metrics.stage(name):
+                function(recording_path)
+    metrics.print_summary()
+
+
+def merge_stage(work_queue, recording_path, sensors, selection=None):
+    from save_pclouds import merge_pinhole_shards
+
+    shards = [
+        job
+        for job in work_queue.results(recording_path.name)
+        if job["kind"] == "pclouds"
+    ]
+    stages = []
+    for sensor_name in sensors:
+        n_merged = merge_pinhole_shards(recording_path, sensor_name)
+        sensor_shards = [job for job in shards if job["sensor"] == sensor_name]
+        frames = sum(job["frames"][1] - job["frames"][0] for job in sensor_shards)
+        busy = sum(job["result"]["seconds"] for job in sensor_shards)
+        print(f"[!] Merged {len(sensor_shards)} shards of {sensor_name}")
+        stages.append(
+            {
+                "name": f"point clouds {sensor_name}",
+                "status": "done",
+                "frames": frames,
+                "shards": len(sensor_shards),
+                "pinhole_shards": n_merged,
+                "shard_busy_s": busy,
+                "nodes": sorted({job["result"]["node"] for job in sensor_shards}),
+            }
+        )
+
+    # the shard timings join the stages recorded by the prepare job
+    metrics_path = recording_path / METRICS_FILENAME
+    content = read_json(metrics_path) if metrics_path.exists() else {"stages": []}
+    content["stages"] += stages
+    write_json(metrics_path, content)
+
+    check_stream_health(recording_path, selection)
+
+
+def run_job(work_queue, job):
+    recording_path = work_queue.w_path / job["recording"]
+    options = process_arguments(job["options"])
+    if job["kind"] == "recording":
+        process_all(recording_path, **options)
+    elif job["kind"] == "prepare":
+        prepare_stage(recording_path, job["options"])
+    elif job["kind"] == "pclouds":
+        from save_pclouds import save_pclouds
+
+        save_pclouds(
+            recording_path,
+            job["sensor"],
+            frame_range=job["frames"],
+            selection=options.get("selection"),
+            keyframes=options.get("keyframes"),
+            decimation=options.get("decimation"),
+        )
+    elif job["kind"] == "merge":
+        merge_stage(
+            work_queue, recording_path, job["sensors"], options.get("selection")
+        )
+    else:
+        raise ValueError(f"Unknown job kind {job['kind']}")
+
+
+def work(
+    w_path,
+    node=None,
+    poll=POLL_S,
+    heartbeat=HEARTBEAT_S,
+    stale_after=STALE_AFTER_S,
+    max_attempts=MAX_ATTEMPTS,
+    exit_when_empty=False,
+):
+    """Claim and run queued jobs until stopped, or with exit_when_empty until
+    nothing is pending or claimed. Returns the number of jobs finished."""
+    if heartbeat * 2 > stale_after:
+        raise ValueError("The heartbeat has to be below half of stale_after")
+    node = node or default_node()
+    work_queue = WorkQueue(w_path)
+    print(f"[!] Node {node} working on {work_queue.path}")
+    n_jobs = 0
+    while True:
+        work_queue.recover_stale(stale_after, max_attempts)
+        claimed = work_queue.claim(node)
+        if claimed is None:
+            if exit_when_empty and work_queue.drained():
+                break
+            time.sleep(poll)
+            continue
+
+        job, claim_path = claimed
+        print(f"\n[!] {node}: running {job['id']} (attempt {job['attempts']})")
+        beat = Heartbeat(claim_path, heartbeat)
+        beat.start()
+        start = time.perf_counter()
+        error = None
+        try:
+            run_job(work_queue, job)
+        except KeyboardInterrupt:
+            beat.stop()
+            work_queue.release(job, claim_path)
+            raise
+        except Exception as e:
+            traceback.print_exc()
+            error = f"{type(e).__name__}: {e}"
+        beat.stop()
+        if beat.lost:
+            # the job is not stopped when the claim is lost, its stages write
+            # the same outputs on every node, but the other node finishes it
+            print(f"[!] {node}: discarding {job['id']}, its claim was lost")
+            continue
+        result = {"node": node, "seconds": time.perf_counter() - start}
+        if work_queue.finish(job, claim_path, result, error):
+            state = "failed" if error else "done"
+            print(f"[!] {node}: {job['id']} {state} in {result['seconds']:.1f}s")
+            n_jobs += 1
+    print(f"[!] Node {node}: queue drained after {n_jobs} jobs")
+    return n_jobs
+
+
+def print_status(w_path, stale_after=STALE_AFTER_S):
+    work_queue = WorkQueue(w_path)
+    jobs = {state: work_queue.jobs(state) for state in STATES}
+    print(", ".join(f"{len(jobs[state])} {state}" for state in STATES))
+    now = time.time()
+    for job_id, node, path in jobs[CLAIMED]:
+        try:
+            age = now - path.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        stale = ", stale" if age >= stale_after else ""
+        print(f"    {job_id}: {node}, heartbeat {age:.0f}s ago{stale}")
+    for job_id, _, path in jobs[FAILED]:
+        print(f"    {job_id} failed: {read_json(path).get('error')}")
+
+    # busy time per node of the finished jobs
+    nodes = {}
+    for _, _, path in jobs[DONE]:
+        result = read_json(path)["result"]
+        n_jobs, seconds = nodes.get(result["node"], (0, 0.0))
+        nodes[result["node"]] = (n_jobs + 1, seconds + result["seconds"])
+    for node, (n_jobs, seconds) in sorted(nodes.items()):
+        print(f"    {node}: {n_jobs} jobs done in {seconds:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared workspace job queue.")
+    parser.add_argument("command", choices=["submit", "work", "status"])
+    parser.add_argument("--workspace", default="downloads", help="Workspace folder")
+    parser.add_argument(
+        "--recordings",
+        nargs="*",
+        default=None,
+        help="submit: names of the recordings, all unprocessed ones by default",
+    )
+    parser.add_argument(
+        "--shard_frames",
+        type=int,
+        default=SHARD_FRAMES,
+        help="submit: split the point clouds of depth streams longer than this "
+        "in jobs of this many frames, 0 to never split",
+    )
+    parser.add_argument(
+        "--retry_failed",
+        action="store_true",
+        help="submit: queue the failed jobs again",
+    )
+    parser.add_argument(
+        "--project_hand_eye",
+        action="store_true",
+        help="submit: project hand joints (and eye gaze, if recorded) to rgb images",
+    )
+    parser.add_argument(
+        "--overlay_output",
+        default="video",
+        choices=["video", "png"],
+        help="submit: render the hand/eye overlays to a video or to a png sequence",
+    )
+    parser.add_argument(
+        "--overlay_scale",
+        type=float,
+        default=1.0,
+        help="submit: downscale factor for the hand/eye overlays",
+    )
+    parser.add_argument(
+        "--node", default=None, help="work: name of the node, <host>-<pid> by default"
+    )
+    parser.add_argument(
+        "--poll", type=float, default=POLL_S, help="work: seconds between polls"
+    )
+    parser.add_argument(
+        "--heartbeat",
+        type=float,
+        default=HEARTBEAT_S,
+        help="work: seconds between the touches of a claim",
+    )
+    parser.add_argument(
+        "--stale_after",
+        type=float,
+        default=STALE_AFTER_S,
+        help="Seconds without heartbeat after which a claim is requeued",
+    )
+    parser.add_argument(
+        "--max_attempts",
+        type=int,
+        default=MAX_ATTEMPTS,
+        help="work: claims of a job by nodes that stopped before it fails",
+    )
+    parser.add_argument(
+        "--exit_when_empty",
+        action="store_true",
+        help="work: stop once nothing is pending or claimed",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="work: worker processes of every stage, all cores by default",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="work: OpenCV/OpenMP/BLAS threads per worker, cores / workers by "
+        "default, 0 for the library defaults",
+    )
+    parser.add_argument(
+        "--affinity",
+        action="store_true",
+        help="work: pin every worker to its own cores (Linux only)",
+    )
+    # submit: the frames processed, stored with the jobs
+    add_selection_arguments(parser)
+    add_keyframe_arguments(parser)
+    add_decimation_arguments(parser)
+
+    args = parser.parse_args()
+    w_path = Path(args.workspace)
+    if args.command == "submit":
+        work_queue = WorkQueue(w_path)
+        if args.retry_failed:
+            print(f"[!] Retrying {work_queue.retry_failed()} failed jobs")
+        options = options_from_arguments(args)
+        jobs = []
+        for recording_path in select_recordings(w_path, args.recordings):
+            jobs += recording_jobs(recording_path, options, args.shard_frames)
+        print(f"[!] Queued {work_queue.submit(jobs)} jobs")
+    elif args.command == "work":
+        set_thread_policy(args.workers, args.threads_per_worker, args.affinity)
+        work(
+            w_path,
+            args.node,
+            args.poll,
+            args.heartbeat,
+            args.stale_after,
+            args.max_attempts,
+            args.exit_when_empty,
+        )
+    else:
+        print_status(w_path, args.stale_after)
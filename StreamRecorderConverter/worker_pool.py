@@ -0,0 +1,130 @@
+"""Process pools of the converters.
+
+A stage gets its pool from stage_pool(). Run on its own, every stage starts a
+pool of all cores. batch_process installs one shared pool for all the stages
+it runs side by side, so they split the cores instead of each starting a
+pool of all of them.
+
+Every pool follows the thread policy of set_thread_policy(): the workers
+already share the cores, so OpenCV, OpenMP (Open3D) and BLAS inside them are
+limited to cpu_count() // workers threads each instead of starting a thread
+per core in every worker, optionally with every worker pinned to its own
+cores.
+"""
+import multiprocessing
+import os
+from contextlib import contextmanager
+
+from stage_metrics import pool_started
+
+# read by OpenMP and the BLAS libraries when they are loaded
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+_shared_pool = None
+_shared_workers = 0
+# workers None: all cores, threads None: cores per worker, 0: library defaults
+_policy = {"workers": None, "threads": None, "affinity": False}
+
+
+def set_thread_policy(workers=None, threads=None, affinity=False):
+    """Pool size and threads per pool worker of the stages of this process.
+
+    The limits are applied in the pool workers only, the main process keeps
+    the library defaults for what it runs itself (e.g. the TSDF integration).
+    threads=0 leaves the libraries at their defaults in the workers too. With
+    affinity every worker is pinned to threads cores of its own (Linux only).
+    """
+    _policy.update(workers=workers, threads=threads, affinity=affinity)
+
+
+def threads_per_worker(workers):
+    if _policy["threads"] is not None:
+        return _policy["threads"]
+    return max(1, multiprocessing.cpu_count() // workers)
+
+
+def set_thread_env(threads):
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+
+
+def init_worker(threads, affinity, worker_counter):
+    """Pool initializer applying the thread policy in a worker."""
+    if threads:
+        # for the libraries the worker loads itself
+        set_thread_env(threads)
+        import cv2
+
+        cv2.setNumThreads(threads)
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            pass
+        else:
+            # BLAS (and OpenMP) the parent loaded before the fork
+            threadpool_limits(threads)
+
+    if affinity and hasattr(os, "sched_setaffinity"):
+        with worker_counter.get_lock():
+            index = worker_counter.value
+            worker_counter.value += 1
+        cpus = sorted(os.sched_getaffinity(0))
+        n_cpus = max(threads, 1)
+        start = (index * n_cpus) % len(cpus)
+        os.sched_setaffinity(0, cpus[start : start + n_cpus])
+
+
+def new_pool(workers):
+    threads = threads_per_worker(workers)
+    return multiprocessing.Pool(
+        workers,
+        initializer=init_worker,
+        initargs=(threads, _policy["affinity"], multiprocessing.Value("i", 0)),
+    )
+
+
+@contextmanager
+def shared_pool(workers):
+    """Run the stage pools of the with block, in any thread, on one pool of
+    workers processes."""
+    global _shared_pool, _shared_workers
+    pool = new_pool(workers)
+    _shared_pool, _shared_workers = pool, workers
+    try:
+        yield pool
+    finally:
+        _shared_pool, _shared_workers = None, 0
+        pool.close()
+        pool.join()
+
+
+@contextmanager
+def stage_pool(workers=None):
+    """Pool for the frames of a stage, yields (pool, number of workers).
+
+    Outside of shared_pool() this is a new pool of workers processes (the
+    policy's pool size, all cores by default), joined when the block exits.
+    Inside of it the shared pool is yielded and workers is ignored, so a stage
+    has to wait for its own tasks before leaving the block.
+    """
+    if _shared_pool is not None:
+        pool_started(_shared_workers)
+        yield _shared_pool, _shared_workers
+        return
+
+    workers = workers or _policy["workers"] or multiprocessing.cpu_count()
+    pool = new_pool(workers)
+    pool_started(workers)
+    try:
+        yield pool, workers
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
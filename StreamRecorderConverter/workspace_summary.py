@@ -0,0 +1,225 @@
+import json
+import os
+
+from process_all import build_stages, is_eye_only
+from recording_files import PROJECTION_FILENAME, folders_extensions, load_tar_timestamps
+
+SUMMARY_FILENAME = "summaries.json"
+# bump when the content of a summary changes, cached ones are then rebuilt
+SUMMARY_VERSION = 1
+HundredsOfNsToSeconds = 1e-7
+
+RAW = "raw"
+PARTIAL = "partial"
+PROCESSED = "processed"
+
+
+def stream_entry(timestamps_first, timestamps_last, n_frames):
+    duration = (timestamps_last - timestamps_first) * HundredsOfNsToSeconds
+    return {"frames": int(n_frames), "duration_s": float(max(duration, 0))}
+
+
+def csv_stream_entry(csv_path):
+    """Row count and time span of a csv stream from its first and last lines,
+    without parsing the rows in between."""
+    with open(csv_path, "rb") as f:
+        first = f.readline()
+        if not first.strip():
+            return stream_entry(0, 0, 0)
+        f.seek(0)
+        n_rows = 0
+        block = b""
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            n_rows += block.count(b"\n")
+        if not block.endswith(b"\n"):
+            n_rows += 1
+        f.seek(max(f.tell() - 64 * 1024, 0))
+        last = f.read().rstrip(b"\n").rsplit(b"\n", 1)[-1]
+    first_ts = int(float(first.split(b",", 1)[0]))
+    last_ts = int(float(last.split(b",", 1)[0]))
+    return stream_entry(first_ts, last_ts, n_rows)
+
+
+def pv_stream_entry(pv_info_path):
+    with open(pv_info_path) as f:
+        lines = [line for line in f.readlines()[1:] if line.strip()]
+    if len(lines) == 0:
+        return stream_entry(0, 0, 0)
+    first_ts = int(lines[0].split(",", 1)[0])
+    last_ts = int(lines[-1].split(",", 1)[0])
+    return stream_entry(first_ts, last_ts, len(lines))
+
+
+def folder_stream_entry(folder, extension):
+    timestamps = sorted(int(path.stem) for path in folder.glob("*%s" % extension))
+    if len(timestamps) == 0:
+        return stream_entry(0, 0, 0)
+    return stream_entry(timestamps[0], timestamps[-1], len(timestamps))
+
+
+def stage_done(recording_path, stage_name):
+    """Whether the outputs of a processing stage from build_stages exist."""
+    if stage_name.startswith("extract "):
+        folder = recording_path / stage_name[len("extract ") : -len(".tar")]
+        return folder.is_dir() and any(folder.iterdir())
+    if stage_name == "convert PV":
+        return any((recording_path / "PV").glob("*.png"))
+    if stage_name == "project hand/eye":
+        return (recording_path / "eye_hands" / PROJECTION_FILENAME).exists()
+    if stage_name.startswith("point clouds "):
+        sensor_name = stage_name[len("point clouds ") :]
+        return any((recording_path / sensor_name).glob("*.ply"))
+    return False
+
+
+def summarize_recording(recording_path):
+    """Streams, frame counts, duration, size and processing state of a
+    recording, read from the tar indexes and the pose/csv files."""
+    files = [path for path in recording_path.iterdir() if path.is_file()]
+    filenames = [path.name for path in files]
+
+    streams = {}
+    for sensor_name, extension in folders_extensions:
+        tar_path = recording_path / f"{sensor_name}.tar"
+        if tar_path.exists():
+            timestamps = load_tar_timestamps(tar_path)
+            if len(timestamps):
+                streams[sensor_name] = stream_entry(
+                    timestamps[0], timestamps[-1], len(timestamps)
+                )
+            else:
+                streams[sensor_name] = stream_entry(0, 0, 0)
+        elif (recording_path / sensor_name).is_dir():
+            streams[sensor_name] = folder_stream_entry(
+                recording_path / sensor_name, extension
+            )
+    if "PV" not in streams:
+        for pv_info_path in recording_path.glob("*pv.txt"):
+            streams["PV"] = pv_stream_entry(pv_info_path)
+    for csv_path in recording_path.glob("*_eye.csv"):
+        streams["Head/hand/eye"] = csv_stream_entry(csv_path)
+
+    if is_eye_only(recording_path):
+        stages = ["eye"]
+        done = [(recording_path / "gaze.npz").exists()]
+    else:
+        stages = [stage[0] for stage in build_stages(filenames, True)]
+        done = [stage_done(recording_path, stage) for stage in stages]
+    if all(done):
+        state = PROCESSED
+    elif any(done):
+        state = PARTIAL
+    else:
+        state = RAW
+
+    return {
+        "name": recording_path.name,
+        "size": sum(path.stat().st_size for path in files),
+        "duration_s": max(
+            (stream["duration_s"] for stream in streams.values()), default=0.0
+        ),
+        "streams": streams,
+        "stages": len(stages),
+        "stages_done": sum(done),
+        "state": state,
+    }
+
+
+def recording_signature(recording_path):
+    # top level entries change whenever files arrive or a stage writes its
+    # outputs into one of the sensor folders
+    entries = []
+    with os.scandir(recording_path) as it:
+        for entry in it:
+            stat = entry.stat()
+            entries.append([entry.name, stat.st_size, stat.st_mtime_ns])
+    return sorted(entries)
+
+
+class WorkspaceSummaries:
+    """Summaries of the workspace recordings, cached in the workspace.
+
+    A summary is recomputed only when the top level entries of its recording
+    changed since it was cached, so listing a large workspace is cheap.
+    """
+
+    def __init__(self, w_path):
+        self.w_path = w_path
+        self.cache_path = w_path / SUMMARY_FILENAME
+        self.cache = {}
+        self.changed = False
+        if self.cache_path.exists():
+            try:
+                with open(self.cache_path) as f:
+                    self.cache = json.load(f)
+            except ValueError:
+                print("[!] Ignoring corrupt summary cache")
+
+    def save(self):
+        tmp_path = str(self.cache_path) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def get(self, recording_path):
+        signature = recording_signature(recording_path)
+        cached = self.cache.get(recording_path.name)
+        if (
+            cached is None
+            or cached["signature"] != signature
+            or cached.get("version") != SUMMARY_VERSION
+        ):
+            # failures are cached as well, until the recording changes
+            cached = {"signature": signature, "version": SUMMARY_VERSION}
+            try:
+                cached["summary"] = summarize_recording(recording_path)
+            except Exception as e:
+                print(f"[!] Could not summarize {recording_path.name}: {e}")
+                cached["summary"] = None
+            self.cache[recording_path.name] = cached
+            self.changed = True
+        return cached["summary"]
+
+    def summaries(self, recording_paths):
+        """Summaries of the given recordings, updating and saving the cache."""
+        self.changed = False
+        summaries = [self.get(path) for path in recording_paths]
+
+        names = {path.name for path in recording_paths}
+        for name in list(self.cache):
+            if name not in names:
+                del self.cache[name]
+                self.changed = True
+        if self.changed:
+            self.save()
+        return summaries
+
+
+def matches(summary, filters):
+    """Filters are 'processed', 'unprocessed', 'partial', 'raw' or
+    ('has', <text>) matching a stream name, e.g. ('has', 'AHaT')."""
+    for f in filters:
+        if f == "unprocessed":
+            if summary["state"] == PROCESSED:
+                return False
+        elif f in (RAW, PARTIAL, PROCESSED):
+            if summary["state"] != f:
+                return False
+        elif isinstance(f, tuple) and f[0] == "has":
+            if not any(f[1].lower() in name.lower() for name in summary["streams"]):
+                return False
+    return True
+
+
+def parse_filters(arg):
+    words = arg.split()
+    filters = []
+    while words:
+        word = words.pop(0)
+        if word == "has" and words:
+            filters.append(("has", words.pop(0)))
+        elif word in ("processed", "unprocessed", RAW, PARTIAL):
+            filters.append(word)
+        else:
+            raise ValueError(word)
+    return filters
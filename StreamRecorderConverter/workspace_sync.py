@@ -0,0 +1,113 @@
+from functools import partial
+
+from connection import HololensInterface, format_size
+from device_recordings import DeviceRecordings
+
+NEW = "new"
+INCOMPLETE = "incomplete"
+COMPLETE = "complete"
+
+
+def local_file_state(path, file):
+    """State of the local copy of a device file item, compared by size."""
+    if path.exists():
+        if path.stat().st_size == file.get("FileSize", -1):
+            return COMPLETE
+        return INCOMPLETE
+    if path.with_name(path.name + ".part").exists():
+        return INCOMPLETE
+    return NEW
+
+
+def plan_sync(recordings: DeviceRecordings, w_path, refresh=True):
+    """Compare the device recordings with the workspace.
+
+    Returns one entry per device recording with its files split into
+    new, incomplete (partial or different size) and complete ones.
+    """
+    plan = []
+    for recording in recordings.list(refresh):
+        entry = {"name": recording["name"], NEW: [], INCOMPLETE: [], COMPLETE: []}
+        for file in recording["files"]:
+            state = local_file_state(w_path / recording["name"] / file["Id"], file)
+            entry[state].append(file)
+        plan.append(entry)
+    return plan
+
+
+def print_plan(plan):
+    to_transfer = 0
+    n_files = 0
+    for entry in plan:
+        files = entry[NEW] + entry[INCOMPLETE]
+        size = sum(file.get("FileSize", 0) for file in files)
+        if len(files) == 0:
+            status = "up to date"
+        elif len(entry[COMPLETE]) == 0 and len(entry[INCOMPLETE]) == 0:
+            status = "new, {} files, {}".format(len(files), format_size(size))
+        else:
+            status = "{} new, {} incomplete, {}".format(
+                len(entry[NEW]), len(entry[INCOMPLETE]), format_size(size)
+            )
+        print("    {}  {}".format(entry["name"], status))
+        to_transfer += size
+        n_files += len(files)
+    print(
+        "[!] Sync plan: {} files, {} to transfer".format(
+            n_files, format_size(to_transfer)
+        )
+    )
+
+
+def recording_progress(progress, name, filename, *args):
+    progress(f"{name}/{filename}", *args)
+
+
+def execute_sync(
+    holo: HololensInterface,
+    recordings: DeviceRecordings,
+    plan,
+    w_path,
+    max_downloads=4,
+    delete=False,
+    progress=None,
+):
+    """Transfer the new and incomplete files of the plan and optionally delete
+    the recordings whose files are all verified in the workspace. progress is
+    passed on to HololensInterface.download_files with the files named
+    <recording>/<filename>."""
+    for entry in plan:
+        name = entry["name"]
+        files = entry[NEW] + entry[INCOMPLETE]
+        if len(files):
+            recording_path = w_path / name
+            # files of the wrong size are replaced once their download completes
+            recording_path.mkdir(exist_ok=True)
+            print("[!] Syncing recording {}...".format(name))
+            file_progress = None
+            if progress:
+                file_progress = partial(recording_progress, progress, name)
+            holo.download_files(
+                "LocalAppData",
+                [file["Id"] for file in files],
+                recording_path,
+                recordings.package_full_name,
+                f"LocalState/{name}",
+                max_workers=max_downloads,
+                progress=file_progress,
+            )
+
+        if delete:
+            all_files = entry[NEW] + entry[INCOMPLETE] + entry[COMPLETE]
+            verified = all(
+                local_file_state(w_path / name / file["Id"], file) == COMPLETE
+                for file in all_files
+            )
+            if verified:
+                print("[!] Deleting verified recording {}...".format(name))
+                holo.delete_file(
+                    "LocalAppData", name, recordings.package_full_name, "LocalState"
+                )
+            else:
+                print("[!] Not deleting {}, files do not match".format(name))
+    recordings.invalidate()
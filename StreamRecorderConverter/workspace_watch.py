@@ -0,0 +1,379 @@
+"""Process recordings as they arrive in the workspace.
+
+The watcher polls the workspace every --poll seconds. A recording is queued
+once it is complete: no download is in progress ('.part' files), every stream
+tar can be read and comes with its calibration and pose files, and none of
+its files changed for --settle seconds. Queued recordings are processed one
+after the other with process_all, or submitted to the shared work queue of
+work_queue.py with --work_queue.
+
+The state of every recording is kept in <workspace>/watch.sqlite, so that a
+recording is processed once, also across restarts of the watcher. Recordings
+already processed when the watcher first sees them are only recorded as done.
+Run one watcher per workspace.
+
+    python workspace_watch.py --workspace downloads --project_hand_eye
+"""
+import argparse
+import fnmatch
+import json
+import os
+import sqlite3
+import tarfile
+import time
+import traceback
+from pathlib import Path
+
+from depth_decimation import add_decimation_arguments
+from frame_selection import add_selection_arguments
+from keyframes import add_keyframe_arguments
+from process_all import build_stages, is_eye_only, process_all
+from recording_files import load_tar_timestamps
+from work_queue import (
+    SHARD_FRAMES,
+    WorkQueue,
+    options_from_arguments,
+    process_arguments,
+    recording_jobs,
+)
+from worker_pool import set_thread_policy
+from workspace_summary import stage_done
+
+WATCH_FILENAME = "watch.sqlite"
+SETTLING = "settling"
+QUEUED = "queued"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+SUBMITTED = "submitted"
+POLL_S = 10.0
+SETTLE_S = 60.0
+# files downloaded from the device, the outputs of the processing are left out
+INPUT_SUFFIXES = (".tar", ".bin", ".txt", ".csv", ".part")
+
+
+class WatchState:
+    """The recordings seen by the watcher, in a sqlite database."""
+
+    def __init__(self, db_path):
+        self.connection = sqlite3.connect(str(db_path))
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS recordings (
+                    name TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    signature TEXT NOT NULL,
+                    changed REAL NOT NULL,
+                    options TEXT,
+                    queued REAL,
+                    started REAL,
+                    finished REAL,
+                    note TEXT
+                )"""
+            )
+
+    def get(self, name):
+        return self.connection.execute(
+            "SELECT * FROM recordings WHERE name = ?", (name,)
+        ).fetchone()
+
+    def add(self, name, state, signature, note=None):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO recordings (name, state, signature, changed, note) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (name, state, signature, time.time(), note),
+            )
+
+    def update(self, name, **fields):
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        with self.connection:
+            self.connection.execute(
+                f"UPDATE recordings SET {columns} WHERE name = ?",
+                list(fields.values()) + [name],
+            )
+
+    def in_state(self, state):
+        """Names of the recordings in a state, in the order they were queued."""
+        rows = self.connection.execute(
+            "SELECT name FROM recordings WHERE state = ? ORDER BY queued, name",
+            (state,),
+        )
+        return [row["name"] for row in rows]
+
+    def rows(self):
+        return self.connection.execute("SELECT * FROM recordings ORDER BY name")
+
+
+def input_signature(recording_path):
+    """Name, size and mtime of the downloaded files of a recording."""
+    entries = []
+    with os.scandir(recording_path) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith(INPUT_SUFFIXES):
+                stat = entry.stat()
+                entries.append([entry.name, stat.st_size, stat.st_mtime_ns])
+    return json.dumps(sorted(entries))
+
+
+def missing_files(recording_path):
+    """Why a recording is not complete yet, None when it is."""
+    filenames = [path.name for path in recording_path.iterdir() if path.is_file()]
+    if any(name.endswith(".part") for name in filenames):
+        return "downloading"
+    if is_eye_only(recording_path):
+        return None
+    tar_names = [name for name in filenames if name.endswith(".tar")]
+    if not tar_names:
+        return "no streams"
+    for tar_name in tar_names:
+        sensor_name = tar_name[: -len(".tar")]
+        if sensor_name == "PV":
+            required = ["*pv.txt"]
+        else:
+            required = [
+                f"{sensor_name}_lut.bin",
+                f"{sensor_name}_extrinsics.txt",
+                f"{sensor_name}_rig2world.txt",
+            ]
+        for pattern in required:
+            if not fnmatch.filter(filenames, pattern):
+                return f"no {pattern}"
+        try:
+            load_tar_timestamps(recording_path / tar_name)
+        except (tarfile.TarError, OSError):
+            return f"{tar_name} is not readable"
+    return None
+
+
+def already_processed(recording_path, options):
+    """Whether the outputs of all stages process_all would run exist."""
+    if is_eye_only(recording_path):
+        return (recording_path / "gaze.npz").exists()
+    filenames = [path.name for path in recording_path.iterdir() if path.is_file()]
+    stages = build_stages(filenames, **process_arguments(options))
+    return bool(stages) and all(stage_done(recording_path, s[0]) for s in stages)
+
+
+class WorkspaceWatcher:
+    """Queues the complete recordings of a workspace and processes them,
+    options are those of work_queue.options_from_arguments(), kept with every
+    queued recording."""
+
+    def __init__(
+        self,
+        w_path,
+        options,
+        settle=SETTLE_S,
+        use_work_queue=False,
+        shard_frames=SHARD_FRAMES,
+    ):
+        self.w_path = w_path
+        self.options = options
+        self.settle = settle
+        self.work_queue = WorkQueue(w_path) if use_work_queue else None
+        self.shard_frames = shard_frames
+        self.state = WatchState(w_path / WATCH_FILENAME)
+        # recordings the watcher was stopped in are processed again
+        for name in self.state.in_state(PROCESSING):
+            print(f"[!] {name} was interrupted, queueing it again")
+            self.state.update(name, state=QUEUED)
+
+    def recordings(self):
+        # hidden folders, like the job queue of work_queue.py, are no recordings
+        return sorted(
+            path
+            for path in self.w_path.glob("*")
+            if path.is_dir() and not path.name.startswith(".")
+        )
+
+    def scan(self):
+        """Record new recordings and queue the settled and complete ones."""
+        now = time.time()
+        for recording_path in self.recordings():
+            name = recording_path.name
+            row = self.state.get(name)
+            if row is not None and row["state"] != SETTLING:
+                continue
+            signature = input_signature(recording_path)
+            if row is None:
+                if already_processed(recording_path, self.options):
+                    self.state.add(name, DONE, signature, "processed before")
+                else:
+                    print(f"[!] New recording {name}")
+                    self.state.add(name, SETTLING, signature)
+                continue
+            if signature != row["signature"]:
+                self.state.update(name, signature=signature, changed=now)
+                continue
+            if now - row["changed"] < self.settle:
+                continue
+
+            reason = missing_files(recording_path)
+            if reason is not None:
+                if reason != row["note"]:
+                    print(f"[!] Waiting for {name}: {reason}")
+                    self.state.update(name, note=reason)
+                continue
+            print(f"[!] Queueing {name}")
+            self.state.update(
+                name,
+                state=QUEUED,
+                options=json.dumps(self.options),
+                queued=now,
+                note=None,
+            )
+
+    def process_next(self):
+        """Process (or submit) the first queued recording, returns False when
+        none is queued."""
+        queued = self.state.in_state(QUEUED)
+        if not queued:
+            return False
+        name = queued[0]
+        recording_path = self.w_path / name
+        options = json.loads(self.state.get(name)["options"])
+        self.state.update(name, state=PROCESSING, started=time.time())
+
+        if self.work_queue is not None:
+            jobs = recording_jobs(recording_path, options, self.shard_frames)
+            n_jobs = self.work_queue.submit(jobs)
+            print(f"[!] Submitted {name} as {n_jobs} jobs")
+            self.state.update(name, state=SUBMITTED, finished=time.time())
+            return True
+
+        print(f"\n[!] Processing {name}")
+        try:
+            process_all(recording_path, **process_arguments(options))
+        except Exception as e:
+            traceback.print_exc()
+            print(f"[!] Processing {name} failed")
+            self.state.update(name, state=FAILED, finished=time.time(), note=f"{e!r}")
+        else:
+            self.state.update(name, state=DONE, finished=time.time())
+        return True
+
+
+def watch(
+    w_path,
+    options,
+    poll=POLL_S,
+    settle=SETTLE_S,
+    use_work_queue=False,
+    shard_frames=SHARD_FRAMES,
+    once=False,
+):
+    """Watch the workspace until interrupted, with once until no recording
+    is queued or settling."""
+    watcher = WorkspaceWatcher(w_path, options, settle, use_work_queue, shard_frames)
+    print(f"[!] Watching {w_path}, {WATCH_FILENAME} keeps the processed recordings")
+    while True:
+        watcher.scan()
+        if watcher.process_next():
+            # new recordings are looked for between two recordings
+            continue
+        if once and not watcher.state.in_state(SETTLING):
+            return
+        time.sleep(poll)
+
+
+def print_state(w_path):
+    state = WatchState(w_path / WATCH_FILENAME)
+    for row in state.rows():
+        text = f"    {row['name']}: {row['state']}"
+        if row["started"] and row["finished"]:
+            text += " in {:.1f}s".format(row["finished"] - row["started"])
+        if row["note"]:
+            text += f" ({row['note']})"
+        print(text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process arriving recordings.")
+    parser.add_argument("--workspace", default="downloads", help="Workspace folder")
+    parser.add_argument(
+        "--poll", type=float, default=POLL_S, help="Seconds between workspace scans"
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=SETTLE_S,
+        help="Seconds the files of a recording have to stay unchanged",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Exit once no recording is queued or settling",
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Print the state of the recordings seen by the watcher and exit",
+    )
+    parser.add_argument(
+        "--work_queue",
+        action="store_true",
+        help="Submit the recordings to the work queue of work_queue.py instead "
+        "of processing them",
+    )
+    parser.add_argument(
+        "--shard_frames",
+        type=int,
+        default=SHARD_FRAMES,
+        help="With --work_queue, split the point clouds of longer depth streams",
+    )
+    parser.add_argument(
+        "--project_hand_eye",
+        action="store_true",
+        help="Project hand joints (and eye gaze, if recorded) to rgb images",
+    )
+    parser.add_argument(
+        "--overlay_output",
+        default="video",
+        choices=["video", "png"],
+        help="Render the hand/eye overlays to a video or to a png sequence",
+    )
+    parser.add_argument(
+        "--overlay_scale",
+        type=float,
+        default=1.0,
+        help="Downscale factor for the hand/eye overlays",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes of every stage, all cores by default",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="OpenCV/OpenMP/BLAS threads per worker, cores / workers by default, "
+        "0 for the library defaults",
+    )
+    parser.add_argument(
+        "--affinity",
+        action="store_true",
+        help="Pin every worker to its own cores (Linux only)",
+    )
+    add_selection_arguments(parser)
+    add_keyframe_arguments(parser)
+    add_decimation_arguments(parser)
+
+    args = parser.parse_args()
+    w_path = Path(args.workspace)
+    if args.status:
+        print_state(w_path)
+    else:
+        set_thread_policy(args.workers, args.threads_per_worker, args.affinity)
+        watch(
+            w_path,
+            options_from_arguments(args),
+            args.poll,
+            args.settle,
+            args.work_queue,
+            args.shard_frames,
+            args.once,
+        )